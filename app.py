@@ -1,11 +1,41 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory
+from flask import before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 from datetime import date
-from sqlalchemy import extract, event
+from datetime import time as dt_time
+from datetime import timedelta, timezone
+from zoneinfo import ZoneInfo
+from sqlalchemy import extract, event, text, inspect
+from sqlalchemy.engine import Engine
 from sqlalchemy.pool import QueuePool, NullPool
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.dialects import postgresql, sqlite
 import os
+import gzip
+import hashlib
+import hmac
+import json
 import logging
+import math
+import mmap
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import deque
+from itertools import groupby, zip_longest
+from urllib.parse import urlsplit
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # ------------------
 # Logging Setup
@@ -13,6 +43,114 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ------------------
+# Connection Pool
+# ------------------
+class PoolMetrics:
+    """Checkout wait, overflow and connection age for this worker's pool."""
+
+    def __init__(self, window=1000, slow_checkout_ms=100):
+        self.slow_checkout_ms = slow_checkout_ms
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=window)
+        self.checkouts = 0
+        self.failed_checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.connects = 0
+        self.closes = 0
+        self._connected_at = {}
+
+    def record_checkout(self, seconds, failed=False):
+        with self._lock:
+            if failed:
+                self.failed_checkouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            self._waits.append(seconds)
+        if seconds * 1000 >= self.slow_checkout_ms:
+            logger.warning(f"✗ Slow DB connection checkout: {seconds * 1000:.0f} ms")
+
+    def record_connect(self, dbapi_connection):
+        with self._lock:
+            self.connects += 1
+            self._connected_at[id(dbapi_connection)] = time.monotonic()
+
+    def record_close(self, dbapi_connection):
+        with self._lock:
+            self.closes += 1
+            self._connected_at.pop(id(dbapi_connection), None)
+
+    def snapshot(self, pool):
+        with self._lock:
+            waits = sorted(self._waits)
+            now = time.monotonic()
+            ages = sorted(now - opened for opened in self._connected_at.values())
+            checkouts = self.checkouts + self.failed_checkouts
+            result = {
+                'pid': os.getpid(),
+                'pool_class': type(pool).__name__,
+                'checkouts': self.checkouts,
+                'failed_checkouts': self.failed_checkouts,
+                'wait_ms_avg': round(self.wait_total / checkouts * 1000, 2) if checkouts else 0.0,
+                'wait_ms_p95': round(waits[max(0, int(len(waits) * 0.95) - 1)] * 1000, 2) if waits else 0.0,
+                'wait_ms_max': round(self.wait_max * 1000, 2),
+                'connects': self.connects,
+                'closes': self.closes,
+                'open_connections': len(ages),
+                'connection_age_s_max': round(ages[-1], 1) if ages else 0.0,
+                'connection_age_s_avg': round(sum(ages) / len(ages), 1) if ages else 0.0,
+            }
+        # NullPool keeps nothing, so these only exist on QueuePool
+        for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+            if hasattr(pool, name):
+                result[name] = getattr(pool, name)()
+        return result
+
+pool_metrics = PoolMetrics(slow_checkout_ms=float(os.environ.get('DB_POOL_SLOW_CHECKOUT_MS', 100)))
+
+class _MeteredPool:
+    """Times every checkout, including the wait for a free connection."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            pool_metrics.record_checkout(time.perf_counter() - started, failed=True)
+            raise
+        pool_metrics.record_checkout(time.perf_counter() - started)
+        return connection
+
+class MeteredQueuePool(_MeteredPool, QueuePool):
+    pass
+
+class MeteredNullPool(_MeteredPool, NullPool):
+    pass
+
+for _pool_class in (MeteredQueuePool, MeteredNullPool):
+    event.listen(_pool_class, 'connect', lambda dbapi_connection, record: pool_metrics.record_connect(dbapi_connection))
+    event.listen(_pool_class, 'close', lambda dbapi_connection, record: pool_metrics.record_close(dbapi_connection))
+
+def pool_sizing():
+    """(pool_size, max_overflow) for one worker, keeping all workers within DB_CONNECTION_BUDGET."""
+    workers = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+    threads = max(1, int(os.environ.get('GUNICORN_THREADS', 1)))
+    budget = max(workers, int(os.environ.get('DB_CONNECTION_BUDGET', 15)))
+    per_worker = budget // workers
+    pool_size = int(os.environ.get('DB_POOL_SIZE', min(threads, per_worker)))
+    max_overflow = int(os.environ.get('DB_MAX_OVERFLOW', max(0, per_worker - pool_size)))
+    return pool_size, max_overflow
+
+def uses_transaction_pooler(url):
+    """PgBouncer/Supavisor in transaction mode (DB_POOL_MODE=transaction or port 6543)."""
+    mode = os.environ.get('DB_POOL_MODE', '').lower()
+    if mode:
+        return mode == 'transaction'
+    return urlsplit(url).port == 6543
+
 # ------------------
 # App Setup
 # ------------------
@@ -42,30 +180,113 @@ if database_url:
     
     app.config['SQLALCHEMY_DATABASE_URI'] = database_url
     
-    # Connection pooling for PostgreSQL (important for performance!)
-    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-        'poolclass': QueuePool,
-        'pool_size': 5,
-        'max_overflow': 10,
-        'pool_recycle': 3600,  # Recycle connections every hour
-        'pool_pre_ping': True,  # Verify connections before using them
-        'echo': True,  # Log SQL queries (disable in production if you want)
-    }
+    if uses_transaction_pooler(database_url):
+        # The external pooler owns the connections: open one per checkout and
+        # hand it straight back. Server-side prepared statements don't survive
+        # a pooler switching backends between transactions, so psycopg 3 must
+        # never prepare (prepare_threshold=None).
+        logger.info("📊 Transaction pooler mode (NullPool, no prepared statements)")
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'poolclass': MeteredNullPool,
+            'connect_args': {'prepare_threshold': None},
+        }
+    else:
+        # Connection pooling for PostgreSQL (important for performance!)
+        pool_size, max_overflow = pool_sizing()
+        logger.info(f"📊 Connection pool: size {pool_size}, overflow {max_overflow} per worker")
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'poolclass': MeteredQueuePool,
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+            # Recycle before the server/pooler drops idle connections
+            'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+            # Costs a round trip per checkout; only needed on flaky networks
+            'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '').lower() in ('1', 'true', 'yes'),
+        }
+    # Log SQL queries only when asked
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['echo'] = os.environ.get('SQLALCHEMY_ECHO', '').lower() in ('1', 'true', 'yes')
 else:
     # For development (SQLite)
     logger.info(f"📁 Using SQLite database")
     db_path = os.path.join(app.instance_path, 'database.db')
     app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
     
-    # SQLite doesn't use pooling
+    # SQLite keeps its default pool sizing, metered like PostgreSQL
     app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-        'check_same_thread': False,
+        'poolclass': MeteredQueuePool,
+        'connect_args': {'check_same_thread': False},
     }
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here-change-in-production')
 db = SQLAlchemy(app)
 
+# ------------------
+# Shop Time
+# ------------------
+# Timestamps are stored as naive UTC (datetime.utcnow). The days, months and
+# hours the shop talks about are in SHOP_TIMEZONE, so Sale and
+# WholesalerTransaction also store business_date, the shop-local date of
+# `date`, and day/month reports are index lookups on it.
+SHOP_TIMEZONE = os.environ.get('SHOP_TIMEZONE', 'Asia/Karachi')
+shop_tz = ZoneInfo(SHOP_TIMEZONE)
+
+@app.template_filter('shop_time')
+def shop_time(moment):
+    """Naive UTC datetime -> naive shop-local datetime."""
+    if moment is None:
+        return None
+    return moment.replace(tzinfo=timezone.utc).astimezone(shop_tz).replace(tzinfo=None)
+
+def business_date_of(moment):
+    return shop_time(moment).date()
+
+def shop_today():
+    return business_date_of(datetime.utcnow())
+
+def shop_to_utc(local):
+    """Naive shop-local datetime (a date means its midnight) -> naive UTC datetime."""
+    if not isinstance(local, datetime):
+        local = datetime.combine(local, dt_time.min)
+    return local.replace(tzinfo=shop_tz).astimezone(timezone.utc).replace(tzinfo=None)
+
+def shop_day_end_utc(day):
+    """The last UTC instant of a shop-local date."""
+    return shop_to_utc(day + timedelta(days=1)) - timedelta(microseconds=1)
+
+def month_range(day, months=0):
+    """(first day, first day of the next month) for the month `months` after day's."""
+    index = day.year * 12 + day.month - 1 + months
+    first = date(index // 12, index % 12 + 1, 1)
+    return first, date(first.year + first.month // 12, first.month % 12 + 1, 1)
+
+# ------------------
+# Phone Numbers
+# ------------------
+# Phones are kept as typed for display; phone_e164 holds the normalized form
+# under a unique index, so "0300-1234567", "+92 300 1234567" and
+# "03001234567" are one customer and duplicate checks are index lookups.
+PHONE_COUNTRY_CODE = os.environ.get('PHONE_COUNTRY_CODE', '92')
+
+def normalize_phone(phone):
+    """E.164 form ('+923001234567') of a phone as typed, or None if it can't be one."""
+    # Local numbers get PHONE_COUNTRY_CODE; a leading '+' or '00' already has one
+    if not phone:
+        return None
+    digits = ''.join(ch for ch in phone if ch.isdigit())
+    if phone.strip().startswith('+'):
+        pass
+    elif digits.startswith('00'):
+        digits = digits[2:]
+    elif digits.startswith('0'):
+        digits = PHONE_COUNTRY_CODE + digits[1:]
+    elif not digits.startswith(PHONE_COUNTRY_CODE) or len(digits) <= 10:
+        digits = PHONE_COUNTRY_CODE + digits
+    if not 8 <= len(digits) <= 15:
+        return None
+    return '+' + digits
+
 # ------------------
 # Database Models
 # ------------------
@@ -73,8 +294,20 @@ class Customer(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     phone = db.Column(db.String(20))
+    # Normalized phone, set on write; NULL for duplicates awaiting merge_customers.py
+    phone_e164 = db.Column(db.String(16))
+    # Most the customer may owe on credit; NULL means no limit
+    credit_limit = db.Column(db.Float)
+    # Amount owed (open sales less advances), moved by every ledger event's
+    # balance_delta so sales can check the limit without summing history
+    balance = db.Column(db.Float, default=0.0)
 
     sales = db.relationship('Sale', backref='customer', lazy=True)
+    payments = db.relationship('Payment', backref='customer', lazy=True)
+
+    __table_args__ = (
+        db.Index('uq_customer_phone_e164', 'phone_e164', unique=True),
+    )
 
 class Item(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -84,8 +317,22 @@ class Item(db.Model):
     purchase_price = db.Column(db.Float)
     sale_price = db.Column(db.Float)
     stock_quantity = db.Column(db.Float, default=0.0)
+    # Perpetual weighted-average unit cost, updated on every purchase
+    avg_cost = db.Column(db.Float)
+    # Codes typed or scanned at the sales counter; unique when set, SKU upper case
+    sku = db.Column(db.String(50), unique=True, index=True)
+    barcode = db.Column(db.String(64), unique=True, index=True)
 
     sales = db.relationship('Sale', backref='item', lazy=True)
+    purchases = db.relationship('WholesalerTransaction', backref='item', lazy=True)
+    cost_layers = db.relationship('CostLayer', backref='item', lazy=True, cascade='all, delete-orphan')
+    reorder_state = db.relationship('ItemReorderState', uselist=False, lazy=True, cascade='all, delete-orphan')
+    price_history = db.relationship('ItemPrice', lazy=True, cascade='all, delete-orphan')
+
+    __table_args__ = (
+        # Case-insensitive name match used when a purchase names an item
+        db.Index('ix_item_name_lower', db.func.lower(name)),
+    )
     
 class Sale(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -99,19 +346,99 @@ class Sale(db.Model):
 
     paid_amount = db.Column(db.Float, default=0.0)
     date = db.Column(db.DateTime, default=datetime.utcnow)
+    # Shop-local date of `date`, set on every write
+    business_date = db.Column(db.Date, index=True)
+
+    # Cost of goods sold, fixed when the sale is recorded
+    cost_fifo = db.Column(db.Float)
+    cost_avg = db.Column(db.Float)
+
+    # Set on summary rows left by archive_sales.py: how many archived sales
+    # (one customer, item and month) this row stands in for. NULL otherwise.
+    archived_count = db.Column(db.Integer)
+
+    allocations = db.relationship('PaymentAllocation', backref='sale', lazy=True, cascade='all, delete-orphan')
+    cost_consumptions = db.relationship('CostLayerConsumption', backref='sale', lazy=True, cascade='all, delete-orphan')
+
+    is_archived = False
+
+    __table_args__ = (
+        db.Index('ix_sale_date', 'date'),
+        # Covers sold-per-item totals (reconcile_stock.py) without touching the table
+        db.Index('ix_sale_item_quantity', 'item_id', 'quantity'),
+        # Partial index over credit sales that still have a balance, in FIFO order.
+        # Payment allocation walks this instead of the customer's whole history.
+        db.Index(
+            'ix_sale_open_balance', 'customer_id', 'date', 'id',
+            sqlite_where=db.text('paid_amount < total_price'),
+            postgresql_where=db.text('paid_amount < total_price'),
+        ),
+    )
+
+class SaleArchive(db.Model):
+    """A fully paid sale moved out of the sale table by archive_sales.py."""
+    # Keeps its original id; its amounts, allocations and cost consumptions
+    # now belong to the summary Sale row (summary_sale_id) that replaced it
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id', ondelete='SET NULL'), nullable=True)
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=False)
+
+    quantity = db.Column(db.Float, nullable=False)
+    unit_price = db.Column(db.Float, nullable=False)
+    total_price = db.Column(db.Float, nullable=False)
+    paid_amount = db.Column(db.Float, default=0.0)
+    # Part of paid_amount that came from later payments rather than at the counter
+    allocated_amount = db.Column(db.Float, nullable=False, default=0.0)
+    date = db.Column(db.DateTime, nullable=False)
+    business_date = db.Column(db.Date, index=True)
+
+    cost_fifo = db.Column(db.Float)
+    cost_avg = db.Column(db.Float)
+
+    summary_sale_id = db.Column(db.Integer, index=True)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    customer = db.relationship('Customer', viewonly=True)
+    item = db.relationship('Item', viewonly=True)
+
+    is_archived = True
+
+    __table_args__ = (
+        db.Index('ix_sale_archive_date', 'date'),
+        db.Index('ix_sale_archive_customer_date', 'customer_id', 'date'),
+    )
 
 class Wholesaler(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     phone = db.Column(db.String(20))
+    phone_e164 = db.Column(db.String(16))
     address = db.Column(db.String(200))
 
     transactions = db.relationship('WholesalerTransaction', backref='wholesaler', lazy=True, cascade='all, delete-orphan')
+    bills = db.relationship('PurchaseBill', backref='wholesaler', lazy=True, cascade='all, delete-orphan')
+
+    __table_args__ = (
+        db.Index('uq_wholesaler_phone_e164', 'phone_e164', unique=True),
+    )
+
+class PurchaseBill(db.Model):
+    """One supplier delivery; its lines are WholesalerTransactions with this bill_id."""
+    id = db.Column(db.Integer, primary_key=True)
+    wholesaler_id = db.Column(db.Integer, db.ForeignKey('wholesaler.id'), nullable=False, index=True)
+    # The supplier's own bill or invoice number
+    reference = db.Column(db.String(50))
+    date = db.Column(db.DateTime, default=datetime.utcnow)
+    notes = db.Column(db.String(500))
+
+    lines = db.relationship('WholesalerTransaction', backref='bill', lazy=True)
 
 class WholesalerTransaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     wholesaler_id = db.Column(db.Integer, db.ForeignKey('wholesaler.id'), nullable=False)
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=True, index=True)
     
+    # Name as written on the purchase; the link to the Item is item_id
     item_name = db.Column(db.String(100), nullable=False)
     category = db.Column(db.String(50))
     unit = db.Column(db.String(20))
@@ -121,25 +448,415 @@ class WholesalerTransaction(db.Model):
     
     paid_amount = db.Column(db.Float, default=0.0)
     
+    date = db.Column(db.DateTime, default=datetime.utcnow)
+    # Shop-local date of `date`, set on every write
+    business_date = db.Column(db.Date, index=True)
+    notes = db.Column(db.String(500))
+    # Set when the purchase was entered as a line of a multi-line bill
+    bill_id = db.Column(db.Integer, db.ForeignKey('purchase_bill.id'), index=True)
+
+class Payment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False, index=True)
+
+    amount = db.Column(db.Float, nullable=False)
+    # Part of the payment not yet applied to any sale (customer paid in advance)
+    unallocated_amount = db.Column(db.Float, default=0.0)
+
     date = db.Column(db.DateTime, default=datetime.utcnow)
     notes = db.Column(db.String(500))
 
+    allocations = db.relationship('PaymentAllocation', backref='payment', lazy=True, cascade='all, delete-orphan')
+
+class PaymentAllocation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    payment_id = db.Column(db.Integer, db.ForeignKey('payment.id'), nullable=False, index=True)
+    sale_id = db.Column(db.Integer, db.ForeignKey('sale.id'), nullable=False, index=True)
+    amount = db.Column(db.Float, nullable=False)
+
+class CostLayer(db.Model):
+    """A batch of stock bought at one unit cost, consumed oldest first (FIFO)."""
+    id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=False)
+    # NULL for opening stock entered on the Items page, and once the purchase is deleted
+    wholesaler_transaction_id = db.Column(db.Integer, db.ForeignKey('wholesaler_transaction.id'), nullable=True, index=True)
+    # 'opening' (Items page), 'purchase', or 'retained': bought stock kept on
+    # the shelf after its purchase went with a deleted wholesaler
+    source = db.Column(db.String(10))
+
+    quantity = db.Column(db.Float, nullable=False)
+    remaining_quantity = db.Column(db.Float, nullable=False)
+    unit_cost = db.Column(db.Float, nullable=False)
+    date = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Only layers with stock left are ever read when selling
+        db.Index(
+            'ix_cost_layer_open', 'item_id', 'date', 'id',
+            sqlite_where=db.text('remaining_quantity > 0'),
+            postgresql_where=db.text('remaining_quantity > 0'),
+        ),
+    )
+
+class CostLayerConsumption(db.Model):
+    """How much of a layer a sale used, so deleting the sale can put it back."""
+    id = db.Column(db.Integer, primary_key=True)
+    sale_id = db.Column(db.Integer, db.ForeignKey('sale.id'), nullable=False, index=True)
+    cost_layer_id = db.Column(db.Integer, db.ForeignKey('cost_layer.id'), nullable=False, index=True)
+    quantity = db.Column(db.Float, nullable=False)
+
+    cost_layer = db.relationship('CostLayer')
+
+class ItemDailySales(db.Model):
+    """Per-item, per-day sales totals, maintained as sales are written."""
+    id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+
+    quantity = db.Column(db.Float, nullable=False, default=0.0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+    sale_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('item_id', 'day', name='uq_item_daily_sales_item_day'),
+        db.Index('ix_item_daily_sales_day', 'day', 'item_id'),
+    )
+
+class ItemReorderState(db.Model):
+    """Precomputed sales velocity and reorder advice for one item."""
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), primary_key=True)
+
+    # Exponentially weighted sales rate in units/day, as of velocity_at
+    velocity = db.Column(db.Float, nullable=False, default=0.0)
+    velocity_at = db.Column(db.DateTime)
+
+    sold_quantity = db.Column(db.Float, nullable=False, default=0.0)
+    remaining_quantity = db.Column(db.Float, nullable=False, default=0.0)
+    reorder_point = db.Column(db.Float, nullable=False, default=0.0)
+    suggested_quantity = db.Column(db.Float, nullable=False, default=0.0)
+
+    # Where the item was last bought, to reorder from the same place
+    last_wholesaler_id = db.Column(db.Integer, db.ForeignKey('wholesaler.id'), nullable=True)
+    last_purchase_price = db.Column(db.Float)
+
+    needs_reorder = db.Column(db.Boolean, nullable=False, default=False, index=True)
+
+class ItemPrice(db.Model):
+    """An item's purchase and sale price over [valid_from, valid_to); the current row has valid_to NULL."""
+    id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=False)
+    purchase_price = db.Column(db.Float)
+    sale_price = db.Column(db.Float)
+    valid_from = db.Column(db.DateTime, nullable=False)
+    valid_to = db.Column(db.DateTime)
+
+    __table_args__ = (
+        # One seek per item for "as of"; valid_to included so bulk lookups
+        # are answered from the index alone
+        db.Index('ix_item_price_item_from', 'item_id', 'valid_from', 'valid_to'),
+        db.Index(
+            'ix_item_price_current', 'item_id', unique=True,
+            sqlite_where=db.text('valid_to IS NULL'),
+            postgresql_where=db.text('valid_to IS NULL')
+        ),
+    )
+
+class LedgerEvent(db.Model):
+    """Append-only journal of everything that moves stock or money."""
+    id = db.Column(db.Integer, primary_key=True)
+    event_type = db.Column(db.String(40), nullable=False)
+    occurred_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    recorded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    entity_id = db.Column(db.Integer)
+    customer_id = db.Column(db.Integer)
+    item_id = db.Column(db.Integer)
+    wholesaler_id = db.Column(db.Integer)
+
+    balance_delta = db.Column(db.Float, nullable=False, default=0.0)
+    quantity_delta = db.Column(db.Float, nullable=False, default=0.0)
+    payable_delta = db.Column(db.Float, nullable=False, default=0.0)
+
+    data = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_ledger_event_occurred', 'occurred_at', 'id'),
+    )
+
+class LedgerSnapshot(db.Model):
+    """Folded ledger state as of a moment, so replays start close to the target."""
+    id = db.Column(db.Integer, primary_key=True)
+    as_of = db.Column(db.DateTime, nullable=False, index=True)
+    # Highest event id folded in; later ids are replayed even if backdated
+    last_event_id = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # JSON: {"customers": {id: balance}, "items": {id: stock}, "wholesalers": {id: payable}}
+    state = db.Column(db.Text, nullable=False)
+
+class OfflineSale(db.Model):
+    """A sale synced from the offline queue, keyed by the id the client gave it."""
+    client_id = db.Column(db.String(64), primary_key=True)
+    sale_id = db.Column(db.Integer, nullable=False)
+    synced_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+# record_purchase_bill inserts purchases through Core and sets business_date itself
+@event.listens_for(Sale, 'before_insert')
+@event.listens_for(Sale, 'before_update')
+@event.listens_for(WholesalerTransaction, 'before_insert')
+@event.listens_for(WholesalerTransaction, 'before_update')
+def _set_business_date(mapper, connection, target):
+    if target.date is None:
+        target.date = datetime.utcnow()
+    business_date = business_date_of(target.date)
+    if target.business_date != business_date:
+        target.business_date = business_date
+
+@event.listens_for(Customer, 'before_insert')
+@event.listens_for(Customer, 'before_update')
+@event.listens_for(Wholesaler, 'before_insert')
+@event.listens_for(Wholesaler, 'before_update')
+def _set_phone_e164(mapper, connection, target):
+    if db.inspect(target).attrs.phone.history.has_changes():
+        target.phone_e164 = normalize_phone(target.phone)
+
 # ------------------
 # Database Initialization
 # ------------------
 
+def apply_schema_upgrades():
+    """Add columns and indexes that create_all() skips on existing tables, then run backfills."""
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            ddl = f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {column.type.compile(db.engine.dialect)}"
+            for fk in column.foreign_keys:
+                ddl += f" REFERENCES {preparer.quote(fk.column.table.name)}({preparer.quote(fk.column.name)})"
+            with db.engine.begin() as conn:
+                conn.execute(text(ddl))
+            logger.info(f"✓ Added column {table.name}.{column.name}")
+        # IF NOT EXISTS rather than checkfirst: reflection can't see expression indexes
+        with db.engine.begin() as conn:
+            for index in table.indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+
+    backfill_wholesaler_item_links()
+    backfill_phone_numbers()
+    backfill_item_daily_sales(rebuild=backfill_business_dates())
+    backfill_item_prices()
+    backfill_customer_balances()
+    backfill_cost_layer_sources()
+
+def backfill_wholesaler_item_links():
+    """Link purchases recorded before item_id existed to their Item by name, in one UPDATE."""
+    same_name = db.func.lower(Item.name) == db.func.lower(db.func.trim(WholesalerTransaction.item_name))
+    matching_item = db.select(Item.id).where(same_name).order_by(Item.id).limit(1).scalar_subquery()
+
+    with db.engine.begin() as conn:
+        result = conn.execute(
+            db.update(WholesalerTransaction.__table__)
+            .where(WholesalerTransaction.item_id.is_(None), db.select(Item.id).where(same_name).exists())
+            .values(item_id=matching_item)
+        )
+    if result.rowcount:
+        logger.info(f"✓ Linked {result.rowcount} wholesaler transactions to items")
+
+def backfill_phone_numbers():
+    """Set phone_e164 on customers and wholesalers that don't have it yet."""
+    # Later rows with an already taken number stay NULL until merge_customers.py
+    for model in (Customer, Wholesaler):
+        table = model.__table__
+        taken = set(db.session.execute(db.select(table.c.phone_e164).where(table.c.phone_e164.isnot(None))).scalars())
+        updates, duplicates = [], 0
+        for row_id, phone in db.session.execute(
+            db.select(table.c.id, table.c.phone)
+            .where(table.c.phone_e164.is_(None), table.c.phone.isnot(None))
+            .order_by(table.c.id)
+        ):
+            phone_e164 = normalize_phone(phone)
+            if phone_e164 is None:
+                continue
+            if phone_e164 in taken:
+                duplicates += 1
+                continue
+            taken.add(phone_e164)
+            updates.append({'row_id': row_id, 'phone_e164': phone_e164})
+        if updates:
+            db.session.execute(
+                db.update(table).where(table.c.id == db.bindparam('row_id'))
+                .values(phone_e164=db.bindparam('phone_e164')),
+                updates
+            )
+            db.session.commit()
+            logger.info(f"✓ Normalized {len(updates)} {table.name} phone numbers")
+        if duplicates:
+            logger.warning(f"✗ {duplicates} {table.name} rows share a phone number with an older one"
+                           + ("; run merge_customers.py" if model is Customer else ""))
+
+def backfill_business_dates():
+    """Fill business_date on rows written before the column existed; returns rows filled."""
+    filled = 0
+    for model in (Sale, SaleArchive, WholesalerTransaction):
+        table = model.__table__
+        missing = (table.c.business_date.is_(None), table.c.date.isnot(None))
+        if db.engine.dialect.name == 'postgresql':
+            local = db.func.timezone(SHOP_TIMEZONE, db.func.timezone('UTC', table.c.date))
+            with db.engine.begin() as conn:
+                filled += conn.execute(
+                    db.update(table).where(*missing).values(business_date=db.cast(local, db.Date))
+                ).rowcount
+            continue
+        update = db.update(table).where(table.c.id == db.bindparam('row_id')).values(business_date=db.bindparam('day'))
+        while True:
+            with db.engine.begin() as conn:
+                rows = conn.execute(db.select(table.c.id, table.c.date).where(*missing).limit(5000)).all()
+                if not rows:
+                    break
+                conn.execute(update, [{'row_id': row_id, 'day': business_date_of(when)} for row_id, when in rows])
+            filled += len(rows)
+    if filled:
+        logger.info(f"✓ Backfilled business dates on {filled} rows ({SHOP_TIMEZONE})")
+    return filled
+
+def backfill_item_daily_sales(rebuild=False):
+    """Fill ItemDailySales from existing sales when empty, or always with rebuild=True."""
+    if rebuild:
+        db.session.execute(db.delete(ItemDailySales))
+    elif db.session.query(ItemDailySales.id).first() is not None:
+        return
+    if db.session.query(Sale.id).first() is None:
+        db.session.commit()
+        return
+    # Archived sales count on their own days, not their month's summary row
+    sales = db.union_all(
+        db.select(Sale.item_id, Sale.business_date, Sale.quantity, Sale.total_price)
+        .where(Sale.archived_count.is_(None)),
+        db.select(SaleArchive.item_id, SaleArchive.business_date, SaleArchive.quantity, SaleArchive.total_price)
+    ).subquery()
+    db.session.execute(
+        db.insert(ItemDailySales).from_select(
+            ['item_id', 'day', 'quantity', 'revenue', 'sale_count'],
+            db.select(
+                sales.c.item_id, sales.c.business_date, db.func.sum(sales.c.quantity),
+                db.func.sum(sales.c.total_price), db.func.count()
+            ).where(sales.c.business_date.isnot(None))
+            .group_by(sales.c.item_id, sales.c.business_date)
+        )
+    )
+    db.session.commit()
+    logger.info("✓ Backfilled item daily sales")
+
+def backfill_item_prices():
+    """Build price history from linked purchases the first time it is empty."""
+    # Sale prices were never recorded, so every interval carries the current one
+    if db.session.query(ItemPrice.id).first() is not None:
+        return
+    items = db.session.execute(db.select(Item.id, Item.purchase_price, Item.sale_price)).all()
+    if not items:
+        return
+
+    first_sale = dict(db.session.execute(
+        db.select(Sale.item_id, db.func.min(Sale.date)).group_by(Sale.item_id)
+    ).all())
+    purchases = {}
+    for item_id, when, price in db.session.execute(
+        db.select(WholesalerTransaction.item_id, WholesalerTransaction.date, WholesalerTransaction.price_per_unit)
+        .where(WholesalerTransaction.item_id.isnot(None))
+        .order_by(WholesalerTransaction.item_id, WholesalerTransaction.date, WholesalerTransaction.id)
+    ):
+        purchases.setdefault(item_id, []).append((when, price))
+
+    now = datetime.utcnow()
+    rows = []
+    for item in items:
+        intervals = []
+        for when, price in purchases.get(item.id, ()):
+            if not intervals or intervals[-1]['purchase_price'] != price:
+                if intervals:
+                    intervals[-1]['valid_to'] = when
+                intervals.append({'item_id': item.id, 'purchase_price': price, 'sale_price': item.sale_price,
+                                  'valid_from': when, 'valid_to': None})
+        if intervals and first_sale.get(item.id) and first_sale[item.id] < intervals[0]['valid_from']:
+            intervals[0]['valid_from'] = first_sale[item.id]
+        if not intervals or intervals[-1]['purchase_price'] != item.purchase_price:
+            start = first_sale.get(item.id) or now
+            if intervals:
+                intervals[-1]['valid_to'] = start = max(intervals[-1]['valid_from'], now)
+            intervals.append({'item_id': item.id, 'purchase_price': item.purchase_price,
+                              'sale_price': item.sale_price, 'valid_from': start, 'valid_to': None})
+        rows.extend(intervals)
+    db.session.execute(db.insert(ItemPrice), rows)
+    db.session.commit()
+    logger.info(f"✓ Backfilled {len(rows)} price history rows for {len(items)} items")
+
+def backfill_customer_balances():
+    """Set balance on customers from before the column existed, in one UPDATE."""
+    owed = db.select(db.func.sum(Sale.total_price - db.func.coalesce(Sale.paid_amount, 0))).where(
+        Sale.customer_id == Customer.id
+    ).scalar_subquery()
+    advance = db.select(db.func.sum(Payment.unallocated_amount)).where(
+        Payment.customer_id == Customer.id
+    ).scalar_subquery()
+    with db.engine.begin() as conn:
+        result = conn.execute(
+            db.update(Customer.__table__).where(Customer.balance.is_(None))
+            .values(balance=db.func.coalesce(owed, 0) - db.func.coalesce(advance, 0))
+        )
+    if result.rowcount:
+        logger.info(f"✓ Backfilled balances for {result.rowcount} customers")
+
+def backfill_cost_layer_sources():
+    """Set source on cost layers from before the column existed."""
+    # An unlinked, emptied layer whose sales don't account for its quantity was a
+    # deleted purchase; one sold out before deletion can't be told from opening stock
+    consumed = db.select(db.func.coalesce(db.func.sum(CostLayerConsumption.quantity), 0)).where(
+        CostLayerConsumption.cost_layer_id == CostLayer.id
+    ).scalar_subquery()
+    layers = CostLayer.__table__
+    with db.engine.begin() as conn:
+        updated = conn.execute(
+            db.update(layers).where(layers.c.source.is_(None), layers.c.wholesaler_transaction_id.isnot(None))
+            .values(source='purchase')
+        ).rowcount
+        updated += conn.execute(
+            db.update(layers).where(layers.c.source.is_(None))
+            .values(source=db.case(
+                (db.and_(layers.c.remaining_quantity <= 0, consumed < layers.c.quantity - 0.0001), 'purchase'),
+                else_='opening'
+            ))
+        ).rowcount
+    if updated:
+        logger.info(f"✓ Backfilled source on {updated} cost layers")
+
+def upsert(model):
+    """INSERT ... ON CONFLICT builder for the active database (SQLite or PostgreSQL)."""
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    return dialect.insert(model.__table__)
+
 # Create all tables if they don't exist
 def init_db():
     """Initialize database tables on app startup"""
     with app.app_context():
         try:
             # Test database connection first
-            db.session.execute('SELECT 1')
+            db.session.execute(text('SELECT 1'))
             db.session.commit()
             logger.info("✓ Database connection successful")
-            
+
+            if db.engine.dialect.name == 'sqlite':
+                # WAL lets readers, backups included, work alongside the counter's
+                # writes instead of blocking them; the setting sticks to the file
+                with db.engine.connect() as conn:
+                    conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+
             # Create tables
             db.create_all()
+            apply_schema_upgrades()
             logger.info("✓ Database tables initialized successfully")
             
         except Exception as e:
@@ -149,11 +866,2157 @@ def init_db():
             import traceback
             traceback.print_exc()
 
-# Call init_db before handling requests
-try:
-    init_db()
-except Exception as e:
-    logger.error(f"✗ Failed to initialize database on startup: {e}")
+# Call init_db before handling requests
+try:
+    init_db()
+except Exception as e:
+    logger.error(f"✗ Failed to initialize database on startup: {e}")
+
+# ------------------
+# Inventory Costing
+# ------------------
+# Every purchase adds a CostLayer and moves the item's weighted-average cost.
+# Every sale consumes layers oldest first and stores its FIFO and average
+# cost on the Sale row, so profit reports never have to replay history.
+
+def _open_layer_quantity(item_id):
+    """Quantity still held in cost layers for an item (reads open layers only)."""
+    return db.session.query(
+        db.func.coalesce(db.func.sum(CostLayer.remaining_quantity), 0)
+    ).filter(
+        CostLayer.item_id == item_id,
+        CostLayer.remaining_quantity > 0
+    ).scalar() or 0
+
+def _moved_average_cost(avg_cost, on_hand, quantity_delta, value_delta):
+    """Average unit cost after adding (or removing) quantity at a value; None if unchanged."""
+    new_quantity = on_hand + quantity_delta
+    if new_quantity > 0.0001:
+        return max(0.0, (on_hand * avg_cost + value_delta) / new_quantity)
+    if quantity_delta > 0:
+        return value_delta / quantity_delta
+    return None
+
+def _shift_average_cost(item, quantity_delta, value_delta):
+    """Move item.avg_cost by adding (or removing) quantity at a given value."""
+    current_avg = item.avg_cost if item.avg_cost is not None else (item.purchase_price or 0)
+    avg_cost = _moved_average_cost(current_avg, _open_layer_quantity(item.id), quantity_delta, value_delta)
+    if avg_cost is not None:
+        item.avg_cost = avg_cost
+
+def add_cost_layer(item, quantity, unit_cost, transaction=None, when=None):
+    """Record purchased stock as a new cost layer. item must have an id."""
+    if quantity <= 0:
+        return None
+    _shift_average_cost(item, quantity, quantity * unit_cost)
+    layer = CostLayer(
+        item_id=item.id,
+        wholesaler_transaction_id=transaction.id if transaction else None,
+        source='purchase' if transaction else 'opening',
+        quantity=quantity,
+        remaining_quantity=quantity,
+        unit_cost=unit_cost,
+        date=when or datetime.utcnow()
+    )
+    db.session.add(layer)
+    return layer
+
+def update_purchase_cost_layer(transaction, item, quantity, unit_cost):
+    """Apply an edited purchase to its cost layer (creating one if missing)."""
+    layer = CostLayer.query.filter_by(wholesaler_transaction_id=transaction.id).first()
+    if layer is None:
+        return add_cost_layer(item, quantity, unit_cost, transaction, transaction.date)
+
+    old_item = db.session.get(Item, layer.item_id)
+    if old_item is not None and layer.remaining_quantity > 0:
+        _shift_average_cost(old_item, -layer.remaining_quantity, -layer.remaining_quantity * layer.unit_cost)
+
+    consumed = layer.quantity - layer.remaining_quantity
+    if consumed > 0 and layer.item_id != item.id:
+        # The old item's sales used part of this layer and may give it back; that
+        # part stays with them as a closed layer and the new item gets a fresh one
+        layer.quantity = consumed
+        layer.remaining_quantity = 0.0
+        layer.wholesaler_transaction_id = None
+        db.session.flush()
+        return add_cost_layer(item, quantity, unit_cost, transaction, transaction.date)
+
+    layer.item_id = item.id
+    layer.quantity = quantity
+    layer.remaining_quantity = max(0.0, quantity - consumed)
+    layer.unit_cost = unit_cost
+    db.session.flush()
+
+    if layer.remaining_quantity > 0:
+        # The layer's own remainder is already counted in on-hand after the flush
+        on_hand = _open_layer_quantity(item.id) - layer.remaining_quantity
+        current_avg = item.avg_cost if item.avg_cost is not None else (item.purchase_price or 0)
+        item.avg_cost = (on_hand * current_avg + layer.remaining_quantity * unit_cost) / (on_hand + layer.remaining_quantity)
+    return layer
+
+def remove_purchase_cost_layer(transaction):
+    """Drop the unsold part of a deleted purchase from stock valuation."""
+    layer = CostLayer.query.filter_by(wholesaler_transaction_id=transaction.id).first()
+    if layer is None:
+        return
+    item = db.session.get(Item, layer.item_id)
+    if item is not None and layer.remaining_quantity > 0:
+        _shift_average_cost(item, -layer.remaining_quantity, -layer.remaining_quantity * layer.unit_cost)
+    # Keep the layer so sales that used it still point somewhere
+    layer.remaining_quantity = 0.0
+    layer.wholesaler_transaction_id = None
+
+def consume_cost_layers(sale, item):
+    """Take the sale's quantity from the item's oldest layers and cost the sale."""
+    fallback_cost = item.avg_cost if item.avg_cost is not None else (item.purchase_price or 0)
+    needed = sale.quantity
+    fifo_cost = 0.0
+
+    open_layers = CostLayer.query.filter(
+        CostLayer.item_id == item.id,
+        CostLayer.remaining_quantity > 0
+    ).order_by(CostLayer.date, CostLayer.id).with_for_update().yield_per(50)
+    for layer in open_layers:
+        if needed <= 0.0001:
+            break
+        used = min(needed, layer.remaining_quantity)
+        layer.remaining_quantity -= used
+        needed -= used
+        fifo_cost += used * layer.unit_cost
+        sale.cost_consumptions.append(CostLayerConsumption(cost_layer=layer, quantity=used))
+
+    if needed > 0.0001:
+        fifo_cost += needed * fallback_cost
+
+    sale.cost_fifo = round(fifo_cost, 2)
+    sale.cost_avg = round(sale.quantity * fallback_cost, 2)
+
+def restore_cost_layers(sale):
+    """Give a deleted sale's quantity back to the layers it was taken from."""
+    for consumption in sale.cost_consumptions:
+        layer = consumption.cost_layer
+        _shift_average_cost(layer.item, consumption.quantity, consumption.quantity * layer.unit_cost)
+        layer.remaining_quantity += consumption.quantity
+
+# ------------------
+# Dashboard Metrics
+# ------------------
+class DashboardMetrics:
+    """In-memory dashboard counters, seeded from one query and kept current by each commit."""
+
+    TOP_ITEMS = 5
+
+    def __init__(self, reseed_seconds):
+        self.reseed_seconds = reseed_seconds
+        self._lock = threading.Lock()
+        self._seeded_at = None
+        self.customer_count = 0
+        self.item_count = 0
+        self.outstanding = 0.0
+        self.item_names = {}
+        self._reset_day(shop_today())
+
+    def _reset_day(self, day):
+        self.day = day
+        self.revenue = 0.0
+        self.cash = 0.0
+        self.credit = 0.0
+        self.sale_count = 0
+        self.per_hour = [0.0] * 24
+        self.item_totals = {}  # item_id -> [revenue, quantity]
+
+    def invalidate(self):
+        """Drop the counters; the next read reseeds them from the database."""
+        with self._lock:
+            self._seeded_at = None
+
+    def _is_stale(self):
+        return (
+            self._seeded_at is None
+            or self.day != shop_today()
+            or time.monotonic() - self._seeded_at > self.reseed_seconds
+        )
+
+    def seed(self):
+        """Rebuild all counters. Needs an app context."""
+        today = shop_today()
+        is_today = Sale.business_date == today
+        # Shop-local hour from the stored UTC time: shift minute-of-day by
+        # today's UTC offset (+1440 keeps west-of-UTC offsets non-negative)
+        offset = int(datetime.now(shop_tz).utcoffset().total_seconds() // 60)
+        minute = db.cast(extract('hour', Sale.date), db.Integer) * 60 + db.cast(extract('minute', Sale.date), db.Integer)
+        hour = db.case((is_today, (minute + offset + 1440) // 60 % 24), else_=-1)
+        is_cash = Sale.customer_id.is_(None)
+
+        # Today's sales and every open credit balance, in one grouped pass.
+        # Both halves are index-backed (ix_sale_business_date, ix_sale_open_balance).
+        rows = db.session.query(
+            Sale.item_id,
+            Item.name,
+            hour,
+            is_cash,
+            db.func.count(db.case((is_today, Sale.id))),
+            db.func.sum(db.case((is_today, Sale.total_price), else_=0)),
+            db.func.sum(db.case((is_today, Sale.quantity), else_=0)),
+            db.func.sum(db.case((is_cash, 0), else_=Sale.total_price - db.func.coalesce(Sale.paid_amount, 0)))
+        ).join(Item, Sale.item_id == Item.id).filter(
+            db.or_(is_today, Sale.paid_amount < Sale.total_price)
+        ).group_by(Sale.item_id, Item.name, hour, is_cash).all()
+
+        counts = db.session.query(
+            db.select(db.func.count(Customer.id)).scalar_subquery(),
+            db.select(db.func.count(Item.id)).scalar_subquery()
+        ).one()
+        # Advances are owed back to customers, so they come off the total
+        advances = db.session.execute(db.select(db.func.sum(Payment.unallocated_amount))).scalar() or 0
+
+        with self._lock:
+            self._reset_day(today)
+            self.outstanding = -advances
+            self.item_names = {}
+            self.customer_count, self.item_count = counts
+            for item_id, item_name, sale_hour, cash, count, revenue, quantity, outstanding in rows:
+                self.item_names[item_id] = item_name
+                self.outstanding += outstanding or 0
+                if sale_hour is None or sale_hour < 0:
+                    continue
+                self.sale_count += count
+                self.revenue += revenue or 0
+                if cash:
+                    self.cash += revenue or 0
+                else:
+                    self.credit += revenue or 0
+                self.per_hour[int(sale_hour)] += revenue or 0
+                totals = self.item_totals.setdefault(item_id, [0.0, 0.0])
+                totals[0] += revenue or 0
+                totals[1] += quantity or 0
+            self._seeded_at = time.monotonic()
+
+    def apply(self, changes):
+        """Fold committed (model, sign, values) changes into the counters."""
+        if not changes:
+            return
+        with self._lock:
+            if self._is_stale():
+                # Next read reseeds and will include these rows
+                return
+            for model, sign, values in changes:
+                if model == 'customer':
+                    self.customer_count += sign
+                elif model == 'item':
+                    self.item_count += sign
+                elif model == 'payment':
+                    self.outstanding -= values
+                elif model == 'sale':
+                    self._apply_sale(sign, *values)
+
+    def _apply_sale(self, sign, item_id, customer_id, sale_date, total_price, paid_amount, quantity):
+        if customer_id is not None:
+            self.outstanding += sign * (total_price - paid_amount)
+        if sale_date is None or business_date_of(sale_date) != self.day:
+            return
+        self.sale_count += sign
+        self.revenue += sign * total_price
+        if customer_id is None:
+            self.cash += sign * total_price
+        else:
+            self.credit += sign * total_price
+        self.per_hour[shop_time(sale_date).hour] += sign * total_price
+        totals = self.item_totals.setdefault(item_id, [0.0, 0.0])
+        totals[0] += sign * total_price
+        totals[1] += sign * quantity
+
+    def snapshot(self):
+        """Current figures as a plain dict. Needs an app context."""
+        if self._is_stale():
+            self.seed()
+        with self._lock:
+            top = sorted(
+                ((item_id, totals) for item_id, totals in self.item_totals.items() if totals[0] > 0),
+                key=lambda entry: entry[1][0],
+                reverse=True
+            )[:self.TOP_ITEMS]
+            snapshot = {
+                'total_customers': self.customer_count,
+                'total_items': self.item_count,
+                'sale_count': self.sale_count,
+                'revenue': self.revenue,
+                'cash': self.cash,
+                'credit': self.credit,
+                'outstanding': self.outstanding,
+                'per_hour': list(self.per_hour),
+                'top_items': [
+                    {'item_id': item_id, 'revenue': totals[0], 'quantity': totals[1]}
+                    for item_id, totals in top
+                ],
+            }
+            missing = [row['item_id'] for row in snapshot['top_items'] if row['item_id'] not in self.item_names]
+
+        if missing:
+            names = dict(db.session.query(Item.id, Item.name).filter(Item.id.in_(missing)).all())
+            with self._lock:
+                self.item_names.update(names)
+        for row in snapshot['top_items']:
+            row['name'] = self.item_names.get(row['item_id'], 'Unknown item')
+        return snapshot
+
+dashboard_metrics = DashboardMetrics(int(os.environ.get('METRICS_RESEED_SECONDS', 300)))
+
+# Seed at startup so the first dashboard view is already warm
+try:
+    with app.app_context():
+        dashboard_metrics.seed()
+except Exception as e:
+    logger.error(f"✗ Failed to seed dashboard metrics: {e}")
+
+# record_purchase_bill queues its own ('item', 1) changes for items it creates; keep them in step
+@event.listens_for(db.session, 'after_flush')
+def _collect_metric_changes(session, flush_context):
+    changes = session.info.setdefault('metric_changes', [])
+    for sign, objects in ((1, session.new), (-1, session.deleted)):
+        for obj in objects:
+            if isinstance(obj, Sale):
+                changes.append(('sale', sign, (
+                    obj.item_id, obj.customer_id, obj.date,
+                    obj.total_price, obj.paid_amount or 0, obj.quantity
+                )))
+            elif isinstance(obj, Customer):
+                changes.append(('customer', sign, None))
+            elif isinstance(obj, Item):
+                changes.append(('item', sign, None))
+
+@event.listens_for(db.session, 'after_flush')
+def _record_item_daily_sales(session, flush_context):
+    """Keep ItemDailySales in step with Sale rows, inside the same transaction."""
+    deltas = {}
+    for sign, objects in ((1, session.new), (-1, session.deleted)):
+        for obj in objects:
+            if not isinstance(obj, Sale) or obj.date is None:
+                continue
+            key = (obj.item_id, obj.business_date or business_date_of(obj.date))
+            delta = deltas.setdefault(key, [0.0, 0.0, 0])
+            delta[0] += sign * obj.quantity
+            delta[1] += sign * obj.total_price
+            delta[2] += sign
+    if not deltas:
+        return
+
+    stmt = upsert(ItemDailySales)
+    table = ItemDailySales.__table__
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['item_id', 'day'],
+        set_={
+            'quantity': table.c.quantity + stmt.excluded.quantity,
+            'revenue': table.c.revenue + stmt.excluded.revenue,
+            'sale_count': table.c.sale_count + stmt.excluded.sale_count,
+        }
+    )
+    session.connection().execute(stmt, [
+        {'item_id': item_id, 'day': day, 'quantity': q, 'revenue': r, 'sale_count': n}
+        for (item_id, day), (q, r, n) in deltas.items()
+    ])
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_metric_changes(session):
+    dashboard_metrics.apply(session.info.pop('metric_changes', None))
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_metric_changes(session, previous_transaction):
+    session.info.pop('metric_changes', None)
+
+# ------------------
+# Reorder Alerts
+# ------------------
+# Sales velocity is an exponentially weighted rate (units/day) with time
+# constant REORDER_VELOCITY_DAYS, updated from each sale as it is flushed:
+#   velocity = velocity * exp(-elapsed_days / tau) + quantity / tau
+# The reorder point covers lead time plus safety stock at that velocity, and
+# the suggestion tops stock up to REORDER_COVER_DAYS beyond the reorder point.
+REORDER_VELOCITY_DAYS = float(os.environ.get('REORDER_VELOCITY_DAYS', 14))
+REORDER_LEAD_DAYS = float(os.environ.get('REORDER_LEAD_DAYS', 3))
+REORDER_SAFETY_DAYS = float(os.environ.get('REORDER_SAFETY_DAYS', 2))
+REORDER_COVER_DAYS = float(os.environ.get('REORDER_COVER_DAYS', 14))
+
+def _decayed_velocity(velocity, velocity_at, now):
+    if not velocity or velocity_at is None:
+        return 0.0
+    elapsed = max(0.0, (now - velocity_at).total_seconds() / 86400)
+    return velocity * math.exp(-elapsed / REORDER_VELOCITY_DAYS)
+
+def _reorder_advice(velocity, remaining, sold_quantity):
+    """(reorder_point, suggested_quantity, needs_reorder) for a velocity and stock level."""
+    reorder_point = velocity * (REORDER_LEAD_DAYS + REORDER_SAFETY_DAYS)
+    needs_reorder = sold_quantity > 0 and (remaining <= 0 or (velocity > 0 and remaining <= reorder_point))
+    suggested = 0.0
+    if needs_reorder:
+        suggested = float(math.ceil(max(0.0, reorder_point + velocity * REORDER_COVER_DAYS - remaining)))
+    return round(reorder_point, 2), suggested, needs_reorder
+
+def refresh_reorder_states(conn, item_ids, sold=None):
+    """Recompute reorder state for the given items on a Core connection."""
+    sold = sold or {}
+    item_ids = [item_id for item_id in item_ids if item_id is not None]
+    if not item_ids:
+        return
+    state_table = ItemReorderState.__table__
+
+    stock = dict(conn.execute(
+        db.select(Item.id, Item.stock_quantity).where(Item.id.in_(item_ids))
+    ).all())
+    states = {
+        row.item_id: row for row in conn.execute(
+            db.select(state_table).where(state_table.c.item_id.in_(item_ids))
+        )
+    }
+    wt = WholesalerTransaction.__table__.alias('wt')
+    latest_purchase_id = db.select(WholesalerTransaction.id).where(
+        WholesalerTransaction.item_id == wt.c.item_id
+    ).order_by(WholesalerTransaction.date.desc(), WholesalerTransaction.id.desc()).limit(1).scalar_subquery()
+    last_purchases = {
+        row.item_id: row for row in conn.execute(
+            db.select(wt.c.item_id, wt.c.wholesaler_id, wt.c.price_per_unit)
+            .where(wt.c.item_id.in_(item_ids), wt.c.id == latest_purchase_id)
+        )
+    }
+
+    now = datetime.utcnow()
+    rows = []
+    for item_id in item_ids:
+        if item_id not in stock:
+            continue
+        state = states.get(item_id)
+        velocity = state.velocity if state else 0.0
+        velocity_at = state.velocity_at if state else None
+        sold_quantity = state.sold_quantity if state else 0.0
+
+        for quantity, when in sorted(sold.get(item_id, []), key=lambda entry: entry[1] or now):
+            sold_quantity += quantity
+            if quantity <= 0:
+                continue
+            when = when or now
+            if velocity_at is not None and when > velocity_at:
+                velocity = _decayed_velocity(velocity, velocity_at, when)
+            if velocity_at is None or when > velocity_at:
+                velocity_at = when
+            velocity += quantity / REORDER_VELOCITY_DAYS
+
+        remaining = (stock[item_id] or 0) - sold_quantity
+        current_velocity = _decayed_velocity(velocity, velocity_at, now)
+        reorder_point, suggested, needs_reorder = _reorder_advice(current_velocity, remaining, sold_quantity)
+        purchase = last_purchases.get(item_id)
+        rows.append({
+            'item_id': item_id,
+            'velocity': velocity,
+            'velocity_at': velocity_at,
+            'sold_quantity': sold_quantity,
+            'remaining_quantity': remaining,
+            'reorder_point': reorder_point,
+            'suggested_quantity': suggested,
+            'last_wholesaler_id': purchase.wholesaler_id if purchase else None,
+            'last_purchase_price': purchase.price_per_unit if purchase else None,
+            'needs_reorder': needs_reorder,
+        })
+
+    if rows:
+        stmt = upsert(ItemReorderState)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['item_id'],
+            set_={column: stmt.excluded[column] for column in rows[0] if column != 'item_id'}
+        )
+        conn.execute(stmt, rows)
+
+# record_purchase_bill bypasses this and calls refresh_reorder_states for its items
+@event.listens_for(db.session, 'after_flush')
+def _update_reorder_states(session, flush_context):
+    sold = {}
+    touched = set()
+    for sign, objects in ((1, session.new), (-1, session.deleted)):
+        for obj in objects:
+            if isinstance(obj, Sale):
+                sold.setdefault(obj.item_id, []).append((sign * obj.quantity, obj.date))
+            elif isinstance(obj, WholesalerTransaction):
+                touched.add(obj.item_id)
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Item):
+            touched.add(obj.id)
+        elif isinstance(obj, WholesalerTransaction):
+            touched.add(obj.item_id)
+            # A purchase moved to another item also changes the old one
+            history = db.inspect(obj).attrs.item_id.history
+            touched.update(history.deleted or ())
+    deleted_items = {obj.id for obj in session.deleted if isinstance(obj, Item)}
+    item_ids = (touched | set(sold)) - deleted_items
+    if item_ids:
+        refresh_reorder_states(session.connection(), sorted(item_ids), sold)
+
+def seed_reorder_states():
+    """Build reorder state for items that have none yet, from daily sales facts."""
+    missing = [
+        item_id for (item_id,) in db.session.query(Item.id).outerjoin(
+            ItemReorderState, ItemReorderState.item_id == Item.id
+        ).filter(ItemReorderState.item_id.is_(None))
+    ]
+    if not missing:
+        return
+    for start in range(0, len(missing), 500):
+        chunk = missing[start:start + 500]
+        sold = {}
+        for item_id, day, quantity in db.session.query(
+            ItemDailySales.item_id, ItemDailySales.day, ItemDailySales.quantity
+        ).filter(ItemDailySales.item_id.in_(chunk)):
+            sold.setdefault(item_id, []).append((quantity, datetime.combine(day, dt_time(12))))
+        refresh_reorder_states(db.session.connection(), chunk, sold)
+    db.session.commit()
+    logger.info(f"✓ Seeded reorder state for {len(missing)} items")
+
+try:
+    with app.app_context():
+        seed_reorder_states()
+except Exception as e:
+    logger.error(f"✗ Failed to seed reorder state: {e}")
+
+def current_stock_alerts():
+    """Items that need reordering, from the precomputed state."""
+    now = datetime.utcnow()
+    alerts = []
+    rows = db.session.query(ItemReorderState, Item.name, Item.unit, Wholesaler).join(
+        Item, ItemReorderState.item_id == Item.id
+    ).outerjoin(
+        Wholesaler, ItemReorderState.last_wholesaler_id == Wholesaler.id
+    ).filter(ItemReorderState.needs_reorder.is_(True)).all()
+    for state, name, unit, wholesaler in rows:
+        velocity = _decayed_velocity(state.velocity, state.velocity_at, now)
+        reorder_point, suggested, needs_reorder = _reorder_advice(velocity, state.remaining_quantity, state.sold_quantity)
+        if not needs_reorder:
+            continue
+        alerts.append({
+            'item_id': state.item_id,
+            'name': name,
+            'unit': unit,
+            'remaining': state.remaining_quantity,
+            'daily_velocity': round(velocity, 3),
+            'days_left': round(state.remaining_quantity / velocity, 1) if velocity > 0 else None,
+            'reorder_point': reorder_point,
+            'suggested_quantity': suggested,
+            'wholesaler': {
+                'id': wholesaler.id,
+                'name': wholesaler.name,
+                'phone': wholesaler.phone
+            } if wholesaler else None,
+            'last_purchase_price': state.last_purchase_price,
+            'estimated_cost': round(suggested * state.last_purchase_price, 2) if state.last_purchase_price else None,
+        })
+    alerts.sort(key=lambda alert: alert['days_left'] if alert['days_left'] is not None else -1)
+    return alerts
+
+# ------------------
+# Offline Bootstrap
+# ------------------
+class BootstrapSnapshot:
+    """Cached, gzip-compressed snapshot of everything the PWA needs offline."""
+
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._stale = True
+        self._built_at = None
+        self.version = None
+        self.body = None
+
+    def invalidate(self):
+        self._stale = True
+
+    def get(self):
+        """(version, gzip bytes). Needs an app context."""
+        with self._lock:
+            expired = self._built_at is None or time.monotonic() - self._built_at > self.ttl_seconds
+            if self._stale or expired:
+                self._build()
+            return self.version, self.body
+
+    def _build(self):
+        # Cleared first so a commit during the build marks it stale again
+        self._stale = False
+        payload = {
+            'customers': [
+                {'id': row.id, 'name': row.name, 'phone': row.phone}
+                for row in db.session.execute(db.select(Customer.id, Customer.name, Customer.phone))
+            ],
+            'items': [
+                {
+                    'id': row.id, 'name': row.name, 'category': row.category, 'unit': row.unit,
+                    'purchase_price': row.purchase_price, 'sale_price': row.sale_price,
+                    'stock_quantity': row.stock_quantity, 'sku': row.sku, 'barcode': row.barcode
+                }
+                for row in db.session.execute(db.select(
+                    Item.id, Item.name, Item.category, Item.unit,
+                    Item.purchase_price, Item.sale_price, Item.stock_quantity, Item.sku, Item.barcode
+                ))
+            ],
+            'wholesalers': [
+                {'id': row.id, 'name': row.name, 'phone': row.phone, 'address': row.address}
+                for row in db.session.execute(db.select(
+                    Wholesaler.id, Wholesaler.name, Wholesaler.phone, Wholesaler.address
+                ))
+            ],
+            # The maintained balance: open sales less any advance, as on the server
+            'balances': [
+                {'customer_id': customer_id, 'balance': round(balance, 2)}
+                for customer_id, balance in db.session.execute(
+                    db.select(Customer.id, Customer.balance).where(Customer.balance != 0)
+                )
+            ],
+        }
+        encoded = json.dumps(payload, separators=(',', ':'), sort_keys=True).encode('utf-8')
+        self.version = hashlib.sha1(encoded).hexdigest()[:16]
+        snapshot = b'{"version":"%s","generated_at":"%s",%s' % (
+            self.version.encode('ascii'),
+            datetime.utcnow().isoformat(timespec='seconds').encode('ascii'),
+            encoded[1:]
+        )
+        self.body = gzip.compress(snapshot, compresslevel=6)
+        self._built_at = time.monotonic()
+
+bootstrap_snapshot = BootstrapSnapshot(int(os.environ.get('BOOTSTRAP_TTL_SECONDS', 60)))
+
+# record_purchase_bill sets bootstrap_stale itself; update it if this check changes
+@event.listens_for(db.session, 'after_flush')
+def _mark_bootstrap_stale(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, (Customer, Item, Wholesaler, Sale, Payment)):
+            session.info['bootstrap_stale'] = True
+            return
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_bootstrap(session):
+    if session.info.pop('bootstrap_stale', False):
+        bootstrap_snapshot.invalidate()
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_bootstrap_stale(session, previous_transaction):
+    session.info.pop('bootstrap_stale', None)
+
+# ------------------
+# Search Coalescing
+# ------------------
+SEARCH_RESULT_LIMIT = 10
+# Rows fetched per query; fewer than this means the result set is complete
+SEARCH_CACHE_ROWS = int(os.environ.get('SEARCH_CACHE_ROWS', 50))
+SEARCH_RATE_PER_SECOND = float(os.environ.get('SEARCH_RATE_PER_SECOND', 10))
+SEARCH_RATE_BURST = int(os.environ.get('SEARCH_RATE_BURST', 20))
+
+def search_matches(query, name, phone):
+    """Python twin of the search WHERE clause, used to refine cached results."""
+    return query.lower() in (name or '').lower() or query in (phone or '')
+
+class _SearchFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.rows = None
+        self.error = None
+
+class SearchCoalescer:
+    """Single-flight, short-TTL prefix cache for the autocomplete endpoints."""
+
+    def __init__(self, ttl_seconds, max_entries=2000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._inflight = {}
+        self._generation = 0
+
+    def invalidate(self, kind=None):
+        with self._lock:
+            self._generation += 1
+            if kind is None:
+                self._entries.clear()
+            else:
+                self._entries = {key: entry for key, entry in self._entries.items() if key[0] != kind}
+
+    def _cached(self, kind, query, now):
+        # Longest cached prefix first; LIKE wildcards can't be refined in Python
+        refinable = '%' not in query and '_' not in query
+        for length in range(len(query), 0, -1):
+            entry = self._entries.get((kind, query[:length]))
+            if entry is None or entry[0] < now:
+                continue
+            expires, rows, complete = entry
+            if length == len(query):
+                return rows
+            if complete and refinable:
+                return [row for row in rows if search_matches(query, row['name'], row['phone'])]
+        return None
+
+    def search(self, kind, query, fetch):
+        """Rows matching query; fetch(limit) runs the real query when needed."""
+        key = (kind, query)
+        with self._lock:
+            now = time.monotonic()
+            rows = self._cached(kind, query, now)
+            if rows is not None:
+                return rows[:SEARCH_RESULT_LIMIT]
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _SearchFlight()
+                generation = self._generation
+
+        if not leader:
+            flight.done.wait(timeout=10)
+            if flight.rows is None:
+                raise flight.error or TimeoutError(f"search for {query!r} timed out")
+            return flight.rows[:SEARCH_RESULT_LIMIT]
+
+        try:
+            flight.rows = fetch(SEARCH_CACHE_ROWS)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+                # A write committed mid-query may not be in these rows
+                if flight.rows is not None and generation == self._generation:
+                    if len(self._entries) >= self.max_entries:
+                        now = time.monotonic()
+                        self._entries = {k: v for k, v in self._entries.items() if v[0] >= now}
+                        if len(self._entries) >= self.max_entries:
+                            self._entries.clear()
+                    self._entries[key] = (
+                        time.monotonic() + self.ttl_seconds,
+                        flight.rows,
+                        len(flight.rows) < SEARCH_CACHE_ROWS
+                    )
+            flight.done.set()
+        return flight.rows[:SEARCH_RESULT_LIMIT]
+
+class RateLimiter:
+    """Per-client token bucket. allow() answers immediately, it never queues."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._pruned_at = time.monotonic()
+
+    def allow(self, client):
+        """(allowed, seconds until the next token)."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._pruned_at > 60:
+                # A bucket idle long enough to refill is the same as no bucket
+                full_after = self.burst / self.rate
+                self._buckets = {c: b for c, b in self._buckets.items() if now - b[1] < full_after}
+                self._pruned_at = now
+            tokens, updated = self._buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[client] = (tokens, now)
+                return False, (1 - tokens) / self.rate
+            self._buckets[client] = (tokens - 1, now)
+            return True, 0.0
+
+search_coalescer = SearchCoalescer(float(os.environ.get('SEARCH_CACHE_TTL_SECONDS', 5)))
+search_rate_limiter = RateLimiter(SEARCH_RATE_PER_SECOND, SEARCH_RATE_BURST)
+
+def rate_limited_response():
+    """429 response if this client is over its search budget, else None."""
+    # First X-Forwarded-For hop when behind the platform proxy
+    client = request.access_route[0] if request.access_route else request.remote_addr
+    allowed, retry_after = search_rate_limiter.allow(client)
+    if allowed:
+        return None
+    response = jsonify({'error': 'Too many requests'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+@event.listens_for(db.session, 'after_flush')
+def _mark_search_stale(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, Customer):
+            session.info.setdefault('search_stale', set()).add('customers')
+        elif isinstance(obj, Wholesaler):
+            session.info.setdefault('search_stale', set()).add('wholesalers')
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_search_cache(session):
+    for kind in session.info.pop('search_stale', ()):
+        search_coalescer.invalidate(kind)
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_search_stale(session, previous_transaction):
+    session.info.pop('search_stale', None)
+
+# ------------------
+# Shared Catalog
+# ------------------
+# Host-local directory for the catalog files; /dev/shm keeps them in RAM
+CATALOG_DIR = os.environ.get('CATALOG_DIR') or ('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+CATALOG_MAGIC = b'KCAT'
+
+class _Strings:
+    """A string column of the catalog file: offsets into a UTF-8 blob, read in place."""
+
+    def __init__(self, source, start, blob, offsets):
+        self.source = source
+        self.start = start
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, index):
+        return self.blob[self.offsets[index]:self.offsets[index + 1]]
+
+    def __getitem__(self, index):
+        return str(self.raw(index), 'utf-8') or None
+
+    def find(self, needle, position):
+        """Offset of needle in the blob at or after position, or -1; searched in the map itself."""
+        found = self.source.find(needle, self.start + position, self.start + len(self.blob))
+        return found - self.start if found >= 0 else -1
+
+def _aligned(position):
+    return position + (-position % 8)
+
+def _string_column(values):
+    blob, offsets = bytearray(), array('I', [0])
+    for value in values:
+        blob += (value or '').encode('utf-8')
+        offsets.append(len(blob))
+    return bytes(blob), offsets
+
+class _CatalogFile:
+    """One built catalog, memory-mapped read-only. Columns are views into the map."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        magic, size = struct.unpack_from('<4sI', view, 0)
+        if magic != CATALOG_MAGIC:
+            raise ValueError(f"{path} is not a catalog file")
+        header = json.loads(bytes(view[8:8 + size]))
+        self.version = header['version']
+        self.built_at = header['built_at']
+        start = _aligned(8 + size)
+        columns = {
+            name: (start + offset, view[start + offset:start + offset + length].cast(typecode))
+            for name, (typecode, offset, length) in header['columns'].items()
+        }
+        self.columns = {
+            name: _Strings(self._map, offset, column, columns[name + '.offsets'][1])
+            if name + '.offsets' in columns else column
+            for name, (offset, column) in columns.items() if not name.endswith('.offsets')
+        }
+
+    @staticmethod
+    def write(path, version, columns):
+        """Write columns (name -> array or bytes) atomically; blobs carry name.offsets."""
+        layout, position = {}, 0
+        for name, values in columns.items():
+            data = values.tobytes() if isinstance(values, array) else values
+            layout[name] = (values.typecode if isinstance(values, array) else 'B', position, data)
+            # Every column starts 8-byte aligned for the casts
+            position = _aligned(position + len(data))
+        header = json.dumps({
+            'version': version,
+            'built_at': time.time(),
+            'columns': {name: [typecode, offset, len(data)] for name, (typecode, offset, data) in layout.items()},
+        }).encode('utf-8')
+        start = _aligned(8 + len(header))
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as f:
+            f.write(struct.pack('<4sI', CATALOG_MAGIC, len(header)))
+            f.write(header)
+            for typecode, offset, data in layout.values():
+                f.seek(start + offset)
+                f.write(data)
+            f.truncate(start + position)
+        os.replace(temporary, path)
+
+class SharedCatalog:
+    """Items and customers for the counter and autocomplete, shared by every worker on a host."""
+
+    def __init__(self, ttl_seconds, directory=CATALOG_DIR):
+        self.ttl_seconds = ttl_seconds
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._file = None
+        self._counter = None
+
+    @property
+    def _base(self):
+        uri = app.config['SQLALCHEMY_DATABASE_URI'].encode('utf-8')
+        return os.path.join(self.directory, f"khata-catalog-{hashlib.sha1(uri).hexdigest()[:12]}")
+
+    def _counter_map(self):
+        if self._counter is None:
+            os.makedirs(self.directory, exist_ok=True)
+            fd = os.open(self._base + '.version', os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if os.fstat(fd).st_size < 8:
+                    os.ftruncate(fd, 8)
+                self._counter = mmap.mmap(fd, 8)
+            finally:
+                os.close(fd)
+        return self._counter
+
+    def version(self):
+        return struct.unpack_from('<Q', self._counter_map(), 0)[0]
+
+    def invalidate(self):
+        """Mark the catalog stale for every worker on this host."""
+        counter = self._counter_map()
+        with open(self._base + '.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            struct.pack_into('<Q', counter, 0, struct.unpack_from('<Q', counter, 0)[0] + 1)
+
+    def _fresh(self, catalog, version):
+        return (catalog is not None and catalog.version == version
+                and time.time() - catalog.built_at <= self.ttl_seconds)
+
+    def _open_built(self):
+        try:
+            return _CatalogFile(self._base + '.data')
+        except (OSError, ValueError):
+            return None
+
+    def _current(self):
+        version = self.version()
+        catalog = self._file
+        if self._fresh(catalog, version):
+            return catalog
+        with self._lock:
+            catalog = self._file
+            if self._fresh(catalog, version):
+                return catalog
+            catalog = self._open_built()
+            if not self._fresh(catalog, version):
+                with open(self._base + '.lock', 'a') as lock:
+                    if fcntl is not None:
+                        fcntl.flock(lock, fcntl.LOCK_EX)
+                    # Another worker may have built it while we waited
+                    catalog = self._open_built()
+                    if not self._fresh(catalog, version):
+                        self._build(version)
+                        catalog = self._open_built()
+            # The old map stays valid for readers still holding it
+            self._file = catalog
+            return catalog
+
+    def _build(self, version):
+        # Own connection: the file is shared, so it must never see a request's uncommitted rows
+        with db.engine.connect() as conn:
+            items = conn.execute(db.select(
+                Item.id, Item.name, Item.category, Item.unit, Item.sale_price, Item.stock_quantity, Item.sku, Item.barcode
+            ).order_by(Item.name, Item.id)).mappings().all()
+            customers = conn.execute(
+                db.select(Customer.id, Customer.name, Customer.phone).order_by(Customer.id)
+            ).mappings().all()
+
+        by_code = {}
+        for index, row in enumerate(items):
+            if row['barcode']:
+                by_code[row['barcode']] = index
+            if row['sku']:
+                by_code.setdefault(row['sku'].upper(), index)
+        codes = sorted((code.encode('utf-8'), index) for code, index in by_code.items())
+
+        columns = {'item.id': array('q', (row['id'] for row in items))}
+        for name in ('sale_price', 'stock_quantity'):
+            columns[f'item.{name}'] = array('d', (math.nan if row[name] is None else row[name] for row in items))
+        string_columns = {
+            **{f'item.{name}': [row[name] for row in items] for name in ('name', 'category', 'unit', 'sku', 'barcode')},
+            # One line per item, so a match never runs into the next one
+            'item.search': [
+                ' '.join(filter(None, (row['name'], row['sku'], row['barcode']))).lower().replace('\n', ' ') + '\n'
+                for row in items
+            ],
+            'code': [code.decode('utf-8') for code, _ in codes],
+            'customer.name': [row['name'] for row in customers],
+            'customer.phone': [row['phone'] for row in customers],
+            'customer.search': [
+                f"{(row['name'] or '').lower()}\0{(row['phone'] or '').lower()}".replace('\n', ' ') + '\n'
+                for row in customers
+            ],
+        }
+        columns['code.item'] = array('q', (index for _, index in codes))
+        columns['customer.id'] = array('q', (row['id'] for row in customers))
+        for name, values in string_columns.items():
+            columns[name], columns[name + '.offsets'] = _string_column(values)
+
+        _CatalogFile.write(self._base + '.data', version, columns)
+        logger.info(f"✓ Rebuilt shared catalog v{version}: {len(items)} items, {len(customers)} customers")
+
+    @staticmethod
+    def _item(catalog, index):
+        columns = catalog.columns
+        sale_price = columns['item.sale_price'][index]
+        return {
+            'id': columns['item.id'][index],
+            'name': columns['item.name'][index],
+            'category': columns['item.category'][index],
+            'unit': columns['item.unit'][index],
+            'sale_price': None if math.isnan(sale_price) else sale_price,
+            'sku': columns['item.sku'][index],
+            'barcode': columns['item.barcode'][index],
+        }
+
+    @staticmethod
+    def _matches(column, query, limit):
+        """Row indexes whose search text contains query, in file order."""
+        needle = query.encode('utf-8')
+        if not needle or b'\n' in needle or b'\0' in needle:
+            return []
+        found, position = [], 0
+        while len(found) < limit:
+            position = column.find(needle, position)
+            if position < 0:
+                break
+            index = bisect_right(column.offsets, position) - 1
+            found.append(index)
+            position = column.offsets[index + 1]
+        return found
+
+    def lookup(self, code):
+        """Exact barcode, or SKU in any case."""
+        catalog = self._current()
+        codes = catalog.columns['code']
+        code = code.strip()
+        for candidate in (code, code.upper()):
+            needle = candidate.encode('utf-8')
+            # Binary search over the sorted codes
+            low, high = 0, len(codes)
+            while low < high:
+                middle = (low + high) // 2
+                if bytes(codes.raw(middle)) < needle:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low < len(codes) and bytes(codes.raw(low)) == needle:
+                return self._item(catalog, catalog.columns['code.item'][low])
+        return None
+
+    def search(self, query, limit=10):
+        """Items whose name, SKU or barcode contains query, by name."""
+        catalog = self._current()
+        return [
+            self._item(catalog, index)
+            for index in self._matches(catalog.columns['item.search'], query.strip().lower(), limit)
+        ]
+
+    def search_customers(self, query, limit=10):
+        """Customers whose name or phone contains query, by id."""
+        catalog = self._current()
+        columns = catalog.columns
+        return [
+            {'id': columns['customer.id'][index], 'name': columns['customer.name'][index],
+             'phone': columns['customer.phone'][index]}
+            for index in self._matches(columns['customer.search'], query.strip().lower(), limit)
+        ]
+
+    def items(self):
+        """Every item in name order, with total purchased (stock_quantity)."""
+        catalog = self._current()
+        for index in range(len(catalog.columns['item.id'])):
+            stock_quantity = catalog.columns['item.stock_quantity'][index]
+            yield {**self._item(catalog, index), 'stock_quantity': None if math.isnan(stock_quantity) else stock_quantity}
+
+shared_catalog = SharedCatalog(int(os.environ.get('ITEM_CATALOG_TTL_SECONDS', 30)))
+
+def with_stock(items):
+    """Catalog entries as JSON dicts with current remaining stock (one query)."""
+    stock = dict(db.session.execute(
+        db.select(ItemReorderState.item_id, ItemReorderState.remaining_quantity)
+        .where(ItemReorderState.item_id.in_([item['id'] for item in items]))
+    ).all()) if items else {}
+    return [
+        {**{k: v for k, v in item.items() if not k.startswith('_')}, 'stock': stock.get(item['id'])}
+        for item in items
+    ]
+
+# record_purchase_bill sets catalog_stale itself; update it if this check changes
+@event.listens_for(db.session, 'after_flush')
+def _mark_catalog_stale(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, (Item, Customer)):
+            session.info['catalog_stale'] = True
+            return
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_shared_catalog(session):
+    if session.info.pop('catalog_stale', False):
+        shared_catalog.invalidate()
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_catalog_stale(session, previous_transaction):
+    session.info.pop('catalog_stale', None)
+
+# ------------------
+# Price History
+# ------------------
+# record_purchase_bill writes ItemPrice rows for its repriced items directly; keep the two in step
+@event.listens_for(db.session, 'after_flush')
+def _record_price_changes(session, flush_context):
+    """Close the open interval and open a new one for every repriced item."""
+    changed = [obj for obj in session.new if isinstance(obj, Item)]
+    candidates = {
+        obj.id: obj for obj in session.dirty
+        if isinstance(obj, Item) and (
+            db.inspect(obj).attrs.purchase_price.history.added or db.inspect(obj).attrs.sale_price.history.added
+        )
+    }
+    conn = session.connection()
+    if candidates:
+        # Attribute history can't tell a real change from re-setting an expired
+        # value, so compare with the open interval
+        current = {
+            row.item_id: (row.purchase_price, row.sale_price)
+            for row in conn.execute(
+                db.select(ItemPrice.item_id, ItemPrice.purchase_price, ItemPrice.sale_price)
+                .where(ItemPrice.item_id.in_(list(candidates)), ItemPrice.valid_to.is_(None))
+            )
+        }
+        changed += [
+            item for item_id, item in candidates.items()
+            if current.get(item_id) != (item.purchase_price, item.sale_price)
+        ]
+    if not changed:
+        return
+    now = datetime.utcnow()
+    conn.execute(
+        db.update(ItemPrice)
+        .where(ItemPrice.item_id.in_([item.id for item in changed]), ItemPrice.valid_to.is_(None))
+        .values(valid_to=now)
+    )
+    conn.execute(db.insert(ItemPrice), [
+        {'item_id': item.id, 'purchase_price': item.purchase_price, 'sale_price': item.sale_price,
+         'valid_from': now, 'valid_to': None}
+        for item in changed
+    ])
+
+def price_as_of(item_id, when):
+    """{'purchase_price', 'sale_price'} for one item at a datetime, or None."""
+    row = db.session.execute(
+        db.select(ItemPrice.purchase_price, ItemPrice.sale_price)
+        .where(
+            ItemPrice.item_id == item_id,
+            ItemPrice.valid_from <= when,
+            db.or_(ItemPrice.valid_to.is_(None), ItemPrice.valid_to > when)
+        )
+        .order_by(ItemPrice.valid_from.desc())
+        .limit(1)
+    ).first()
+    return dict(row._mapping) if row else None
+
+def prices_as_of(when, item_ids=None):
+    """{item_id: {'purchase_price', 'sale_price'}} at a datetime, in one query."""
+    query = db.select(ItemPrice.item_id, ItemPrice.purchase_price, ItemPrice.sale_price).where(
+        ItemPrice.valid_from <= when,
+        db.or_(ItemPrice.valid_to.is_(None), ItemPrice.valid_to > when)
+    )
+    if item_ids is not None:
+        query = query.where(ItemPrice.item_id.in_(item_ids))
+    return {
+        row.item_id: {'purchase_price': row.purchase_price, 'sale_price': row.sale_price}
+        for row in db.session.execute(query)
+    }
+
+# ------------------
+# Ledger Journal
+# ------------------
+# Write paths call record_event() before committing, so an event lands in the
+# same transaction as the change it describes. Point-in-time state is the
+# nearest LedgerSnapshot at or before the target plus the events after it.
+LEDGER_SNAPSHOT_EVERY = int(os.environ.get('LEDGER_SNAPSHOT_EVERY', 1000))
+
+def record_event(event_type, occurred_at=None, entity_id=None, customer_id=None, item_id=None,
+                 wholesaler_id=None, balance_delta=0.0, quantity_delta=0.0, payable_delta=0.0, **data):
+    """Append a ledger event to the current transaction."""
+    db.session.add(LedgerEvent(
+        event_type=event_type,
+        occurred_at=occurred_at or datetime.utcnow(),
+        entity_id=entity_id,
+        customer_id=customer_id,
+        item_id=item_id,
+        wholesaler_id=wholesaler_id,
+        balance_delta=balance_delta,
+        quantity_delta=quantity_delta,
+        payable_delta=payable_delta,
+        data=json.dumps(data, default=str) if data else None
+    ))
+
+def _empty_ledger_state():
+    return {'customers': {}, 'items': {}, 'wholesalers': {}}
+
+def _fold_ledger_events(state, condition, upto_event_id=None):
+    """Add grouped event deltas matching condition into state (in place)."""
+    query = db.session.query(
+        LedgerEvent.customer_id,
+        LedgerEvent.item_id,
+        LedgerEvent.wholesaler_id,
+        db.func.sum(LedgerEvent.balance_delta),
+        db.func.sum(LedgerEvent.quantity_delta),
+        db.func.sum(LedgerEvent.payable_delta)
+    ).filter(condition)
+    if upto_event_id is not None:
+        query = query.filter(LedgerEvent.id <= upto_event_id)
+    query = query.group_by(LedgerEvent.customer_id, LedgerEvent.item_id, LedgerEvent.wholesaler_id)
+    for customer_id, item_id, wholesaler_id, balance, quantity, payable in query:
+        for key, entity_id, delta in (
+            ('customers', customer_id, balance),
+            ('items', item_id, quantity),
+            ('wholesalers', wholesaler_id, payable),
+        ):
+            if entity_id is not None and delta:
+                bucket = state[key]
+                bucket[str(entity_id)] = round(bucket.get(str(entity_id), 0.0) + delta, 4)
+    return state
+
+def ledger_state_at(as_of, upto_event_id=None):
+    """Customer balances, item stock and wholesaler payables as of a datetime."""
+    snapshot = LedgerSnapshot.query.filter(
+        LedgerSnapshot.as_of <= as_of
+    ).order_by(LedgerSnapshot.as_of.desc(), LedgerSnapshot.id.desc()).first()
+
+    if snapshot is None:
+        return _fold_ledger_events(_empty_ledger_state(), LedgerEvent.occurred_at <= as_of, upto_event_id)
+
+    state = json.loads(snapshot.state)
+    _fold_ledger_events(
+        state,
+        db.and_(LedgerEvent.occurred_at > snapshot.as_of, LedgerEvent.occurred_at <= as_of),
+        upto_event_id
+    )
+    _fold_ledger_events(
+        state,
+        db.and_(LedgerEvent.id > snapshot.last_event_id, LedgerEvent.occurred_at <= snapshot.as_of),
+        upto_event_id
+    )
+    return state
+
+def take_ledger_snapshot(state=None, as_of=None):
+    """Store the folded state as of now (or the given state/as_of)."""
+    last_event_id = db.session.query(db.func.coalesce(db.func.max(LedgerEvent.id), 0)).scalar()
+    as_of = as_of or datetime.utcnow()
+    if state is None:
+        state = ledger_state_at(as_of, last_event_id)
+    snapshot = LedgerSnapshot(as_of=as_of, last_event_id=last_event_id, state=json.dumps(state))
+    db.session.add(snapshot)
+    db.session.commit()
+    return snapshot
+
+def maybe_snapshot_ledger():
+    """Take a snapshot once LEDGER_SNAPSHOT_EVERY events have built up."""
+    last_snapshot_event = db.session.query(db.func.max(LedgerSnapshot.last_event_id)).scalar() or 0
+    last_event = db.session.query(db.func.max(LedgerEvent.id)).scalar() or 0
+    if last_event - last_snapshot_event >= LEDGER_SNAPSHOT_EVERY:
+        snapshot = take_ledger_snapshot()
+        logger.info(f"✓ Ledger snapshot taken at event {snapshot.last_event_id}")
+
+def seed_ledger_journal():
+    """Open the journal on an existing database with a snapshot of current state."""
+    if db.session.query(LedgerSnapshot.id).first() is not None:
+        return
+    if db.session.query(LedgerEvent.id).first() is not None:
+        return
+
+    state = _empty_ledger_state()
+    for customer_id, balance in db.session.query(
+        Sale.customer_id, db.func.sum(Sale.total_price - db.func.coalesce(Sale.paid_amount, 0))
+    ).filter(Sale.customer_id.isnot(None)).group_by(Sale.customer_id):
+        state['customers'][str(customer_id)] = round(balance or 0, 4)
+    for customer_id, advance in db.session.query(
+        Payment.customer_id, db.func.sum(Payment.unallocated_amount)
+    ).group_by(Payment.customer_id):
+        key = str(customer_id)
+        state['customers'][key] = round(state['customers'].get(key, 0.0) - (advance or 0), 4)
+
+    sold = dict(db.session.query(Sale.item_id, db.func.sum(Sale.quantity)).group_by(Sale.item_id))
+    for item_id, stock_quantity in db.session.query(Item.id, Item.stock_quantity):
+        state['items'][str(item_id)] = round((stock_quantity or 0) - (sold.get(item_id) or 0), 4)
+
+    for wholesaler_id, payable in db.session.query(
+        WholesalerTransaction.wholesaler_id,
+        db.func.sum(WholesalerTransaction.total_price - db.func.coalesce(WholesalerTransaction.paid_amount, 0))
+    ).group_by(WholesalerTransaction.wholesaler_id):
+        state['wholesalers'][str(wholesaler_id)] = round(payable or 0, 4)
+
+    if not any(state.values()):
+        return
+    take_ledger_snapshot(state=state)
+    logger.info("✓ Ledger journal opened with a snapshot of current balances")
+
+try:
+    with app.app_context():
+        seed_ledger_journal()
+except Exception as e:
+    logger.error(f"✗ Failed to open ledger journal: {e}")
+
+@app.after_request
+def _snapshot_ledger_after_writes(response):
+    if request.method == 'POST' or request.path.startswith('/delete'):
+        # Handlers commit what they keep; anything still pending was left by an
+        # error path and must not go out with the snapshot's commit
+        db.session.rollback()
+        try:
+            maybe_snapshot_ledger()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"✗ Ledger snapshot failed: {e}")
+    return response
+
+# ------------------
+# Hot/Cold Storage
+# ------------------
+# Sales and purchases only ever grow. On PostgreSQL, partition_tables.py turns
+# sale and wholesaler_transaction into tables partitioned by month on date, and
+# the app keeps PARTITION_MONTHS_AHEAD months of partitions created ahead, so
+# recent-date queries only touch small partitions and their indexes.
+# On SQLite, archive_sales.py moves fully paid sales older than
+# ARCHIVE_HORIZON_MONTHS into sale_archive and leaves one summary Sale row per
+# customer, item and month in their place. Balances and monthly totals read
+# from Sale stay exact; sale_history() reads sale detail across both tables.
+
+PARTITIONED_TABLES = ('sale', 'wholesaler_transaction')
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', 3))
+ARCHIVE_HORIZON_MONTHS = int(os.environ.get('ARCHIVE_HORIZON_MONTHS', 12))
+
+def add_months(moment, months=0):
+    """Midnight on the first of the month `months` after moment's month."""
+    index = moment.year * 12 + moment.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def partition_name(table, month):
+    return f"{table}_y{month.year}m{month.month:02d}"
+
+def partitioned_tables(conn):
+    """Which of PARTITIONED_TABLES are partitioned in this database."""
+    if conn.dialect.name != 'postgresql':
+        return []
+    return list(conn.execute(text(
+        "SELECT c.relname FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = ANY(:names) AND pg_table_is_visible(c.oid)"
+    ), {'names': list(PARTITIONED_TABLES)}).scalars())
+
+def create_month_partitions(conn, table, first_month, last_month):
+    """Create the monthly partitions of table from first_month through last_month."""
+    preparer = conn.dialect.identifier_preparer
+    month = add_months(first_month)
+    while month <= last_month:
+        following = add_months(month, 1)
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {preparer.quote(partition_name(table, month))} "
+            f"PARTITION OF {preparer.quote(table)} "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')"
+        ))
+        month = following
+
+_partitions_checked_month = None
+
+def ensure_month_partitions():
+    """Create partitions through PARTITION_MONTHS_AHEAD months from now."""
+    global _partitions_checked_month
+    this_month = add_months(datetime.utcnow())
+    if _partitions_checked_month == this_month or db.engine.dialect.name != 'postgresql':
+        return
+    _partitions_checked_month = this_month
+    try:
+        with db.engine.begin() as conn:
+            for table in partitioned_tables(conn):
+                create_month_partitions(conn, table, this_month, add_months(this_month, PARTITION_MONTHS_AHEAD))
+    except Exception as e:
+        logger.error(f"✗ Creating monthly partitions failed: {e}")
+
+@app.before_request
+def _ensure_partitions_this_month():
+    ensure_month_partitions()
+
+def sale_history():
+    """Every sale in detail (hot sales plus archived ones) as a subquery with Sale's columns."""
+    hot = db.select(
+        Sale.id, Sale.customer_id, Sale.item_id, Sale.quantity, Sale.unit_price, Sale.total_price,
+        Sale.paid_amount, db.cast(db.null(), db.Float).label('allocated_amount'), Sale.date,
+        Sale.business_date, Sale.cost_fifo, Sale.cost_avg
+    ).where(Sale.archived_count.is_(None))
+    cold = db.select(
+        SaleArchive.id, SaleArchive.customer_id, SaleArchive.item_id, SaleArchive.quantity,
+        SaleArchive.unit_price, SaleArchive.total_price, SaleArchive.paid_amount,
+        SaleArchive.allocated_amount, SaleArchive.date, SaleArchive.business_date,
+        SaleArchive.cost_fifo, SaleArchive.cost_avg
+    )
+    return db.union_all(hot, cold).subquery('sale_history')
+
+def detail_sales(conditions):
+    """Sale and SaleArchive objects matching conditions(model), newest first."""
+    hot = Sale.query.filter(Sale.archived_count.is_(None), *conditions(Sale)).all()
+    cold = SaleArchive.query.filter(*conditions(SaleArchive)).all()
+    return sorted(hot + cold, key=lambda s: (s.date or datetime.min, s.id), reverse=True)
+
+def archive_paid_sales(before):
+    """Move fully paid sales from shop months before `before` into sale_archive."""
+    sales = Sale.__table__
+    before, _ = month_range(before)
+    paid_off = (sales.c.archived_count.is_(None), sales.c.paid_amount >= sales.c.total_price)
+    first = db.session.execute(
+        db.select(db.func.min(sales.c.business_date)).where(*paid_off, sales.c.business_date < before)
+    ).scalar()
+    if first is None:
+        return 0, 0
+
+    allocated = db.select(db.func.coalesce(db.func.sum(PaymentAllocation.amount), 0.0)).where(
+        PaymentAllocation.sale_id == sales.c.id
+    ).scalar_subquery()
+    repoint_allocations = db.update(PaymentAllocation.__table__).where(
+        PaymentAllocation.__table__.c.sale_id == db.bindparam('old_id')
+    ).values(sale_id=db.bindparam('new_id'))
+    repoint_consumptions = db.update(CostLayerConsumption.__table__).where(
+        CostLayerConsumption.__table__.c.sale_id == db.bindparam('old_id')
+    ).values(sale_id=db.bindparam('new_id'))
+
+    archived = summaries = 0
+    month, following = month_range(first)
+    while month < before:
+        rows = db.session.execute(
+            db.select(sales, allocated.label('allocated_amount'))
+            .where(*paid_off, sales.c.business_date >= month, sales.c.business_date < following)
+            .order_by(sales.c.customer_id, sales.c.item_id, sales.c.date, sales.c.id)
+        ).all()
+        if rows:
+            groups = [list(group) for _, group in groupby(rows, key=lambda r: (r.customer_id, r.item_id))]
+            summary_rows = []
+            for group in groups:
+                quantity = sum(r.quantity for r in group)
+                total = sum(r.total_price for r in group)
+                fifo = [r.cost_fifo for r in group if r.cost_fifo is not None]
+                avg = [r.cost_avg for r in group if r.cost_avg is not None]
+                summary_rows.append({
+                    'customer_id': group[0].customer_id,
+                    'item_id': group[0].item_id,
+                    'quantity': quantity,
+                    'unit_price': total / quantity if quantity else 0.0,
+                    'total_price': total,
+                    'paid_amount': sum(r.paid_amount or 0.0 for r in group),
+                    'date': group[0].date,
+                    'business_date': group[0].business_date,
+                    'cost_fifo': sum(fifo) if fifo else None,
+                    'cost_avg': sum(avg) if avg else None,
+                    'archived_count': len(group),
+                })
+            summary_ids = db.session.execute(
+                db.insert(sales).returning(sales.c.id, sort_by_parameter_order=True), summary_rows
+            ).scalars().all()
+
+            now = datetime.utcnow()
+            archive_rows, moves, with_allocations = [], [], []
+            for group, summary_id in zip(groups, summary_ids):
+                for r in group:
+                    archive_rows.append({
+                        'id': r.id, 'customer_id': r.customer_id, 'item_id': r.item_id,
+                        'quantity': r.quantity, 'unit_price': r.unit_price, 'total_price': r.total_price,
+                        'paid_amount': r.paid_amount, 'allocated_amount': r.allocated_amount,
+                        'date': r.date, 'business_date': r.business_date, 'cost_fifo': r.cost_fifo, 'cost_avg': r.cost_avg,
+                        'summary_sale_id': summary_id, 'archived_at': now,
+                    })
+                    moves.append({'old_id': r.id, 'new_id': summary_id})
+                    if r.allocated_amount:
+                        with_allocations.append(moves[-1])
+            db.session.execute(db.insert(SaleArchive.__table__), archive_rows)
+            if with_allocations:
+                db.session.execute(repoint_allocations, with_allocations)
+            db.session.execute(repoint_consumptions, moves)
+            ids = [m['old_id'] for m in moves]
+            for i in range(0, len(ids), 500):
+                db.session.execute(db.delete(sales).where(sales.c.id.in_(ids[i:i + 500])))
+            db.session.commit()
+
+            archived += len(archive_rows)
+            summaries += len(summary_rows)
+            logger.info(f"✓ Archived {len(archive_rows)} sales from {month:%Y-%m} into {len(summary_rows)} summary rows")
+        month, following = month_range(following)
+    return archived, summaries
+
+# ------------------
+# Duplicate Customers
+# ------------------
+# Customers entered before phone_e164 existed can share a number. The oldest
+# one is kept; the others' sales, archived sales and payments are moved to it
+# with set-based UPDATEs and the duplicates are deleted.
+_phone_keys = db.Table(
+    'customer_phone_key', db.MetaData(),
+    db.Column('customer_id', db.Integer, primary_key=True),
+    db.Column('phone_e164', db.String(16), nullable=False),
+    prefixes=['TEMPORARY']
+)
+_customer_merges = db.Table(
+    'customer_merge', db.MetaData(),
+    db.Column('duplicate_id', db.Integer, primary_key=True),
+    db.Column('survivor_id', db.Integer, nullable=False),
+    prefixes=['TEMPORARY']
+)
+
+def find_duplicate_customers():
+    """[(phone_e164, survivor_id, [duplicate ids])] for numbers held by several customers."""
+    conn = db.session.connection()
+    _phone_keys.drop(conn, checkfirst=True)
+    _phone_keys.create(conn)
+    try:
+        conn.execute(_phone_keys.insert().from_select(
+            ['customer_id', 'phone_e164'],
+            db.select(Customer.id, Customer.phone_e164).where(Customer.phone_e164.isnot(None))
+        ))
+        unkeyed = [
+            {'customer_id': customer_id, 'phone_e164': normalize_phone(phone)}
+            for customer_id, phone in conn.execute(
+                db.select(Customer.id, Customer.phone).where(Customer.phone_e164.is_(None), Customer.phone.isnot(None))
+            )
+        ]
+        unkeyed = [row for row in unkeyed if row['phone_e164']]
+        if unkeyed:
+            conn.execute(_phone_keys.insert(), unkeyed)
+
+        keys = _phone_keys.c
+        shared = db.select(
+            keys.phone_e164, db.func.min(keys.customer_id).label('survivor_id')
+        ).group_by(keys.phone_e164).having(db.func.count() > 1).subquery()
+        rows = conn.execute(
+            db.select(shared.c.phone_e164, shared.c.survivor_id, keys.customer_id)
+            .join(_phone_keys, keys.phone_e164 == shared.c.phone_e164)
+            .where(keys.customer_id != shared.c.survivor_id)
+            .order_by(shared.c.survivor_id, keys.customer_id)
+        ).all()
+    finally:
+        _phone_keys.drop(conn)
+    return [
+        (phone_e164, survivor_id, [row.customer_id for row in group])
+        for (phone_e164, survivor_id), group in groupby(rows, key=lambda row: (row.phone_e164, row.survivor_id))
+    ]
+
+def merge_duplicate_customers():
+    """Fold every duplicate into its survivor in one transaction; returns (groups, removed)."""
+    groups = find_duplicate_customers()
+    if not groups:
+        return 0, 0
+    merges = [
+        {'duplicate_id': duplicate_id, 'survivor_id': survivor_id}
+        for _, survivor_id, duplicate_ids in groups for duplicate_id in duplicate_ids
+    ]
+    balances = ledger_state_at(datetime.utcnow())['customers']
+
+    conn = db.session.connection()
+    _customer_merges.drop(conn, checkfirst=True)
+    _customer_merges.create(conn)
+    try:
+        conn.execute(_customer_merges.insert(), merges)
+        duplicates = db.select(_customer_merges.c.duplicate_id)
+        for model in (Sale, SaleArchive, Payment):
+            table = model.__table__
+            survivor = db.select(_customer_merges.c.survivor_id).where(
+                _customer_merges.c.duplicate_id == table.c.customer_id
+            ).scalar_subquery()
+            moved = conn.execute(
+                db.update(table).where(table.c.customer_id.in_(duplicates)).values(customer_id=survivor)
+            ).rowcount
+            logger.info(f"✓ Moved {moved} {table.name} rows to surviving customers")
+        conn.execute(db.delete(Customer.__table__).where(Customer.__table__.c.id.in_(duplicates)))
+    finally:
+        _customer_merges.drop(conn)
+
+    # Survivors entered before the duplicates were found may still lack the key
+    conn.execute(
+        db.update(Customer.__table__)
+        .where(Customer.__table__.c.id == db.bindparam('survivor_id'), Customer.__table__.c.phone_e164.is_(None))
+        .values(phone_e164=db.bindparam('phone_e164')),
+        [{'survivor_id': survivor_id, 'phone_e164': phone_e164} for phone_e164, survivor_id, _ in groups]
+    )
+    for merge in merges:
+        balance = balances.get(str(merge['duplicate_id']), 0.0)
+        if balance:
+            record_event('customer_merged', entity_id=merge['duplicate_id'], customer_id=merge['duplicate_id'],
+                         balance_delta=-balance, merged_into=merge['survivor_id'])
+            record_event('customer_merged', entity_id=merge['duplicate_id'], customer_id=merge['survivor_id'],
+                         balance_delta=balance, merged_from=merge['duplicate_id'])
+
+    db.session.info.setdefault('search_stale', set()).add('customers')
+    db.session.info['catalog_stale'] = True
+    db.session.info['bootstrap_stale'] = True
+    db.session.commit()
+    dashboard_metrics.invalidate()
+    return len(groups), len(merges)
+
+# ------------------
+# Purchase Bills
+# ------------------
+def record_purchase_bill(bill, lines):
+    """Write a whole delivery in a fixed number of statements; the caller commits."""
+    # Core statements skip the ORM hooks, so this repeats _set_business_date,
+    # _update_reorder_states, _record_price_changes, _mark_catalog_stale,
+    # _mark_bootstrap_stale and _collect_metric_changes for purchases
+    session = db.session
+    session.add(bill)
+    session.flush()
+    conn = session.connection()
+    items, purchases = Item.__table__, WholesalerTransaction.__table__
+    when = bill.date
+
+    by_id, by_name = {}, {}
+    for row in conn.execute(
+        db.select(items.c.id, items.c.name, items.c.category, items.c.unit, items.c.purchase_price,
+                  items.c.sale_price, items.c.stock_quantity, items.c.avg_cost)
+        .where(db.or_(
+            items.c.id.in_([line['item_id'] for line in lines if line['item_id']]),
+            db.func.lower(items.c.name).in_(list({line['item_name'].lower() for line in lines}))
+        )).order_by(items.c.id)
+    ):
+        item = dict(row._mapping, prices=(row.purchase_price, row.sale_price))
+        by_id[row.id] = item
+        by_name.setdefault(row.name.strip().lower(), item)
+    on_hand = dict(conn.execute(
+        db.select(CostLayer.item_id, db.func.sum(CostLayer.remaining_quantity))
+        .where(CostLayer.item_id.in_(list(by_id)), CostLayer.remaining_quantity > 0)
+        .group_by(CostLayer.item_id)
+    ).all())
+
+    new_items = []
+    for line in lines:
+        item = by_id.get(line['item_id']) or by_name.get(line['item_name'].lower())
+        if item is None:
+            item = {'id': None, 'name': line['item_name'], 'category': None, 'unit': None, 'purchase_price': None,
+                    'sale_price': None, 'stock_quantity': 0.0, 'avg_cost': None, 'prices': None}
+            by_name[line['item_name'].lower()] = item
+            new_items.append(item)
+        line['item'] = item
+        quantity, price = line['quantity'], line['price_per_unit']
+        item['purchase_price'] = price
+        if not item['sale_price']:
+            item['sale_price'] = price
+        if line['category']:
+            item['category'] = line['category']
+        if line['unit']:
+            item['unit'] = line['unit']
+        item['stock_quantity'] = (item['stock_quantity'] or 0) + quantity
+        current_avg = item['avg_cost'] if item['avg_cost'] is not None else price
+        held = on_hand.get(item['id'], 0.0) if item['id'] else item.setdefault('held', 0.0)
+        item['avg_cost'] = _moved_average_cost(current_avg, held, quantity, quantity * price)
+        if item['id']:
+            on_hand[item['id']] = held + quantity
+        else:
+            item['held'] = held + quantity
+
+    columns = ('name', 'category', 'unit', 'purchase_price', 'sale_price', 'stock_quantity', 'avg_cost')
+    if new_items:
+        # Names are unique within the batch, so RETURNING rows are matched by name
+        new_ids = dict(conn.execute(
+            db.insert(items).returning(items.c.name, items.c.id),
+            [{column: item[column] for column in columns} for item in new_items]
+        ).all())
+        for item in new_items:
+            item['id'] = new_ids[item['name']]
+    existing = [item for item in by_id.values() if any(line['item'] is item for line in lines)]
+    if existing:
+        conn.execute(
+            db.update(items).where(items.c.id == db.bindparam('item_id'))
+            .values({column: db.bindparam(column) for column in columns[1:]}),
+            [{'item_id': item['id'], **{column: item[column] for column in columns[1:]}} for item in existing]
+        )
+
+    business_date = business_date_of(when)
+    inserted = conn.execute(
+        db.insert(purchases).returning(
+            purchases.c.id, purchases.c.item_id, purchases.c.quantity,
+            purchases.c.price_per_unit, purchases.c.paid_amount
+        ),
+        [{
+            'wholesaler_id': bill.wholesaler_id, 'bill_id': bill.id, 'item_id': line['item']['id'],
+            'item_name': line['item_name'], 'category': line['category'] or None, 'unit': line['unit'] or None,
+            'quantity': line['quantity'], 'price_per_unit': line['price_per_unit'],
+            'total_price': line['quantity'] * line['price_per_unit'], 'paid_amount': line['paid_amount'],
+            'date': when, 'business_date': business_date, 'notes': bill.notes,
+        } for line in lines]
+    ).all()
+    # RETURNING order isn't guaranteed; lines that match on every value are interchangeable
+    ids = {}
+    for row in inserted:
+        ids.setdefault(tuple(row[1:]), []).append(row.id)
+    for line in lines:
+        key = (line['item']['id'], line['quantity'], line['price_per_unit'], line['paid_amount'])
+        line['id'] = ids[key].pop()
+
+    conn.execute(db.insert(CostLayer.__table__), [{
+        'item_id': line['item']['id'], 'wholesaler_transaction_id': line['id'], 'source': 'purchase',
+        'quantity': line['quantity'], 'remaining_quantity': line['quantity'], 'unit_cost': line['price_per_unit'],
+        'date': when,
+    } for line in lines])
+    now = datetime.utcnow()
+    conn.execute(db.insert(LedgerEvent.__table__), [{
+        'event_type': 'purchase_recorded', 'occurred_at': when, 'recorded_at': now, 'entity_id': line['id'],
+        'customer_id': None, 'item_id': line['item']['id'], 'wholesaler_id': bill.wholesaler_id,
+        'balance_delta': 0.0, 'quantity_delta': line['quantity'],
+        'payable_delta': line['quantity'] * line['price_per_unit'] - line['paid_amount'],
+        'data': json.dumps({'price_per_unit': line['price_per_unit'], 'bill_id': bill.id}),
+    } for line in lines])
+
+    touched = existing + new_items
+    repriced = [item for item in touched if item['prices'] != (item['purchase_price'], item['sale_price'])]
+    if repriced:
+        conn.execute(
+            db.update(ItemPrice)
+            .where(ItemPrice.item_id.in_([item['id'] for item in repriced]), ItemPrice.valid_to.is_(None))
+            .values(valid_to=now)
+        )
+        conn.execute(db.insert(ItemPrice), [
+            {'item_id': item['id'], 'purchase_price': item['purchase_price'], 'sale_price': item['sale_price'],
+             'valid_from': now, 'valid_to': None}
+            for item in repriced
+        ])
+    refresh_reorder_states(conn, sorted(item['id'] for item in touched))
+    session.info['catalog_stale'] = True
+    session.info['bootstrap_stale'] = True
+    session.info.setdefault('metric_changes', []).extend(('item', 1, None) for _ in new_items)
+    return sum(line['quantity'] * line['price_per_unit'] for line in lines)
+
+# ------------------
+# Credit Limits
+# ------------------
+# Customers at this share of their limit or more show on the credit report
+CREDIT_LIMIT_WARN_RATIO = float(os.environ.get('CREDIT_LIMIT_WARN_RATIO', 0.8))
+# Queued offline sales older than this are checked against the limit like any other
+OFFLINE_SALE_MAX_AGE = timedelta(days=float(os.environ.get('OFFLINE_SALE_MAX_AGE_DAYS', 7)))
+# ...and so are ones made this recently, which could just as well have been made online
+OFFLINE_SALE_MIN_AGE = timedelta(minutes=float(os.environ.get('OFFLINE_SALE_MIN_AGE_MINUTES', 5)))
+
+@event.listens_for(db.session, 'after_flush')
+def _apply_customer_balances(session, flush_context):
+    """Move Customer.balance by the balance_delta of ledger events in this flush."""
+    deltas = {}
+    for obj in session.new:
+        if isinstance(obj, LedgerEvent) and obj.customer_id and obj.balance_delta:
+            deltas[obj.customer_id] = deltas.get(obj.customer_id, 0.0) + obj.balance_delta
+    if deltas:
+        customers = Customer.__table__
+        session.connection().execute(
+            db.update(customers).where(customers.c.id == db.bindparam('customer_id'))
+            .values(balance=db.func.coalesce(customers.c.balance, 0) + db.bindparam('delta')),
+            [{'customer_id': customer_id, 'delta': delta} for customer_id, delta in deltas.items()]
+        )
+        # Core UPDATE, so the offline snapshot's flush check doesn't see it
+        session.info['bootstrap_stale'] = True
+
+def credit_limit_breach(customer_id, amount):
+    """(balance, credit_limit) if owing amount more would take the customer over their limit, else None."""
+    if amount <= 0:
+        return None
+    row = db.session.execute(
+        db.select(Customer.balance, Customer.credit_limit).where(Customer.id == customer_id).with_for_update()
+    ).one_or_none()
+    if row is None or row.credit_limit is None:
+        return None
+    balance = row.balance or 0.0
+    if balance + amount > row.credit_limit + 0.005:
+        return balance, row.credit_limit
+    return None
+
+def customers_near_limit(ratio=CREDIT_LIMIT_WARN_RATIO):
+    """Customers with a limit whose balance is at least ratio of it, fullest first."""
+    rows = db.session.execute(
+        db.select(Customer.id, Customer.name, Customer.phone, Customer.balance, Customer.credit_limit)
+        .where(Customer.credit_limit.isnot(None), Customer.balance >= Customer.credit_limit * ratio)
+    ).all()
+    report = [{
+        'id': row.id, 'name': row.name, 'phone': row.phone,
+        'balance': round(row.balance, 2), 'credit_limit': row.credit_limit,
+        'available': round(row.credit_limit - row.balance, 2),
+        'used': row.balance / row.credit_limit if row.credit_limit > 0 else math.inf,
+    } for row in rows]
+    report.sort(key=lambda entry: entry['used'], reverse=True)
+    return report
+
+def offline_queued_at(value):
+    """The offline queue's ISO timestamp as naive UTC, or None unless it's between the min and max offline age."""
+    try:
+        moment = datetime.fromisoformat((value or '').strip().replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    now = datetime.utcnow()
+    if not now - OFFLINE_SALE_MAX_AGE <= moment <= now - OFFLINE_SALE_MIN_AGE:
+        return None
+    return moment
+
+def available_stock(item):
+    """Stock left for item: everything bought minus everything sold."""
+    sold_qty = db.session.query(db.func.sum(Sale.quantity)).filter(Sale.item_id == item.id).scalar() or 0
+    return item.stock_quantity - sold_qty
+
+def record_sale(item, customer_id, quantity, unit_price, paid_amount, breach=None, override_reason='', queued_at=None):
+    """Add a sale with its cost and ledger events, noting a limit breach; the caller commits."""
+    total_price = quantity * unit_price
+    sale = Sale(
+        customer_id=customer_id,
+        item_id=item.id,
+        quantity=quantity,
+        unit_price=unit_price,
+        total_price=total_price,
+        paid_amount=paid_amount
+    )
+
+    db.session.add(sale)
+    consume_cost_layers(sale, item)
+    db.session.flush()
+    record_event(
+        'sale_recorded', occurred_at=sale.date, entity_id=sale.id,
+        customer_id=customer_id, item_id=item.id,
+        balance_delta=(total_price - paid_amount) if customer_id else 0.0,
+        quantity_delta=-quantity,
+        total_price=total_price, paid_amount=paid_amount,
+        **({'queued_at': queued_at} if queued_at else {})
+    )
+    if breach:
+        over_limit = dict(
+            occurred_at=sale.date, entity_id=sale.id, customer_id=customer_id,
+            balance_before=round(breach[0], 2), credit_limit=breach[1],
+            amount=round(total_price - paid_amount, 2)
+        )
+        if override_reason:
+            record_event('credit_limit_overridden', reason=override_reason, **over_limit)
+        else:
+            # Made offline, so it already happened, but it isn't approved
+            # either: it waits on the credit report for a reason
+            record_event('offline_sale_over_limit', queued_at=queued_at, **over_limit)
+    return sale
+
+def _over_limit_events(condition, limit=None):
+    names = db.select(Customer.name).where(Customer.id == LedgerEvent.customer_id).scalar_subquery()
+    query = db.select(LedgerEvent, names.label('name')).where(condition).order_by(LedgerEvent.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    return [
+        {'occurred_at': event_row.occurred_at, 'sale_id': event_row.entity_id,
+         'customer_id': event_row.customer_id, 'name': name, **json.loads(event_row.data or '{}')}
+        for event_row, name in db.session.execute(query)
+    ]
+
+def credit_limit_overrides(limit=50):
+    """Latest sales recorded over a credit limit with a reason, newest first."""
+    return _over_limit_events(LedgerEvent.event_type == 'credit_limit_overridden', limit)
+
+def pending_limit_reviews():
+    """Offline sales that went over a limit and haven't been given a reason yet."""
+    override = db.aliased(LedgerEvent)
+    reviewed = db.select(override.id).where(
+        override.event_type == 'credit_limit_overridden', override.entity_id == LedgerEvent.entity_id
+    ).exists()
+    pending = _over_limit_events(db.and_(LedgerEvent.event_type == 'offline_sale_over_limit', ~reviewed))
+    for entry in pending:
+        entry['queued_at'] = datetime.fromisoformat(entry['queued_at'])
+    return pending
+
+# ------------------
+# Static Assets
+# ------------------
+# build_assets.py writes hashed bundles and a manifest to static/dist/. When it
+# has run, url_for('static', ...) and asset_bundle() point at those files;
+# otherwise the source files are served as before.
+from build_assets import ASSET_BUNDLES
+
+ASSET_DIST_DIR = os.path.join(app.static_folder, 'dist')
+
+def load_asset_manifest():
+    try:
+        with open(os.path.join(ASSET_DIST_DIR, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        logger.info(f"✓ Asset manifest {manifest['version']} loaded")
+        return manifest
+    except FileNotFoundError:
+        logger.info("📁 No asset build found, serving source static files")
+        return {'bundles': {}, 'files': {}, 'version': None}
+
+asset_manifest = load_asset_manifest()
+
+@app.url_defaults
+def _fingerprint_static_url(endpoint, values):
+    if endpoint == 'static':
+        hashed = asset_manifest['files'].get(values.get('filename'))
+        if hashed:
+            values['filename'] = hashed
+
+@app.template_global()
+def asset_bundle(name):
+    """Static filenames to include for a bundle: the built file, or its sources."""
+    built = asset_manifest['bundles'].get(name)
+    return [built] if built else ASSET_BUNDLES[name]
+
+@app.route('/static/dist/<path:filename>')
+def static_dist(filename):
+    """Hashed build output: precompressed variant if accepted, cached forever."""
+    from flask import send_from_directory
+    accepted = request.headers.get('Accept-Encoding', '')
+    mimetype = 'text/css' if filename.endswith('.css') else 'application/javascript'
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in accepted and os.path.isfile(os.path.join(ASSET_DIST_DIR, filename + suffix)):
+            response = send_from_directory(ASSET_DIST_DIR, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(ASSET_DIST_DIR, filename, mimetype=mimetype)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+# ------------------
+# Request Profiler
+# ------------------
+# Off until switched on through /admin/profiler (PROFILER_TOKEN must be set).
+# The settings live in instance/profiler.json so every worker follows the same
+# toggle. A chosen request has its stack sampled every PROFILER_INTERVAL_MS
+# and its SQL and template time measured exactly. Each one writes a
+# collapsed-stack file (flamegraph.pl / speedscope format, weights in
+# microseconds) to instance/profiles/ and a summary line to
+# instance/profiles/index.jsonl.
+
+PROFILER_TOKEN = os.environ.get('PROFILER_TOKEN', '')
+PROFILER_INTERVAL = float(os.environ.get('PROFILER_INTERVAL_MS', 5)) / 1000
+PROFILE_DIR = os.path.join(app.instance_path, 'profiles')
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 200))
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(APP_DIR, 'templates')
+# Innermost SQLAlchemy frames while the driver runs a statement or fetches rows
+DBAPI_CALLS = {'do_execute', 'do_executemany', 'do_execute_no_params', 'fetchone', 'fetchmany', 'fetchall'}
+DRIVER_PATHS = (os.sep + 'sqlite3' + os.sep, os.sep + 'psycopg' + os.sep)
+
+def sample_phase(frame):
+    """db, orm, template or app: the innermost frame that is ours or a known library."""
+    while frame is not None:
+        code = frame.f_code
+        filename = code.co_filename
+        if any(path in filename for path in DRIVER_PATHS):
+            return 'db'
+        if os.sep + 'sqlalchemy' + os.sep in filename:
+            return 'db' if code.co_name in DBAPI_CALLS else 'orm'
+        if os.sep + 'jinja2' + os.sep in filename or filename.startswith(TEMPLATE_DIR):
+            return 'template'
+        if filename.startswith(APP_DIR):
+            return 'app'
+        frame = frame.f_back
+    return 'app'
+
+class ProfilerSettings:
+    """The shared toggle. Re-read from disk at most once a second per worker."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+        self._mtime = None
+        self._settings = None
+
+    def current(self):
+        """Settings dict while profiling is on, else None."""
+        now = time.monotonic()
+        if now - self._checked_at >= 1.0:
+            with self._lock:
+                self._checked_at = now
+                try:
+                    mtime = os.stat(self.path).st_mtime
+                except OSError:
+                    mtime, self._settings = None, None
+                if mtime is not None and mtime != self._mtime:
+                    try:
+                        with open(self.path, encoding='utf-8') as f:
+                            self._settings = json.load(f)
+                    except (OSError, ValueError):
+                        self._settings = None
+                self._mtime = mtime
+        settings = self._settings
+        if not settings or not settings.get('enabled') or settings.get('expires_at', 0) < time.time():
+            return None
+        return settings
+
+    def save(self, settings):
+        partial = self.path + '.partial'
+        with open(partial, 'w', encoding='utf-8') as f:
+            json.dump(settings, f)
+        os.replace(partial, self.path)
+        with self._lock:
+            self._checked_at = 0.0
+
+    def selects(self, endpoint, path):
+        settings = self.current()
+        if settings is None or endpoint in (None, 'static', 'static_dist', 'admin_profiler', 'admin_profile_file'):
+            return False
+        routes = settings.get('routes') or []
+        if routes and endpoint not in routes and path not in routes:
+            return False
+        return random.random() * 100 < settings.get('percent', 100)
+
+class RequestProfile:
+    """Stack samples and phase timings for one request."""
+
+    def __init__(self, method, path, endpoint, interval):
+        self.method = method
+        self.path = path
+        self.endpoint = endpoint
+        self.interval = interval
+        self.started_at = datetime.utcnow()
+        self.started = self.last_sample = time.perf_counter()
+        self.stacks = {}  # collapsed stack -> microseconds
+        self.phase_seconds = {'db': 0.0, 'orm': 0.0, 'template': 0.0, 'app': 0.0}
+        self.samples = 0
+        self.db_seconds = 0.0
+        self.db_queries = 0
+        self.template_seconds = 0.0
+        self.orm_objects = 0
+        self.template_started = []
+        self._labels = {}
+
+    def start(self):
+        _profiling.profile = self
+        sys.setprofile(self._on_event)
+
+    def stop(self):
+        sys.setprofile(None)
+        _profiling.profile = None
+
+    def _on_event(self, frame, event, arg):
+        now = time.perf_counter()
+        if now - self.last_sample >= self.interval:
+            self.add_sample(frame, now - self.last_sample)
+            self.last_sample = now
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            filename = code.co_filename
+            if filename.startswith(APP_DIR):
+                filename = os.path.relpath(filename, APP_DIR)
+            else:
+                filename = os.path.join(*filename.split(os.sep)[-2:])
+            label = self._labels[code] = f"{code.co_name} ({filename})"
+        return label
+
+    def add_sample(self, frame, seconds):
+        self.phase_seconds[sample_phase(frame)] += seconds
+        names = []
+        while frame is not None:
+            names.append(self._label(frame.f_code))
+            frame = frame.f_back
+        names.append(f"{self.method} {self.endpoint}")
+        stack = ';'.join(reversed(names))
+        self.stacks[stack] = self.stacks.get(stack, 0) + int(seconds * 1_000_000)
+        self.samples += 1
+
+    def summary(self, status, stacks_file):
+        wall = time.perf_counter() - self.started
+        return {
+            'at': self.started_at.isoformat(timespec='seconds'),
+            'method': self.method,
+            'path': self.path,
+            'endpoint': self.endpoint,
+            'status': status,
+            'wall_ms': round(wall * 1000, 1),
+            'db_ms': round(self.db_seconds * 1000, 1),
+            'db_queries': self.db_queries,
+            'template_ms': round(self.template_seconds * 1000, 1),
+            'orm_objects': self.orm_objects,
+            'samples': self.samples,
+            # Wall time split by where the samples landed; the only place the
+            # ORM's share shows up, and db here includes fetching rows
+            'sampled_ms': {phase: round(seconds * 1000, 1) for phase, seconds in self.phase_seconds.items()},
+            'stacks': stacks_file,
+        }
+
+_profiling = threading.local()
+
+def current_profile():
+    return getattr(_profiling, 'profile', None)
+
+profiler_settings = ProfilerSettings(os.path.join(app.instance_path, 'profiler.json'))
+
+def write_profile(profile, status):
+    """Write the collapsed stacks and append the summary to the index."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{profile.started_at:%Y%m%dT%H%M%S}-{profile.endpoint}-{os.getpid()}-{threading.get_ident() % 100000}.folded"
+    with open(os.path.join(PROFILE_DIR, name), 'w', encoding='utf-8') as f:
+        for stack, count in sorted(profile.stacks.items()):
+            f.write(f"{stack} {count}\n")
+    summary = profile.summary(status, name)
+    with open(os.path.join(PROFILE_DIR, 'index.jsonl'), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(summary) + '\n')
+    stale = sorted(n for n in os.listdir(PROFILE_DIR) if n.endswith('.folded'))[:-PROFILE_KEEP]
+    for old in stale:
+        os.remove(os.path.join(PROFILE_DIR, old))
+    logger.info(f"📊 Profiled {profile.method} {profile.path}: {summary['wall_ms']} ms, {summary['db_ms']} ms SQL, {summary['template_ms']} ms template")
+    return summary
+
+def recent_profiles(limit=20):
+    try:
+        with open(os.path.join(PROFILE_DIR, 'index.jsonl'), encoding='utf-8') as f:
+            lines = deque(f, maxlen=limit)
+    except OSError:
+        return []
+    return [json.loads(line) for line in reversed(lines)]
+
+@app.before_request
+def _start_profile():
+    if profiler_settings.selects(request.endpoint, request.path):
+        RequestProfile(request.method, request.path, request.endpoint, PROFILER_INTERVAL).start()
+
+@app.after_request
+def _finish_profile(response):
+    profile = current_profile()
+    if profile is not None:
+        profile.stop()
+        try:
+            write_profile(profile, response.status_code)
+        except OSError as e:
+            logger.error(f"✗ Writing profile failed: {e}")
+    return response
+
+@app.teardown_request
+def _drop_profile(exc):
+    # after_request doesn't run when a view raises
+    profile = current_profile()
+    if profile is not None:
+        profile.stop()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _profile_query_start(conn, cursor, statement, parameters, context, executemany):
+    if current_profile() is not None:
+        conn.info.setdefault('profile_query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _profile_query_end(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile()
+    started = conn.info.get('profile_query_started')
+    if profile is not None and started:
+        profile.db_seconds += time.perf_counter() - started.pop()
+        profile.db_queries += 1
+
+@event.listens_for(db.Model, 'load', propagate=True)
+def _profile_orm_load(target, context):
+    profile = current_profile()
+    if profile is not None:
+        profile.orm_objects += 1
+
+@before_render_template.connect_via(app)
+def _profile_template_start(sender, template, context, **extra):
+    profile = current_profile()
+    if profile is not None:
+        profile.template_started.append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _profile_template_end(sender, template, context, **extra):
+    profile = current_profile()
+    if profile is not None and profile.template_started:
+        profile.template_seconds += time.perf_counter() - profile.template_started.pop()
 
 # ------------------
 # Routes
@@ -162,14 +3025,157 @@ except Exception as e:
 @app.route("/")
 def home():
     # Instead of redirecting to customers, show a dashboard
-    total_customers = Customer.query.count()
-    total_items = Item.query.count()
-    # Placeholder for earnings; we can calculate later
-    total_sales = 0
+    metrics = dashboard_metrics.snapshot()
     return render_template("dashboard.html",
-                           total_customers=total_customers,
-                           total_items=total_items,
-                           total_sales=total_sales)
+                           total_customers=metrics['total_customers'],
+                           total_items=metrics['total_items'],
+                           total_sales=metrics['revenue'],
+                           metrics=metrics,
+                           peak_hour_revenue=max(metrics['per_hour']) or 1)
+
+# API endpoint for live dashboard refresh
+@app.route("/api/dashboard", methods=["GET"])
+def api_dashboard():
+    """Current dashboard figures as JSON"""
+    return jsonify(dashboard_metrics.snapshot())
+
+# API endpoint for connection pool tuning (per worker)
+@app.route("/api/db/pool", methods=["GET"])
+def api_db_pool():
+    """Checkout wait, overflow and connection age for this worker's pool"""
+    denied = profiler_admin_denied()
+    if denied:
+        return denied
+    return jsonify(pool_metrics.snapshot(db.engine.pool))
+
+def profiler_admin_denied():
+    """403 response unless the request carries PROFILER_TOKEN, else None."""
+    # Header only: a query-string token ends up in access logs and browser history
+    token = request.headers.get('X-Admin-Token', '')
+    if not PROFILER_TOKEN:
+        return jsonify({'error': 'Set PROFILER_TOKEN to use the admin endpoints'}), 403
+    if not hmac.compare_digest(token.encode('utf-8'), PROFILER_TOKEN.encode('utf-8')):
+        return jsonify({'error': 'Invalid admin token'}), 403
+    return None
+
+@app.route("/admin/profiler", methods=["GET", "POST"])
+def admin_profiler():
+    """Show or change what is profiled, and list recent profiles."""
+    denied = profiler_admin_denied()
+    if denied:
+        return denied
+    if request.method == "POST":
+        data = request.get_json(silent=True) or request.form
+        if str(data.get('enabled', 'true')).lower() in ('0', 'false', 'no'):
+            profiler_settings.save({'enabled': False})
+        else:
+            routes = data.get('routes') or []
+            if isinstance(routes, str):
+                routes = [r.strip() for r in routes.split(',') if r.strip()]
+            try:
+                percent = min(100.0, max(0.0, float(data.get('percent', 100))))
+                minutes = min(240.0, max(1.0, float(data.get('minutes', 15))))
+            except (TypeError, ValueError):
+                return jsonify({'error': 'percent and minutes must be numbers'}), 400
+            # Always expires, so a forgotten toggle can't keep costing requests
+            profiler_settings.save({
+                'enabled': True, 'routes': routes, 'percent': percent,
+                'expires_at': time.time() + minutes * 60,
+            })
+            logger.info(f"📊 Profiler on for {minutes:g} min: {percent:g}% of {', '.join(routes) or 'all routes'}")
+    return jsonify({
+        'settings': profiler_settings.current() or {'enabled': False},
+        'interval_ms': PROFILER_INTERVAL * 1000,
+        'recent': recent_profiles(),
+    })
+
+@app.route("/admin/profiler/<name>", methods=["GET"])
+def admin_profile_file(name):
+    """One collapsed-stack file, ready for flamegraph.pl or speedscope"""
+    denied = profiler_admin_denied()
+    if denied:
+        return denied
+    if not name.endswith('.folded'):
+        return jsonify({'error': 'Not found'}), 404
+    return send_from_directory(PROFILE_DIR, name, mimetype='text/plain')
+
+# API endpoint for item velocity, top-N and ABC analysis
+@app.route("/api/analytics/items", methods=["GET"])
+def api_item_analytics():
+    """Top items, ABC classes and days of stock left for a date range."""
+    today = shop_today()
+    try:
+        end_date = datetime.strptime(request.args.get('end', ''), '%Y-%m-%d').date()
+    except ValueError:
+        end_date = today
+    try:
+        start_date = datetime.strptime(request.args.get('start', ''), '%Y-%m-%d').date()
+    except ValueError:
+        start_date = date.fromordinal(end_date.toordinal() - 29)
+    if start_date > end_date:
+        return jsonify({'error': 'start must be on or before end'}), 400
+    try:
+        top_n = max(1, int(request.args.get('top', 10)))
+    except ValueError:
+        top_n = 10
+    days = (end_date - start_date).days + 1
+
+    in_range = dict(
+        (item_id, (revenue or 0, quantity or 0))
+        for item_id, revenue, quantity in db.session.query(
+            ItemDailySales.item_id,
+            db.func.sum(ItemDailySales.revenue),
+            db.func.sum(ItemDailySales.quantity)
+        ).filter(
+            ItemDailySales.day >= start_date,
+            ItemDailySales.day <= end_date
+        ).group_by(ItemDailySales.item_id)
+    )
+    total_revenue = sum(revenue for revenue, _ in in_range.values())
+    rows = []
+    # Stock left comes from the running totals in the reorder state, not from history
+    for item_id, name, unit, stock_quantity, state_remaining in db.session.query(
+        Item.id, Item.name, Item.unit, Item.stock_quantity, ItemReorderState.remaining_quantity
+    ).outerjoin(ItemReorderState, ItemReorderState.item_id == Item.id):
+        revenue, quantity = in_range.get(item_id, (0.0, 0.0))
+        remaining = max(0.0, state_remaining if state_remaining is not None else (stock_quantity or 0))
+        daily_velocity = quantity / days
+        rows.append({
+            'item_id': item_id,
+            'name': name,
+            'unit': unit,
+            'revenue': round(revenue, 2),
+            'quantity': quantity,
+            'daily_velocity': round(daily_velocity, 3),
+            'remaining_stock': remaining,
+            'days_of_stock_left': round(remaining / daily_velocity, 1) if daily_velocity > 0 else None,
+        })
+
+    # ABC: A = items making the first 80% of revenue, B = next 15%, C = the rest
+    rows.sort(key=lambda r: r['revenue'], reverse=True)
+    cumulative = 0.0
+    for row in rows:
+        share = row['revenue'] / total_revenue if total_revenue else 0.0
+        previous = cumulative
+        cumulative += share
+        row['revenue_share'] = round(share * 100, 2)
+        if row['revenue'] <= 0:
+            row['abc_class'] = 'C'
+        elif previous < 0.80:
+            row['abc_class'] = 'A'
+        elif previous < 0.95:
+            row['abc_class'] = 'B'
+        else:
+            row['abc_class'] = 'C'
+
+    return jsonify({
+        'start': start_date.isoformat(),
+        'end': end_date.isoformat(),
+        'days': days,
+        'total_revenue': round(total_revenue, 2),
+        'top_items': [row for row in rows if row['revenue'] > 0][:top_n],
+        'items': rows,
+    })
 
 # Customers page
 @app.route("/customers", methods=["GET", "POST"])
@@ -183,14 +3189,24 @@ def customers():
             flash("Phone number is required", "error")
             return redirect(url_for("customers"))
         
-        # Check for duplicate phone number
-        existing_customer = Customer.query.filter_by(phone=phone).first()
+        phone_e164 = normalize_phone(phone)
+        if phone_e164 is None:
+            flash(f"{phone} is not a valid phone number", "error")
+            return redirect(url_for("customers"))
+
+        # Check for duplicate phone number, however it was written
+        existing_customer = Customer.query.filter_by(phone_e164=phone_e164).first()
         if existing_customer:
             flash(f"Customer with phone number {phone} already exists: {existing_customer.name}", "error")
             return redirect(url_for("customers"))
         
         db.session.add(Customer(name=name, phone=phone))
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash(f"Customer with phone number {phone} already exists", "error")
+            return redirect(url_for("customers"))
         flash("Customer added successfully", "success")
         return redirect(url_for("customers"))
     all_customers = Customer.query.all()
@@ -200,6 +3216,40 @@ def customers():
 # API Endpoints
 # ============================================
 
+# Columns each JSON list can return, in their default order. ?fields=id,name
+# narrows a response to those keys, and only those columns are selected.
+API_FIELDS = {
+    'customers': {'id': Customer.id, 'name': Customer.name, 'phone': Customer.phone},
+    'items': {
+        'id': Item.id, 'name': Item.name, 'category': Item.category, 'unit': Item.unit,
+        'purchase_price': Item.purchase_price, 'sale_price': Item.sale_price,
+        'stock_quantity': Item.stock_quantity, 'sku': Item.sku, 'barcode': Item.barcode,
+    },
+    'wholesalers': {
+        'id': Wholesaler.id, 'name': Wholesaler.name, 'phone': Wholesaler.phone, 'address': Wholesaler.address,
+    },
+}
+
+def parse_fields(fields, available):
+    """Names from a comma-separated fields value, in request order; all when empty."""
+    names = list(dict.fromkeys(name.strip() for name in (fields or '').split(',') if name.strip()))
+    if not names:
+        return list(available)
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(available)}")
+    return names
+
+def field_rows(resource, fields):
+    """Requested columns of every row as plain dicts, straight from Core rows."""
+    columns = API_FIELDS[resource]
+    names = parse_fields(fields, columns)
+    rows = db.session.execute(db.select(*(columns[name] for name in names)))
+    return [dict(zip(names, row)) for row in rows]
+
+def fields_error(error):
+    return jsonify({'error': str(error)}), 400
+
 # API endpoint for contact integration
 @app.route("/api/contacts", methods=["GET"])
 def get_contacts():
@@ -211,52 +3261,87 @@ def get_contacts():
 @app.route("/api/customers", methods=["GET"])
 def api_customers():
     """Get all customers as JSON"""
-    customers = Customer.query.all()
-    return jsonify([{
-        'id': c.id,
-        'name': c.name,
-        'phone': c.phone
-    } for c in customers])
+    try:
+        return jsonify(field_rows('customers', request.args.get('fields')))
+    except ValueError as e:
+        return fields_error(e)
+
+# API endpoint for the offline bootstrap bundle
+@app.route("/api/bootstrap", methods=["GET"])
+def api_bootstrap():
+    """Customers, items, wholesalers and balances in one gzip-compressed snapshot"""
+    version, body = bootstrap_snapshot.get()
+    if request.if_none_match.contains(version):
+        response = app.response_class(status=304)
+    elif request.accept_encodings.best_match(['gzip']):
+        response = app.response_class(body, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = app.response_class(gzip.decompress(body), mimetype='application/json')
+    response.set_etag(version)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 # API endpoint to search customers
 @app.route("/api/customers/search", methods=["GET"])
 def api_customers_search():
     """Search customers by name or phone"""
     query = request.args.get('q', '').strip()
-    
+    try:
+        names = parse_fields(request.args.get('fields'), API_FIELDS['customers'])
+    except ValueError as e:
+        return fields_error(e)
+
     if not query or len(query) < 1:
         return jsonify([])
-    
-    # Search by name or phone using LIKE (SQLite compatible)
-    # SQLite doesn't support ILIKE, so we use LIKE with lower() or case-insensitive search
-    query_lower = query.lower()
-    customers = Customer.query.filter(
-        db.or_(
-            db.func.lower(Customer.name).like(f'%{query_lower}%'),
-            Customer.phone.like(f'%{query}%')
-        )
-    ).limit(10).all()
-    
-    return jsonify([{
-        'id': c.id,
-        'name': c.name,
-        'phone': c.phone
-    } for c in customers])
+
+    limited = rate_limited_response()
+    if limited is not None:
+        return limited
+
+    # Answered from the shared catalog, which every worker maps without querying
+    results = shared_catalog.search_customers(query, SEARCH_RESULT_LIMIT)
+    return jsonify([{name: result[name] for name in names} for result in results])
 
 # API endpoint to get all items (for offline sync)
 @app.route("/api/items", methods=["GET"])
 def api_items():
     """Get all items as JSON"""
-    items = Item.query.all()
-    return jsonify([{
-        'id': i.id,
-        'name': i.name,
-        'category': i.category,
-        'unit': i.unit,
-        'purchase_price': i.purchase_price,
-        'sale_price': i.sale_price,
-        'stock_quantity': i.stock_quantity
-    } for i in items])
+    try:
+        return jsonify(field_rows('items', request.args.get('fields')))
+    except ValueError as e:
+        return fields_error(e)
+
+# API endpoint for the sales counter: exact barcode / SKU
+@app.route("/api/items/lookup", methods=["GET"])
+def api_items_lookup():
+    """Find one item by barcode or SKU"""
+    code = request.args.get('code', '').strip()
+    item = shared_catalog.lookup(code) if code else None
+    if item is None:
+        return jsonify({'error': 'Item not found'}), 404
+    return jsonify(with_stock([item])[0])
+
+# What a catalog search result carries: the catalog's columns plus remaining stock
+ITEM_SEARCH_FIELDS = ('id', 'name', 'category', 'unit', 'sale_price', 'sku', 'barcode', 'stock')
+
+# API endpoint for the sales counter: item name / code search
+@app.route("/api/items/search", methods=["GET"])
+def api_items_search():
+    """Search items by name, SKU or barcode"""
+    query = request.args.get('q', '').strip()
+    try:
+        names = parse_fields(request.args.get('fields'), ITEM_SEARCH_FIELDS)
+    except ValueError as e:
+        return fields_error(e)
+    if not query:
+        return jsonify([])
+    matches = shared_catalog.search(query)
+    # Remaining stock costs a query; skip it when not asked for
+    if 'stock' in names:
+        matches = with_stock(matches)
+    return jsonify([{name: match[name] for name in names} for match in matches])
 
 # API endpoint to create customer (for inline add)
 @app.route("/api/customers", methods=["POST"])
@@ -267,14 +3352,22 @@ def api_create_customer():
     if not data or not data.get('name') or not data.get('phone'):
         return jsonify({'error': 'Name and phone are required'}), 400
     
+    phone_e164 = normalize_phone(data['phone'])
+    if phone_e164 is None:
+        return jsonify({'error': f'{data["phone"]} is not a valid phone number'}), 400
+
     # Check for duplicate phone
-    existing = Customer.query.filter_by(phone=data['phone']).first()
+    existing = Customer.query.filter_by(phone_e164=phone_e164).first()
     if existing:
         return jsonify({'error': f'Customer with phone {data["phone"]} already exists'}), 400
     
     customer = Customer(name=data['name'], phone=data['phone'])
     db.session.add(customer)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': f'Customer with phone {data["phone"]} already exists'}), 400
     
     return jsonify({
         'id': customer.id,
@@ -286,132 +3379,236 @@ def api_create_customer():
 def customer_detail(id):
     customer = Customer.query.get_or_404(id)
 
-    # Get all credit sales for this customer (exclude cash sales)
-    all_sales = Sale.query.filter(
-        Sale.customer_id == id
-    ).order_by(Sale.date.desc()).all()
+    # Get all credit sales for this customer (exclude cash sales), archived ones included
+    all_sales = detail_sales(lambda model: (model.customer_id == id,))
 
     # Calculations for all time
+    payments = Payment.query.filter_by(customer_id=id).order_by(Payment.date.desc()).all()
+
     total_bill = sum(s.total_price for s in all_sales)
     total_paid = sum(s.paid_amount for s in all_sales)
-    balance = total_bill - total_paid
+    # Money paid in advance isn't on any sale yet but still settles the account
+    advance = sum(p.unallocated_amount or 0 for p in payments)
+    balance = total_bill - total_paid - advance
 
     return render_template(
         "customer_detail.html",
         customer=customer,
         sales=all_sales,
+        payments=payments,
         total_bill=total_bill,
         total_paid=total_paid,
+        advance=advance,
         balance=balance
     )
 
-@app.route("/customer-bills")
-def customer_bills():
-    customers = Customer.query.all()
+def allocate_payment(payment):
+    """Apply a payment to the customer's open sales, oldest first (FIFO); returns sales settled."""
+    remaining = payment.amount
+    sale_updates = []
 
-    now = datetime.now()
-    this_month = now.month
-    this_year = now.year
+    open_sales = db.session.execute(
+        db.select(Sale.id, Sale.total_price, Sale.paid_amount)
+        .where(
+            Sale.customer_id == payment.customer_id,
+            Sale.paid_amount < Sale.total_price
+        )
+        .order_by(Sale.date, Sale.id)
+        .with_for_update()
+        .execution_options(yield_per=100)
+    )
+    for sale_id, total_price, paid_amount in open_sales:
+        if remaining <= 0.005:
+            break
+        applied = round(min(remaining, total_price - paid_amount), 2)
+        remaining = round(remaining - applied, 2)
+        sale_updates.append({'id': sale_id, 'paid_amount': paid_amount + applied})
+        db.session.add(PaymentAllocation(payment=payment, sale_id=sale_id, amount=applied))
+    open_sales.close()
 
-    # Last month handling (January edge case)
-    if this_month == 1:
-        last_month = 12
-        last_year = this_year - 1
-    else:
-        last_month = this_month - 1
-        last_year = this_year
+    if sale_updates:
+        db.session.execute(db.update(Sale), sale_updates)
+    # Bulk UPDATEs bypass flush events, so tell the dashboard directly; any
+    # advance left over comes off the outstanding total too
+    db.session.info.setdefault('metric_changes', []).append(('payment', 1, payment.amount))
 
-    customer_data = []
+    payment.unallocated_amount = max(0.0, remaining)
+    return len(sale_updates)
 
-    for c in customers:
-        # This month sales
-        this_sales = Sale.query.filter(
-            Sale.customer_id == c.id,
-            extract('month', Sale.date) == this_month,
-            extract('year', Sale.date) == this_year
-        ).all()
+# Receive a payment from a credit customer
+@app.route("/customer/<int:id>/receive-payment", methods=["POST"])
+def receive_payment(id):
+    customer = Customer.query.get_or_404(id)
+
+    try:
+        amount = round(float(request.form.get("amount", 0)), 2)
+    except ValueError:
+        flash("Invalid payment amount", "error")
+        return redirect(url_for("customer_detail", id=id))
 
-        this_total = sum(s.total_price for s in this_sales)
-        this_paid = sum(s.paid_amount for s in this_sales)
-        this_unpaid = this_total - this_paid
+    if amount <= 0:
+        flash("Payment amount must be greater than zero", "error")
+        return redirect(url_for("customer_detail", id=id))
 
-        # Last month sales
-        last_sales = Sale.query.filter(
-            Sale.customer_id == c.id,
-            extract('month', Sale.date) == last_month,
-            extract('year', Sale.date) == last_year
-        ).all()
+    payment = Payment(customer_id=customer.id, amount=amount, notes=request.form.get("notes", ""))
+    db.session.add(payment)
+    try:
+        settled = allocate_payment(payment)
+        db.session.flush()
+        record_event(
+            'payment_received', occurred_at=payment.date, entity_id=payment.id,
+            customer_id=customer.id, balance_delta=-amount,
+            sales_settled=settled
+        )
+        db.session.commit()
+        logger.info(f"✓ Payment received: Customer {id}, Rs {amount}, {settled} sale(s)")
+    except Exception as db_error:
+        db.session.rollback()
+        logger.error(f"✗ Error saving payment: {db_error}", exc_info=True)
+        flash(f"Database error while saving payment: {str(db_error)}", "error")
+        return redirect(url_for("customer_detail", id=id))
+
+    message = f"Payment of Rs {amount:.2f} applied to {settled} sale(s)"
+    if payment.unallocated_amount:
+        message += f", Rs {payment.unallocated_amount:.2f} kept as advance"
+    flash(message, "success")
+    return redirect(url_for("customer_detail", id=id))
+
+# Set or clear a customer's credit limit
+@app.route("/customer/<int:id>/credit-limit", methods=["POST"])
+def set_credit_limit(id):
+    customer = Customer.query.get_or_404(id)
+
+    value = request.form.get("credit_limit", "").strip()
+    try:
+        credit_limit = round(float(value), 2) if value else None
+    except ValueError:
+        flash("Invalid credit limit", "error")
+        return redirect(url_for("customer_detail", id=id))
+
+    if credit_limit is not None and credit_limit < 0:
+        flash("Credit limit cannot be negative", "error")
+        return redirect(url_for("customer_detail", id=id))
 
-        last_total = sum(s.total_price for s in last_sales)
-        last_paid = sum(s.paid_amount for s in last_sales)
-        last_unpaid = last_total - last_paid
+    customer.credit_limit = credit_limit
+    try:
+        db.session.commit()
+        logger.info(f"✓ Credit limit for customer {id}: {credit_limit}")
+    except Exception as db_error:
+        db.session.rollback()
+        logger.error(f"✗ Error saving credit limit: {db_error}", exc_info=True)
+        flash(f"Database error while saving credit limit: {str(db_error)}", "error")
+        return redirect(url_for("customer_detail", id=id))
+
+    if credit_limit is None:
+        flash(f"Credit limit removed for {customer.name}", "success")
+    else:
+        flash(f"Credit limit for {customer.name} set to Rs {credit_limit:.2f}", "success")
+    return redirect(url_for("customer_detail", id=id))
+
+def customer_month_totals(all_time=False):
+    """Per-customer billed and paid totals for this and last shop month."""
+    this_month, next_month = month_range(shop_today())
+    last_month, _ = month_range(this_month, -1)
+    in_this = db.and_(Sale.business_date >= this_month, Sale.business_date < next_month)
+    in_last = db.and_(Sale.business_date >= last_month, Sale.business_date < this_month)
+    paid = db.func.coalesce(Sale.paid_amount, 0)
+
+    query = db.select(
+        Sale.customer_id,
+        db.func.sum(db.case((in_this, Sale.total_price), else_=0)),
+        db.func.sum(db.case((in_this, paid), else_=0)),
+        db.func.sum(db.case((in_last, Sale.total_price), else_=0)),
+        db.func.sum(db.case((in_last, paid), else_=0)),
+        db.func.sum(Sale.total_price),
+        db.func.sum(paid)
+    ).where(Sale.customer_id.isnot(None)).group_by(Sale.customer_id)
+    if not all_time:
+        query = query.where(Sale.business_date >= last_month, Sale.business_date < next_month)
+
+    keys = ('this_total', 'this_paid', 'last_total', 'last_paid', 'all_total', 'all_paid')
+    return {
+        customer_id: dict(zip(keys, (value or 0 for value in values)))
+        for customer_id, *values in db.session.execute(query)
+    }
 
+@app.route("/customer-bills")
+def customer_bills():
+    customers = Customer.query.all()
+    totals = customer_month_totals()
+    empty = dict.fromkeys(('this_total', 'this_paid', 'last_total', 'last_paid'), 0)
+
+    customer_data = []
+    for c in customers:
+        t = totals.get(c.id, empty)
         customer_data.append({
             "customer": c,
-            "this_total": this_total,
-            "this_paid": this_paid,
-            "this_unpaid": this_unpaid,
-            "last_total": last_total,
-            "last_paid": last_paid,
-            "last_unpaid": last_unpaid
+            "this_total": t['this_total'],
+            "this_paid": t['this_paid'],
+            "this_unpaid": t['this_total'] - t['this_paid'],
+            "last_total": t['last_total'],
+            "last_paid": t['last_paid'],
+            "last_unpaid": t['last_total'] - t['last_paid']
         })
 
     return render_template("customer_bills.html", customer_data=customer_data)
 
 @app.route('/customers/summary')
 def customer_summary():
-    today = date.today()
-    this_month = today.month
-    this_year = today.year
-
-    # calculate last month properly
-    if this_month == 1:
-        last_month = 12
-        last_year = this_year - 1
-    else:
-        last_month = this_month - 1
-        last_year = this_year
-
     customers = Customer.query.all()
-    summary = []
+    totals = customer_month_totals(all_time=True)
+    advances = dict(db.session.execute(
+        db.select(Payment.customer_id, db.func.sum(Payment.unallocated_amount))
+        .where(Payment.unallocated_amount > 0).group_by(Payment.customer_id)
+    ).all())
+    empty = dict.fromkeys(('this_total', 'this_paid', 'last_total', 'last_paid', 'all_total', 'all_paid'), 0)
 
+    summary = []
     for customer in customers:
-        # THIS MONTH
-        this_month_sales = Sale.query.filter(
-            Sale.customer_id == customer.id,
-            extract('month', Sale.date) == this_month,
-            extract('year', Sale.date) == this_year
-        ).all()
-
-        this_month_total = sum(s.total_price for s in this_month_sales)
-        this_month_paid = sum(s.paid_amount for s in this_month_sales)
-
-        # LAST MONTH
-        last_month_sales = Sale.query.filter(
-            Sale.customer_id == customer.id,
-            extract('month', Sale.date) == last_month,
-            extract('year', Sale.date) == last_year
-        ).all()
-
-        last_month_total = sum(s.total_price for s in last_month_sales)
-        last_month_paid = sum(s.paid_amount for s in last_month_sales)
-
-        # ALL TIME
-        all_sales = Sale.query.filter_by(customer_id=customer.id).all()
-        total_bill = sum(s.total_price for s in all_sales)
-        total_paid = sum(s.paid_amount for s in all_sales)
-
+        t = totals.get(customer.id, empty)
         summary.append({
             "customer": customer.name,
-            "this_month_bill": this_month_total,
-            "this_month_unpaid": this_month_total - this_month_paid,
-            "last_month_bill": last_month_total,
-            "last_month_unpaid": last_month_total - last_month_paid,
-            "total_unpaid": total_bill - total_paid
+            "this_month_bill": t['this_total'],
+            "this_month_unpaid": t['this_total'] - t['this_paid'],
+            "last_month_bill": t['last_total'],
+            "last_month_unpaid": t['last_total'] - t['last_paid'],
+            "total_unpaid": t['all_total'] - t['all_paid'] - (advances.get(customer.id) or 0)
         })
 
     return render_template("customer_summary.html", summary=summary)
 
+# Customers near or over their credit limit, and sales recorded over it
+@app.route('/customers/credit')
+def credit_limits():
+    return render_template(
+        "credit_limits.html",
+        customers=customers_near_limit(),
+        pending=pending_limit_reviews(),
+        overrides=credit_limit_overrides(),
+        warn_ratio=CREDIT_LIMIT_WARN_RATIO
+    )
+
+# Give an offline sale that went over the limit its override reason
+@app.route('/customers/credit/review/<int:sale_id>', methods=["POST"])
+def review_credit_override(sale_id):
+    reason = request.form.get("reason", "").strip()
+    if not reason:
+        flash("Enter a reason to approve the sale", "error")
+        return redirect(url_for("credit_limits"))
+
+    pending = LedgerEvent.query.filter_by(event_type='offline_sale_over_limit', entity_id=sale_id).first_or_404()
+    approved = LedgerEvent.query.filter_by(event_type='credit_limit_overridden', entity_id=sale_id).first()
+    if approved is None:
+        data = json.loads(pending.data or '{}')
+        record_event(
+            'credit_limit_overridden', occurred_at=pending.occurred_at, entity_id=sale_id,
+            customer_id=pending.customer_id, reason=reason, reviewed=True, **data
+        )
+        db.session.commit()
+        logger.info(f"✓ Credit limit override approved for sale {sale_id}")
+    flash(f"Sale #{sale_id} approved", "success")
+    return redirect(url_for("credit_limits"))
+
 # Items page
 @app.route("/items", methods=["GET", "POST"])
 def items():
@@ -422,6 +3619,9 @@ def items():
         purchase_price = request.form.get("purchase_price")
         sale_price = request.form.get("sale_price")
         stock_quantity = request.form.get("stock_quantity")
+        # Blank codes are stored as NULL so they don't collide; SKUs in upper case
+        sku = (request.form.get("sku") or "").strip().upper() or None
+        barcode = (request.form.get("barcode") or "").strip() or None
 
         # Convert prices to float safely
         try:
@@ -433,15 +3633,28 @@ def items():
             sale_price = 0.0
             stock_quantity = 0.0
 
-        db.session.add(Item(
+        item = Item(
             name=name,
             category=category,
             unit=unit,
             purchase_price=purchase_price,
             sale_price=sale_price,
-            stock_quantity=stock_quantity
-        ))
-        db.session.commit()
+            stock_quantity=stock_quantity,
+            sku=sku,
+            barcode=barcode
+        )
+        try:
+            db.session.add(item)
+            db.session.flush()
+            # Opening stock is valued at the purchase price entered here
+            add_cost_layer(item, stock_quantity, purchase_price)
+            if stock_quantity:
+                record_event('opening_stock', entity_id=item.id, item_id=item.id, quantity_delta=stock_quantity)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash("That SKU or barcode is already used by another item", "error")
+            return redirect(url_for("items"))
         flash("Item added successfully", "success")
         return redirect(url_for("items"))
     all_items = Item.query.all()
@@ -449,35 +3662,41 @@ def items():
 
 @app.route('/stock')
 def stock():
-    items = Item.query.all()
+    # Items from the shared catalog; sold totals in one grouped query
+    sold = dict(db.session.execute(
+        db.select(Sale.item_id, db.func.sum(Sale.quantity)).group_by(Sale.item_id)
+    ).all())
     stock_data = []
 
-    for item in items:
-        sold_qty = db.session.query(
-            db.func.sum(Sale.quantity)
-        ).filter(Sale.item_id == item.id).scalar() or 0
+    for item in shared_catalog.items():
+        sold_qty = sold.get(item['id']) or 0
+        purchased = item['stock_quantity'] or 0
 
         # Calculate remaining stock
-        remaining = item.stock_quantity - sold_qty
+        remaining = purchased - sold_qty
         if remaining < 0:
             remaining = 0
 
         stock_data.append({
-            "name": item.name,
-            "purchased": item.stock_quantity,
+            "name": item['name'],
+            "purchased": purchased,
             "sold": sold_qty,
             "remaining": remaining,
-            "unit": item.unit
+            "unit": item['unit']
         })
 
-    return render_template("stock.html", stock_data=stock_data)
+    return render_template("stock.html", stock_data=stock_data, alerts=current_stock_alerts())
+
+# API endpoint for reorder alerts
+@app.route("/api/stock/alerts", methods=["GET"])
+def api_stock_alerts():
+    """Items at or below their reorder point, with a suggested order"""
+    return jsonify(current_stock_alerts())
 
 # Add Sale page
 @app.route("/add-sale", methods=["GET", "POST"])
 def add_sale():
-    customers = Customer.query.all()
-    items = Item.query.all()
-
+    # Items and customers are looked up on demand through the API
     if request.method == "POST":
         try:
             sale_type = request.form.get("sale_type")  # "cash" or "credit"
@@ -493,17 +3712,9 @@ def add_sale():
 
             # Get item and check stock
             item = Item.query.get_or_404(item_id)
-            
-            # Calculate sold quantity so far
-            sold_qty = db.session.query(
-                db.func.sum(Sale.quantity)
-            ).filter(Sale.item_id == item_id).scalar() or 0
-            
-            available_stock = item.stock_quantity - sold_qty
-            
-            # Check if stock is sufficient
-            if quantity > available_stock:
-                flash(f"Insufficient stock. Available: {available_stock} {item.unit}", "error")
+            stock_left = available_stock(item)
+            if quantity > stock_left:
+                flash(f"Insufficient stock. Available: {stock_left} {item.unit}", "error")
                 return redirect(url_for("add_sale"))
 
             total_price = quantity * unit_price
@@ -525,16 +3736,19 @@ def add_sale():
                 # Cash sale - paid amount must equal total
                 paid_amount = total_price
 
-            sale = Sale(
-                customer_id=customer_id,
-                item_id=item_id,
-                quantity=quantity,
-                unit_price=unit_price,
-                total_price=total_price,
-                paid_amount=paid_amount
-            )
+            breach = credit_limit_breach(customer_id, total_price - paid_amount) if customer_id else None
+            override_reason = request.form.get("override_reason", "").strip()
+            if breach and not override_reason:
+                db.session.rollback()
+                balance, credit_limit = breach
+                flash(
+                    f"Credit limit exceeded: balance Rs {balance:.2f} plus Rs {total_price - paid_amount:.2f} "
+                    f"on this sale is over the limit of Rs {credit_limit:.2f}. "
+                    "Enter an override reason to record it anyway.", "error"
+                )
+                return redirect(url_for("add_sale"))
 
-            db.session.add(sale)
+            sale = record_sale(item, customer_id, quantity, unit_price, paid_amount, breach, override_reason)
             try:
                 db.session.commit()
                 logger.info(f"✓ Sale created successfully: Item {item_id}, Qty {quantity}")
@@ -560,11 +3774,64 @@ def add_sale():
             flash(f"An unexpected error occurred: {str(e)}", "error")
             return redirect(url_for("add_sale"))
 
-    return render_template(
-        "add_sale.html",
-        customers=customers,
-        items=items
-    )
+    return render_template("add_sale.html")
+
+# API endpoint for sales made offline and queued by the PWA
+@app.route("/api/offline-sales", methods=["POST"])
+def api_offline_sale():
+    """Record a queued offline sale once per client_id; a 4xx answer won't change on retry"""
+    data = request.get_json(silent=True) or {}
+    client_id = str(data.get('client_id') or '').strip()
+    if not client_id or len(client_id) > 64:
+        return jsonify({'error': 'client_id is required (at most 64 characters)'}), 400
+    synced = db.session.get(OfflineSale, client_id)
+    if synced:
+        return jsonify({'sale_id': synced.sale_id, 'duplicate': True})
+
+    try:
+        item_id = int(data['item_id'])
+        quantity = float(data['quantity'])
+        unit_price = float(data['unit_price'])
+        paid_amount = float(data.get('paid_amount') or 0)
+        customer_id = int(data['customer_id']) if data.get('sale_type', 'credit') == 'credit' else None
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Invalid sale: item, quantity, price and (for credit) customer are required'}), 400
+
+    item = db.session.get(Item, item_id)
+    if item is None:
+        return jsonify({'error': 'Item not found'}), 404
+    if customer_id is not None and db.session.get(Customer, customer_id) is None:
+        return jsonify({'error': 'Customer not found'}), 404
+    stock_left = available_stock(item)
+    if quantity > stock_left:
+        return jsonify({'error': f"Insufficient stock for {item.name}. Available: {stock_left} {item.unit}"}), 409
+
+    total_price = quantity * unit_price
+    if customer_id is None:
+        paid_amount = total_price
+    breach = credit_limit_breach(customer_id, total_price - paid_amount) if customer_id else None
+    queued_at = offline_queued_at(data.get('queued_at'))
+    if breach and queued_at is None:
+        db.session.rollback()
+        balance, credit_limit = breach
+        return jsonify({'error': (
+            f"Credit limit exceeded: balance Rs {balance:.2f} plus Rs {total_price - paid_amount:.2f} "
+            f"is over the limit of Rs {credit_limit:.2f}. Record it from the sale form with an override reason."
+        )}), 409
+
+    sale = record_sale(item, customer_id, quantity, unit_price, paid_amount, breach, queued_at=queued_at)
+    db.session.add(OfflineSale(client_id=client_id, sale_id=sale.id))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # The same queued sale arrived twice at once; the other request kept it
+        db.session.rollback()
+        synced = db.session.get(OfflineSale, client_id)
+        if synced is None:
+            raise
+        return jsonify({'sale_id': synced.sale_id, 'duplicate': True})
+    logger.info(f"✓ Offline sale synced: Item {item_id}, Qty {quantity}")
+    return jsonify({'sale_id': sale.id, 'pending_review': bool(breach)}), 201
 
 # Daily Sales page
 @app.route("/sales")
@@ -575,18 +3842,12 @@ def sales():
         try:
             selected_date = datetime.strptime(date_str, "%Y-%m-%d").date()
         except ValueError:
-            selected_date = date.today()
+            selected_date = shop_today()
     else:
-        selected_date = date.today()
+        selected_date = shop_today()
 
-    # Get all sales for the selected date
-    start_datetime = datetime.combine(selected_date, datetime.min.time())
-    end_datetime = datetime.combine(selected_date, datetime.max.time())
-    
-    daily_sales = Sale.query.filter(
-        Sale.date >= start_datetime,
-        Sale.date <= end_datetime
-    ).order_by(Sale.date.desc()).all()
+    # Get all sales for the selected shop day
+    daily_sales = detail_sales(lambda model: (model.business_date == selected_date,))
 
     # Calculate summaries
     total_sales = sum(s.total_price for s in daily_sales)
@@ -605,6 +3866,27 @@ def sales():
 @app.route("/delete-sale/<int:id>")
 def delete_sale(id):
     sale = Sale.query.get_or_404(id)
+    if sale.archived_count is not None:
+        flash("This row stands in for archived sales and can't be deleted.", "error")
+        return redirect(url_for("sales"))
+    # Money received against this sale goes back to the payment as advance
+    allocated = 0.0
+    for allocation in sale.allocations:
+        payment = allocation.payment
+        payment.unallocated_amount = (payment.unallocated_amount or 0) + allocation.amount
+        allocated += allocation.amount
+    if allocated:
+        db.session.info.setdefault('metric_changes', []).append(('payment', 1, allocated))
+    restore_cost_layers(sale)
+    # Reverses what the sale added; paid_at_sale excludes later payments,
+    # which stay on the customer's account as advance
+    paid_at_sale = (sale.paid_amount or 0) - allocated
+    record_event(
+        'sale_deleted', entity_id=sale.id, customer_id=sale.customer_id, item_id=sale.item_id,
+        balance_delta=-(sale.total_price - paid_at_sale) if sale.customer_id else 0.0,
+        quantity_delta=sale.quantity,
+        sale_date=sale.date, total_price=sale.total_price
+    )
     db.session.delete(sale)
     db.session.commit()
     flash("Sale deleted successfully", "success")
@@ -613,8 +3895,17 @@ def delete_sale(id):
 @app.route("/delete-customer/<int:id>")
 def delete_customer(id):
     customer = Customer.query.get_or_404(id)
+    # Sales and payments are the customer's account history; they are never dropped
+    has_history = db.session.execute(db.select(
+        db.select(Sale.id).where(Sale.customer_id == id).exists()
+        | db.select(Payment.id).where(Payment.customer_id == id).exists()
+    )).scalar()
+    if has_history:
+        flash(f"{customer.name} has sales or payments and can't be deleted", "error")
+        return redirect(url_for("customer_detail", id=id))
     db.session.delete(customer)
     db.session.commit()
+    flash("Customer deleted successfully", "success")
     return redirect(url_for("customers"))
 
 @app.route("/delete-item/<int:id>")
@@ -629,6 +3920,10 @@ def delete_item(id):
 # WHOLESALER TRANSACTIONS ROUTES
 # ============================================
 
+def find_item_by_name(item_name):
+    """Case-insensitive Item lookup for purchases that name an item."""
+    return Item.query.filter(db.func.lower(Item.name) == item_name.strip().lower()).first()
+
 # Wholesaler Transactions page
 @app.route("/wholesaler-transactions", methods=["GET", "POST"])
 def wholesaler_transactions():
@@ -790,8 +4085,16 @@ def wholesaler_transactions():
         total_price = quantity * price_per_unit
 
         # Ensure corresponding Item exists and update stock_quantity
-        # Try to match item by case-insensitive name
-        item = Item.query.filter(db.func.lower(Item.name) == item_name.strip().lower()).first()
+        # Use the picked item if the form sent one, otherwise match by name
+        item = None
+        item_id_raw = request.form.get("item_id")
+        if item_id_raw:
+            try:
+                item = db.session.get(Item, int(item_id_raw))
+            except (ValueError, TypeError):
+                item = None
+        if item is None:
+            item = find_item_by_name(item_name)
         if item:
             # Update purchase price to latest wholesaler price
             item.purchase_price = price_per_unit
@@ -809,7 +4112,7 @@ def wholesaler_transactions():
             db.session.add(item)
         else:
             # Create a new Item using wholesaler data
-            new_item = Item(
+            item = Item(
                 name=item_name,
                 category=category or None,
                 unit=unit or None,
@@ -817,11 +4120,12 @@ def wholesaler_transactions():
                 sale_price=price_per_unit,
                 stock_quantity=quantity
             )
-            db.session.add(new_item)
+            db.session.add(item)
 
         # Create and save the wholesaler transaction
         transaction = WholesalerTransaction(
             wholesaler_id=wholesaler_id,
+            item=item,
             item_name=item_name,
             category=category or None,
             unit=unit or None,
@@ -833,12 +4137,102 @@ def wholesaler_transactions():
         )
 
         db.session.add(transaction)
+        db.session.flush()
+        add_cost_layer(item, quantity, price_per_unit, transaction, transaction.date)
+        record_event(
+            'purchase_recorded', occurred_at=transaction.date, entity_id=transaction.id,
+            item_id=item.id, wholesaler_id=wholesaler_id,
+            quantity_delta=quantity, payable_delta=total_price - paid_amount,
+            price_per_unit=price_per_unit
+        )
         db.session.commit()
         flash("Transaction added successfully", "success")
         return redirect(url_for("wholesaler_transactions"))
     
     return render_template("wholesaler_transactions.html", wholesalers=wholesalers)
 
+# Multi-line purchase bill (a whole delivery in one form)
+@app.route("/purchase-bill", methods=["GET", "POST"])
+def purchase_bill():
+    """Record a supplier delivery: one bill, many lines, one commit."""
+    if request.method == "GET":
+        return render_template("purchase_bill.html", today=shop_today())
+
+    try:
+        wholesaler_id = int(request.form.get("wholesaler_id") or 0)
+    except ValueError:
+        wholesaler_id = 0
+    if not wholesaler_id or db.session.get(Wholesaler, wholesaler_id) is None:
+        flash("Please select or add a wholesaler", "error")
+        return redirect(url_for("purchase_bill"))
+
+    lines = []
+    fields = ("item_name", "item_id", "category", "unit", "quantity", "price_per_unit")
+    columns = zip_longest(*(request.form.getlist(field) for field in fields), fillvalue="")
+    for number, (item_name, item_id, category, unit, quantity, price_per_unit) in enumerate(columns, start=1):
+        item_name = item_name.strip()
+        if not (item_name or quantity or price_per_unit):
+            continue  # blank row
+        try:
+            quantity, price_per_unit = float(quantity), float(price_per_unit)
+        except ValueError:
+            quantity = price_per_unit = 0
+        if not item_name or quantity <= 0 or price_per_unit <= 0:
+            flash(f"Line {number}: item name, quantity and price are required", "error")
+            return redirect(url_for("purchase_bill"))
+        lines.append({
+            'item_name': item_name, 'item_id': int(item_id) if item_id.isdigit() else None,
+            'category': category.strip(), 'unit': unit.strip(),
+            'quantity': quantity, 'price_per_unit': price_per_unit,
+        })
+    if not lines:
+        flash("Add at least one line to the bill", "error")
+        return redirect(url_for("purchase_bill"))
+    try:
+        paid_amount = float(request.form.get("paid_amount") or 0)
+    except ValueError:
+        paid_amount = -1
+    if paid_amount < 0:
+        flash("Invalid paid amount value", "error")
+        return redirect(url_for("purchase_bill"))
+
+    when = datetime.utcnow()
+    date_str = request.form.get("date")
+    if date_str:
+        try:
+            bill_day = datetime.strptime(date_str, "%Y-%m-%d")
+        except ValueError:
+            flash("Invalid date format", "error")
+            return redirect(url_for("purchase_bill"))
+        # Backdated bills start at the shop's midnight of that day
+        if bill_day.date() != shop_today():
+            when = shop_to_utc(bill_day)
+
+    # The amount paid on the bill settles its lines in order; any extra stays
+    # on the last line, as it would on a single purchase
+    remaining_paid = paid_amount
+    for line in lines:
+        line['paid_amount'] = min(remaining_paid, line['quantity'] * line['price_per_unit'])
+        remaining_paid -= line['paid_amount']
+    lines[-1]['paid_amount'] += remaining_paid
+
+    bill = PurchaseBill(
+        wholesaler_id=wholesaler_id, reference=request.form.get("reference", "").strip() or None,
+        date=when, notes=request.form.get("notes", "").strip() or None
+    )
+    try:
+        bill_total = record_purchase_bill(bill, lines)
+        db.session.commit()
+        logger.info(f"✓ Purchase bill {bill.id} saved: {len(lines)} lines, Rs {bill_total:.2f}")
+    except Exception as db_error:
+        db.session.rollback()
+        logger.error(f"✗ Error saving purchase bill: {db_error}", exc_info=True)
+        flash(f"Database error while saving bill: {str(db_error)}", "error")
+        return redirect(url_for("purchase_bill"))
+
+    flash(f"Bill {bill.reference or '#' + str(bill.id)} recorded: {len(lines)} lines, Rs {bill_total:.2f}", "success")
+    return redirect(url_for("wholesaler_detail", id=wholesaler_id))
+
 # Get Wholesaler Detail
 @app.route("/wholesaler/<int:id>")
 def wholesaler_detail(id):
@@ -882,14 +4276,23 @@ def wholesalers():
         
         # Check for duplicate phone
         if phone:
-            existing = Wholesaler.query.filter_by(phone=phone).first()
+            phone_e164 = normalize_phone(phone)
+            if phone_e164 is None:
+                flash(f"{phone} is not a valid phone number", "error")
+                return redirect(url_for("wholesalers"))
+            existing = Wholesaler.query.filter_by(phone_e164=phone_e164).first()
             if existing:
                 flash(f"Wholesaler with phone {phone} already exists", "error")
                 return redirect(url_for("wholesalers"))
         
         wholesaler = Wholesaler(name=name, phone=phone, address=address)
         db.session.add(wholesaler)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash(f"Wholesaler with phone {phone} already exists", "error")
+            return redirect(url_for("wholesalers"))
         flash("Wholesaler added successfully", "success")
         return redirect(url_for("wholesalers"))
     
@@ -911,15 +4314,24 @@ def edit_wholesaler(id):
 
     # Check for duplicate phone (if changed)
     if phone and phone != wholesaler.phone:
-        existing = Wholesaler.query.filter_by(phone=phone).first()
-        if existing:
+        phone_e164 = normalize_phone(phone)
+        if phone_e164 is None:
+            flash(f'{phone} is not a valid phone number', 'error')
+            return redirect(url_for('wholesaler_detail', id=id))
+        existing = Wholesaler.query.filter_by(phone_e164=phone_e164).first()
+        if existing and existing.id != id:
             flash(f'Wholesaler with phone {phone} already exists', 'error')
             return redirect(url_for('wholesaler_detail', id=id))
 
     wholesaler.name = name
     wholesaler.phone = phone
     wholesaler.address = address
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        flash(f'Wholesaler with phone {phone} already exists', 'error')
+        return redirect(url_for('wholesaler_detail', id=id))
     flash('Wholesaler details updated successfully', 'success')
     return redirect(url_for('wholesaler_detail', id=id))
 
@@ -934,7 +4346,10 @@ def api_create_wholesaler():
     
     # Check for duplicate phone
     if data.get('phone'):
-        existing = Wholesaler.query.filter_by(phone=data['phone']).first()
+        phone_e164 = normalize_phone(data['phone'])
+        if phone_e164 is None:
+            return jsonify({'error': f'{data["phone"]} is not a valid phone number'}), 400
+        existing = Wholesaler.query.filter_by(phone_e164=phone_e164).first()
         if existing:
             return jsonify({'error': f'Wholesaler with phone {data["phone"]} already exists'}), 400
     
@@ -944,7 +4359,11 @@ def api_create_wholesaler():
         address=data.get('address', '')
     )
     db.session.add(wholesaler)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': f'Wholesaler with phone {data["phone"]} already exists'}), 400
     
     return jsonify({
         'id': wholesaler.id,
@@ -957,42 +4376,64 @@ def api_create_wholesaler():
 @app.route("/api/wholesalers", methods=["GET"])
 def api_wholesalers():
     """Get all wholesalers as JSON"""
-    wholesalers = Wholesaler.query.all()
-    return jsonify([{
-        'id': w.id,
-        'name': w.name,
-        'phone': w.phone,
-        'address': w.address
-    } for w in wholesalers])
+    try:
+        return jsonify(field_rows('wholesalers', request.args.get('fields')))
+    except ValueError as e:
+        return fields_error(e)
 
 # API endpoint to search wholesalers
 @app.route("/api/wholesalers/search", methods=["GET"])
 def api_wholesalers_search():
     """Search wholesalers by name or phone"""
     query = request.args.get('q', '').strip()
-    
+    try:
+        names = parse_fields(request.args.get('fields'), API_FIELDS['wholesalers'])
+    except ValueError as e:
+        return fields_error(e)
+
     if not query or len(query) < 1:
         return jsonify([])
-    
-    query_lower = query.lower()
-    wholesalers = Wholesaler.query.filter(
-        db.or_(
-            db.func.lower(Wholesaler.name).like(f'%{query_lower}%'),
-            Wholesaler.phone.like(f'%{query}%')
+
+    limited = rate_limited_response()
+    if limited is not None:
+        return limited
+
+    results = search_wholesalers(query)
+    return jsonify([{name: result[name] for name in names} for result in results])
+
+def search_wholesalers(query):
+    """Wholesalers matching query, first SEARCH_RESULT_LIMIT by id, through the coalescer."""
+    def fetch(limit):
+        query_lower = query.lower()
+        rows = db.session.execute(
+            db.select(Wholesaler.id, Wholesaler.name, Wholesaler.phone, Wholesaler.address).where(
+                db.or_(
+                    db.func.lower(Wholesaler.name).like(f'%{query_lower}%'),
+                    Wholesaler.phone.like(f'%{query}%')
+                )
+            ).order_by(Wholesaler.id).limit(limit)
         )
-    ).limit(10).all()
-    
-    return jsonify([{
-        'id': w.id,
-        'name': w.name,
-        'phone': w.phone,
-        'address': w.address
-    } for w in wholesalers])
+        return [{'id': w.id, 'name': w.name, 'phone': w.phone, 'address': w.address} for w in rows]
+
+    return search_coalescer.search('wholesalers', query, fetch)
 
 # Delete Wholesaler
 @app.route("/delete-wholesaler/<int:id>")
 def delete_wholesaler(id):
     wholesaler = Wholesaler.query.get_or_404(id)
+    ItemReorderState.query.filter_by(last_wholesaler_id=id).update(
+        {'last_wholesaler_id': None}, synchronize_session=False
+    )
+    # Purchased stock stays on the shelf; only the link to the purchase goes
+    for transaction in wholesaler.transactions:
+        CostLayer.query.filter_by(wholesaler_transaction_id=transaction.id).update(
+            {'wholesaler_transaction_id': None, 'source': 'retained'}, synchronize_session=False
+        )
+        # Only the payable is reversed; the stock was bought and is kept
+        record_event(
+            'wholesaler_deleted', entity_id=transaction.id, item_id=transaction.item_id,
+            wholesaler_id=id, payable_delta=-(transaction.total_price - (transaction.paid_amount or 0))
+        )
     db.session.delete(wholesaler)
     db.session.commit()
     flash("Wholesaler deleted successfully", "success")
@@ -1004,10 +4445,16 @@ def delete_wholesaler_transaction(id):
     transaction = WholesalerTransaction.query.get_or_404(id)
     wholesaler_id = transaction.wholesaler_id
     # Adjust Item stock to reflect deletion of this purchase
-    item = Item.query.filter(db.func.lower(Item.name) == transaction.item_name.strip().lower()).first()
+    item = transaction.item
     if item:
         item.stock_quantity = max(0, (item.stock_quantity or 0) - transaction.quantity)
         db.session.add(item)
+    remove_purchase_cost_layer(transaction)
+    record_event(
+        'purchase_deleted', entity_id=transaction.id, item_id=transaction.item_id,
+        wholesaler_id=wholesaler_id, quantity_delta=-transaction.quantity,
+        payable_delta=-(transaction.total_price - (transaction.paid_amount or 0))
+    )
 
     db.session.delete(transaction)
     db.session.commit()
@@ -1021,6 +4468,8 @@ def edit_wholesaler_transaction(id):
     transaction = WholesalerTransaction.query.get_or_404(id)
     old_item_name = transaction.item_name
     old_quantity = transaction.quantity
+    old_item_id = transaction.item_id
+    old_payable = transaction.total_price - (transaction.paid_amount or 0)
     item_name = request.form.get('item_name')
     try:
         quantity = float(request.form.get('quantity', transaction.quantity))
@@ -1042,9 +4491,10 @@ def edit_wholesaler_transaction(id):
     date_str = request.form.get('date')
     if date_str:
         try:
-            # Convert to datetime (time defaults to 00:00)
+            # A shop-local day; a new day starts at its local midnight
             parsed_date = datetime.strptime(date_str, '%Y-%m-%d')
-            transaction.date = parsed_date
+            if parsed_date.date() != business_date_of(transaction.date):
+                transaction.date = shop_to_utc(parsed_date)
         except Exception:
             flash('Invalid date format', 'error')
             return redirect(url_for('wholesaler_detail', id=transaction.wholesaler_id))
@@ -1056,9 +4506,9 @@ def edit_wholesaler_transaction(id):
         return redirect(url_for('wholesaler_detail', id=transaction.wholesaler_id))
 
     # Adjust stock based on changes
-    # If item name unchanged, adjust by delta
+    # If item name unchanged, adjust the linked item by delta
     if item_name.strip().lower() == old_item_name.strip().lower():
-        item = Item.query.filter(db.func.lower(Item.name) == item_name.strip().lower()).first()
+        item = transaction.item or find_item_by_name(item_name)
         if item:
             delta = quantity - old_quantity
             item.stock_quantity = (item.stock_quantity or 0) + delta
@@ -1074,7 +4524,7 @@ def edit_wholesaler_transaction(id):
             db.session.add(item)
         else:
             # No existing item found; create one with the new quantity
-            created = Item(
+            item = Item(
                 name=item_name,
                 category=request.form.get('category') or None,
                 unit=request.form.get('unit') or None,
@@ -1082,15 +4532,16 @@ def edit_wholesaler_transaction(id):
                 sale_price=price_per_unit,
                 stock_quantity=quantity
             )
-            db.session.add(created)
+            db.session.add(item)
+        target_item = item
     else:
         # Item name changed: subtract from old item, add to (or create) new item
-        old_item = Item.query.filter(db.func.lower(Item.name) == old_item_name.strip().lower()).first()
+        old_item = transaction.item
         if old_item:
             old_item.stock_quantity = max(0, (old_item.stock_quantity or 0) - old_quantity)
             db.session.add(old_item)
 
-        new_item = Item.query.filter(db.func.lower(Item.name) == item_name.strip().lower()).first()
+        new_item = find_item_by_name(item_name)
         if new_item:
             new_item.stock_quantity = (new_item.stock_quantity or 0) + quantity
             new_item.purchase_price = price_per_unit
@@ -1103,7 +4554,7 @@ def edit_wholesaler_transaction(id):
                 new_item.unit = request.form.get('unit')
             db.session.add(new_item)
         else:
-            created = Item(
+            new_item = Item(
                 name=item_name,
                 category=request.form.get('category') or None,
                 unit=request.form.get('unit') or None,
@@ -1111,8 +4562,13 @@ def edit_wholesaler_transaction(id):
                 sale_price=price_per_unit,
                 stock_quantity=quantity
             )
-            db.session.add(created)
+            db.session.add(new_item)
+        target_item = new_item
+
+    db.session.flush()
+    update_purchase_cost_layer(transaction, target_item, quantity, price_per_unit)
 
+    transaction.item = target_item
     transaction.item_name = item_name
     transaction.category = request.form.get('category') or None
     transaction.unit = request.form.get('unit') or None
@@ -1122,14 +4578,190 @@ def edit_wholesaler_transaction(id):
     transaction.paid_amount = paid_amount
     transaction.notes = notes
 
+    payable_delta = (transaction.total_price - paid_amount) - old_payable
+    if old_item_id == target_item.id:
+        record_event(
+            'purchase_edited', entity_id=transaction.id, item_id=target_item.id,
+            wholesaler_id=transaction.wholesaler_id, quantity_delta=quantity - old_quantity,
+            payable_delta=payable_delta, price_per_unit=price_per_unit
+        )
+    else:
+        # Moved to another item: take the old quantity off the old item...
+        record_event(
+            'purchase_edited', entity_id=transaction.id, item_id=old_item_id,
+            wholesaler_id=transaction.wholesaler_id, quantity_delta=-old_quantity,
+            payable_delta=payable_delta, price_per_unit=price_per_unit
+        )
+        # ...and put the new quantity on the new one
+        record_event(
+            'purchase_edited', entity_id=transaction.id, item_id=target_item.id,
+            wholesaler_id=transaction.wholesaler_id, quantity_delta=quantity
+        )
+
     db.session.commit()
     flash('Transaction updated successfully', 'success')
     return redirect(url_for('wholesaler_detail', id=transaction.wholesaler_id))
 
+# API endpoint for point-in-time ledger state
+@app.route("/api/ledger/as-of", methods=["GET"])
+def api_ledger_as_of():
+    """Balances, stock and payables at the end of a date (snapshot + replay)"""
+    try:
+        as_of_date = datetime.strptime(request.args.get('date', ''), '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'error': 'date is required as YYYY-MM-DD'}), 400
+    as_of = shop_day_end_utc(as_of_date)
+    state = ledger_state_at(as_of)
+
+    for param, key in (('customer_id', 'customers'), ('item_id', 'items'), ('wholesaler_id', 'wholesalers')):
+        value = request.args.get(param)
+        if value:
+            state = {key: {value: state[key].get(value, 0.0)}}
+            break
+
+    journal_start = db.session.query(db.func.min(LedgerSnapshot.as_of)).scalar()
+    return jsonify({
+        'as_of': as_of.isoformat(),
+        'journal_started_at': journal_start.isoformat() if journal_start else None,
+        **state
+    })
+
+def _end_of_date_param():
+    try:
+        return shop_day_end_utc(datetime.strptime(request.args.get('date', ''), '%Y-%m-%d').date())
+    except ValueError:
+        return None
+
+# API endpoint for historical prices (price history intervals)
+@app.route("/api/items/prices", methods=["GET"])
+def api_item_prices():
+    """Purchase/sale prices at the end of a date, for one item, some, or all"""
+    as_of = _end_of_date_param()
+    if as_of is None:
+        return jsonify({'error': 'date is required as YYYY-MM-DD'}), 400
+    try:
+        item_id = request.args.get('item_id', type=int)
+        ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+    except ValueError:
+        return jsonify({'error': 'ids must be item ids separated by commas'}), 400
+
+    if item_id is not None:
+        price = price_as_of(item_id, as_of)
+        if price is None:
+            return jsonify({'error': 'No price recorded for this item at that date'}), 404
+        return jsonify({'as_of': as_of.isoformat(), 'item_id': item_id, **price})
+
+    prices = prices_as_of(as_of, ids or None)
+    return jsonify({
+        'as_of': as_of.isoformat(),
+        'prices': {str(item_id): price for item_id, price in prices.items()}
+    })
+
+# API endpoint for stock valuation at a past date
+@app.route("/api/stock/valuation", methods=["GET"])
+def api_stock_valuation():
+    """Stock on hand (ledger replay) valued at the purchase prices of that date"""
+    as_of = _end_of_date_param()
+    if as_of is None:
+        return jsonify({'error': 'date is required as YYYY-MM-DD'}), 400
+    stock = {int(item_id): quantity for item_id, quantity in ledger_state_at(as_of)['items'].items() if quantity}
+    prices = prices_as_of(as_of, list(stock))
+    items = []
+    for item_id, quantity in sorted(stock.items()):
+        unit_cost = (prices.get(item_id) or {}).get('purchase_price') or 0.0
+        items.append({'item_id': item_id, 'quantity': quantity, 'unit_cost': unit_cost,
+                      'value': round(quantity * unit_cost, 2)})
+    return jsonify({
+        'as_of': as_of.isoformat(),
+        'total_value': round(sum(i['value'] for i in items), 2),
+        'items': items
+    })
+
+# Profit report (reads the cost stored on each sale, no history replay)
+@app.route("/reports/profit")
+def profit_report():
+    group_by = request.args.get("group", "item")
+    if group_by not in ("item", "customer", "month"):
+        group_by = "item"
+    method = request.args.get("method", "fifo")
+    if method not in ("fifo", "avg"):
+        method = "fifo"
+
+    today = shop_today()
+    try:
+        start_date = datetime.strptime(request.args.get("start", ""), "%Y-%m-%d").date()
+    except ValueError:
+        start_date = today.replace(day=1)
+    try:
+        end_date = datetime.strptime(request.args.get("end", ""), "%Y-%m-%d").date()
+    except ValueError:
+        end_date = today
+
+    # Per-sale detail, so ranges that cut through archived months stay exact
+    sales = sale_history()
+    cost_column = sales.c.cost_fifo if method == "fifo" else sales.c.cost_avg
+    revenue = db.func.sum(sales.c.total_price)
+    cost = db.func.sum(db.func.coalesce(cost_column, 0))
+    uncosted = db.func.sum(db.case((cost_column.is_(None), 1), else_=0))
+    in_range = (sales.c.business_date >= start_date, sales.c.business_date <= end_date)
+
+    if group_by == "customer":
+        query = db.session.query(Customer.name, revenue, cost, uncosted).select_from(sales).outerjoin(
+            Customer, sales.c.customer_id == Customer.id
+        ).filter(*in_range).group_by(sales.c.customer_id, Customer.name)
+    elif group_by == "month":
+        sale_year = extract('year', sales.c.business_date)
+        sale_month = extract('month', sales.c.business_date)
+        query = db.session.query(sale_year, sale_month, revenue, cost, uncosted).select_from(sales).filter(
+            *in_range
+        ).group_by(sale_year, sale_month).order_by(sale_year, sale_month)
+    else:
+        query = db.session.query(Item.name, revenue, cost, uncosted).select_from(sales).join(
+            Item, sales.c.item_id == Item.id
+        ).filter(*in_range).group_by(Item.id, Item.name)
+
+    rows = []
+    missing_cost = 0
+    for row in query.all():
+        if group_by == "month":
+            label = f"{int(row[0])}-{int(row[1]):02d}"
+            row_revenue, row_cost, row_uncosted = row[2:]
+        else:
+            label = row[0] or "Cash Sales"
+            row_revenue, row_cost, row_uncosted = row[1:]
+        row_revenue = row_revenue or 0
+        row_cost = row_cost or 0
+        missing_cost += row_uncosted or 0
+        rows.append({
+            "label": label,
+            "revenue": row_revenue,
+            "cost": row_cost,
+            "profit": row_revenue - row_cost,
+            "margin": (row_revenue - row_cost) / row_revenue * 100 if row_revenue else 0
+        })
+    if group_by != "month":
+        rows.sort(key=lambda r: r["profit"], reverse=True)
+
+    total_revenue = sum(r["revenue"] for r in rows)
+    total_cost = sum(r["cost"] for r in rows)
+
+    return render_template(
+        "profit_report.html",
+        rows=rows,
+        group_by=group_by,
+        method=method,
+        start_date=start_date,
+        end_date=end_date,
+        total_revenue=total_revenue,
+        total_cost=total_cost,
+        total_profit=total_revenue - total_cost,
+        missing_cost=missing_cost
+    )
+
 # Invoice page
 @app.route("/invoice/<int:sale_id>")
 def invoice(sale_id):
-    sale = Sale.query.get_or_404(sale_id)
+    sale = db.session.get(Sale, sale_id) or SaleArchive.query.get_or_404(sale_id)
     
     # Only show invoices for credit sales
     if not sale.customer_id:
@@ -1143,7 +4775,7 @@ def invoice(sale_id):
     remaining_balance = sale.total_price - sale.paid_amount
     
     # Generate invoice message (basic version, enhanced in frontend)
-    invoice_date = sale.date.strftime('%Y-%m-%d')
+    invoice_date = shop_time(sale.date).strftime('%Y-%m-%d')
     invoice_message = f"Thank you for shopping with us.\nThis is your invoice dated {invoice_date}.\nTotal amount: Rs {sale.total_price}\nPaid: Rs {sale.paid_amount}\nRemaining balance: Rs {remaining_balance}"
     
     return render_template(
@@ -1159,7 +4791,12 @@ def invoice(sale_id):
 @app.route('/static/service-worker.js')
 def service_worker():
     from flask import send_from_directory
-    return send_from_directory('static', 'service-worker.js', mimetype='application/javascript')
+    # The built copy carries the precache list and cache name from the asset manifest
+    directory = ASSET_DIST_DIR if asset_manifest['version'] else app.static_folder
+    response = send_from_directory(directory, 'service-worker.js', mimetype='application/javascript')
+    # Browsers must always see a new build's worker
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
 
@@ -0,0 +1,59 @@
+"""
+Sale Archive Script
+Moves fully paid sales older than the archive horizon out of the sale table
+into sale_archive, leaving one summary sale per customer, item and month in
+their place. Customer balances, monthly bills and stock figures read from the
+sale table are unchanged; the daily sales page, customer pages, invoices,
+profit report and month-end statements still show every archived sale.
+
+Meant for SQLite, where the sale table and its indexes otherwise grow
+forever. On PostgreSQL use partition_tables.py instead.
+
+Examples:
+    python archive_sales.py                  # older than ARCHIVE_HORIZON_MONTHS (default 12)
+    python archive_sales.py --months 6 --vacuum
+    python archive_sales.py --dry-run
+"""
+
+import argparse
+from datetime import datetime
+
+from app import app, db, Sale, ARCHIVE_HORIZON_MONTHS, archive_paid_sales, month_range, shop_today
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--months', type=int, default=ARCHIVE_HORIZON_MONTHS,
+                        help='Keep sales from this many whole months back (default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true', help='Only count what would be archived')
+    parser.add_argument('--vacuum', action='store_true', help='VACUUM afterwards so the file shrinks (SQLite)')
+    args = parser.parse_args()
+    if args.months < 1:
+        parser.error('--months must be at least 1; the current month is never archived')
+
+    before, _ = month_range(shop_today(), -args.months)
+    with app.app_context():
+        if args.dry_run:
+            count, total = db.session.execute(
+                db.select(db.func.count(Sale.id), db.func.sum(Sale.total_price)).where(
+                    Sale.archived_count.is_(None),
+                    Sale.paid_amount >= Sale.total_price,
+                    Sale.business_date < before
+                )
+            ).one()
+            print(f"{count} fully paid sales before {before:%Y-%m-%d} (Rs {total or 0:.2f}) would be archived")
+            return
+
+        started = datetime.now()
+        archived, summaries = archive_paid_sales(before)
+        elapsed = (datetime.now() - started).total_seconds()
+        print(f"Archived {archived} sales before {before:%Y-%m-%d} into {summaries} summary rows in {elapsed:.1f}s")
+
+        if args.vacuum and archived and db.engine.dialect.name == 'sqlite':
+            with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.exec_driver_sql('VACUUM')
+            print("Vacuumed database")
+
+
+if __name__ == "__main__":
+    main()
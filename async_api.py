@@ -0,0 +1,205 @@
+"""
+Async JSON API
+Serves the small read-only /api/* lookups (customer and wholesaler search,
+customer/item/wholesaler lists) on an asyncio event loop through SQLAlchemy's
+async engine. While one request waits on the database the worker keeps
+serving others, so autocomplete traffic no longer starves form posts.
+Every other request is passed through to the Flask app unchanged.
+
+The searches answer exactly as the Flask endpoints do: the same per-client
+rate limit, customers from the shared catalog, wholesalers through the
+single-flight search cache. Those are synchronous, so they run in a thread.
+
+Run it in place of gunicorn's sync workers:
+    uvicorn async_api:application --host 0.0.0.0 --port $PORT --workers 2
+
+Or mount just the async routes in another ASGI app with `api_app`.
+"""
+
+import asyncio
+import json
+import math
+import os
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+from app import (
+    app as flask_app, logger, API_FIELDS, SEARCH_RESULT_LIMIT, parse_fields, pool_sizing, search_rate_limiter,
+    search_wholesalers, shared_catalog, uses_transaction_pooler
+)
+
+
+def async_database_url(url):
+    """Map the Flask app's sync URL onto an async driver."""
+    if url.startswith('sqlite:///'):
+        return url.replace('sqlite:///', 'sqlite+aiosqlite:///', 1)
+    # psycopg 3 is already a dependency and speaks asyncio natively
+    if url.startswith('postgresql+psycopg://'):
+        return url.replace('postgresql+psycopg://', 'postgresql+psycopg_async://', 1)
+    return url
+
+
+def create_engine_for(url):
+    url = async_database_url(url)
+    if url.startswith('sqlite'):
+        return create_async_engine(url)
+    if uses_transaction_pooler(url):
+        # Same rules as the sync engine behind PgBouncer/Supavisor
+        return create_async_engine(url, poolclass=NullPool, connect_args={'prepare_threshold': None})
+    # Sized by the same rules as the Flask engine; count both in DB_CONNECTION_BUDGET
+    pool_size, max_overflow = pool_sizing()
+    return create_async_engine(
+        url,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    )
+
+
+engine = create_engine_for(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__('Too many requests')
+        self.retry_after = retry_after
+
+
+def fields_for(resource, params):
+    """Field names picked by ?fields= (same rules as the Flask endpoints); ValueError if unknown."""
+    return parse_fields(params.get('fields', [''])[0], API_FIELDS[resource])
+
+
+def columns_for(resource, params):
+    columns = API_FIELDS[resource]
+    return [columns[name] for name in fields_for(resource, params)]
+
+
+def client_address(scope):
+    """First X-Forwarded-For hop when behind the platform proxy, as Flask's access_route."""
+    for name, value in scope.get('headers', ()):
+        if name == b'x-forwarded-for':
+            return value.decode('latin-1').split(',')[0].strip()
+    return (scope.get('client') or ('',))[0]
+
+
+def check_rate(client):
+    allowed, retry_after = search_rate_limiter.allow(client)
+    if not allowed:
+        raise RateLimited(retry_after)
+
+
+async def in_app_context(function, *args):
+    """Run a synchronous app function in a thread, with the Flask app context it needs."""
+    def call():
+        with flask_app.app_context():
+            return function(*args)
+    return await asyncio.to_thread(call)
+
+
+async def fetch_rows(statement):
+    async with engine.connect() as conn:
+        result = await conn.execute(statement)
+        return [dict(row) for row in result.mappings()]
+
+
+async def customers(params, client):
+    return await fetch_rows(select(*columns_for('customers', params)))
+
+
+async def customers_search(params, client):
+    names = fields_for('customers', params)
+    query = params.get('q', [''])[0].strip()
+    if not query:
+        return []
+    check_rate(client)
+    results = await in_app_context(shared_catalog.search_customers, query, SEARCH_RESULT_LIMIT)
+    return [{name: result[name] for name in names} for result in results]
+
+
+async def items(params, client):
+    return await fetch_rows(select(*columns_for('items', params)))
+
+
+async def wholesalers(params, client):
+    return await fetch_rows(select(*columns_for('wholesalers', params)))
+
+
+async def wholesalers_search(params, client):
+    names = fields_for('wholesalers', params)
+    query = params.get('q', [''])[0].strip()
+    if not query:
+        return []
+    check_rate(client)
+    results = await in_app_context(search_wholesalers, query)
+    return [{name: result[name] for name in names} for result in results]
+
+
+ROUTES = {
+    '/api/customers': customers,
+    '/api/customers/search': customers_search,
+    '/api/items': items,
+    '/api/wholesalers': wholesalers,
+    '/api/wholesalers/search': wholesalers_search,
+}
+
+
+async def send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('ascii')),
+            *headers,
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def handles(scope):
+    return scope['type'] == 'http' and scope['method'] == 'GET' and scope['path'] in ROUTES
+
+
+async def api_app(scope, receive, send):
+    """ASGI app for the async routes only."""
+    params = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+    try:
+        payload = await ROUTES[scope['path']](params, client_address(scope))
+    except RateLimited as e:
+        retry_after = str(max(1, math.ceil(e.retry_after))).encode('ascii')
+        await send_json(send, {'error': str(e)}, status=429, headers=[(b'retry-after', retry_after)])
+        return
+    except ValueError as e:
+        await send_json(send, {'error': str(e)}, status=400)
+        return
+    except Exception as e:
+        logger.error(f"✗ Async API error on {scope['path']}: {e}", exc_info=True)
+        await send_json(send, {'error': 'Internal server error'}, status=500)
+        return
+    await send_json(send, payload)
+
+
+flask_asgi = WsgiToAsgi(flask_app)
+
+
+async def application(scope, receive, send):
+    """Async routes on the event loop, everything else through Flask."""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    elif handles(scope):
+        await api_app(scope, receive, send)
+    else:
+        await flask_asgi(scope, receive, send)
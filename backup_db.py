@@ -0,0 +1,417 @@
+"""
+Database Backup and Restore
+Takes consistent snapshots of the live database without stopping the app,
+and restores them.
+
+- SQLite: pages are copied with SQLite's online backup API a few at a time,
+  from a single read snapshot (the app runs SQLite in WAL mode, so sales keep
+  being written while it copies).
+- PostgreSQL: every table is streamed out with COPY inside one read-only
+  REPEATABLE READ transaction, so all tables come from the same moment and
+  nothing is locked against writes. The dump is plain COPY text that psql can
+  also load.
+
+Snapshots are gzip-compressed and written next to a .sha256 file in the
+`sha256sum -c` format; verify and restore refuse files that don't match.
+
+Examples:
+    python backup_db.py backup --dir backups --keep 14
+    python backup_db.py verify backups/khata-20261019T020000Z.sqlite.gz
+    python backup_db.py restore backups/khata-20261019T020000Z.sqlite.gz --yes
+    python backup_db.py benchmark http://localhost:8000 --item-id 1 --customer-id 1
+
+benchmark records credit sales through a running server (using the same
+database as this script) with and without a backup in progress, deletes them
+again, and fails if the p95 latency during backups is over --budget-ms.
+Run it against a staging copy: the deleted sales stay in the ledger journal.
+"""
+
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+from app import app, db, logger, shared_catalog
+
+CHUNK_SIZE = 1024 * 1024
+# Pages copied per backup step; between steps the counter gets the disk
+SQLITE_PAGES_PER_STEP = int(os.environ.get('BACKUP_PAGES_PER_STEP', 256))
+SQLITE_STEP_PAUSE = float(os.environ.get('BACKUP_STEP_PAUSE_MS', 5)) / 1000
+
+
+class HashingWriter:
+    """File wrapper that hashes everything written through it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+def snapshot_path(directory, dialect):
+    extension = 'sqlite.gz' if dialect == 'sqlite' else 'pgcopy.gz'
+    return os.path.join(directory, f"khata-{datetime.utcnow():%Y%m%dT%H%M%SZ}.{extension}")
+
+
+def write_checksum(path, digest):
+    with open(path + '.sha256', 'w', encoding='utf-8') as f:
+        f.write(f"{digest}  {os.path.basename(path)}\n")
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def verify(path):
+    """True when path matches its .sha256 file and decompresses cleanly."""
+    try:
+        with open(path + '.sha256', encoding='utf-8') as f:
+            expected = f.read().split()[0]
+    except (OSError, IndexError):
+        logger.error(f"✗ No checksum file for {path}")
+        return False
+    if file_sha256(path) != expected:
+        logger.error(f"✗ Checksum mismatch for {path}")
+        return False
+    try:
+        # Reading to the end checks gzip's own CRC as well
+        with gzip.open(path, 'rb') as f:
+            while f.read(CHUNK_SIZE):
+                pass
+    except (OSError, EOFError) as e:
+        logger.error(f"✗ {path} is not a valid gzip file: {e}")
+        return False
+    return True
+
+
+# ------------------
+# SQLite
+# ------------------
+def backup_sqlite(db_path, out_path):
+    """Copy db_path page by page, check the copy, then gzip it to out_path."""
+    fd, copy_path = tempfile.mkstemp(suffix='.db', dir=os.path.dirname(out_path))
+    os.close(fd)
+    source = sqlite3.connect(db_path, timeout=30)
+    target = sqlite3.connect(copy_path)
+    try:
+        if source.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+            # An open read transaction pins one snapshot for every step, so the
+            # copy never restarts; in WAL mode it doesn't hold writers back
+            source.execute('BEGIN')
+            source.execute('SELECT count(*) FROM sqlite_master').fetchone()
+        source.backup(
+            target, pages=SQLITE_PAGES_PER_STEP,
+            progress=lambda status, remaining, total: time.sleep(SQLITE_STEP_PAUSE)
+        )
+        source.rollback()
+        result = target.execute('PRAGMA quick_check').fetchone()[0]
+        if result != 'ok':
+            raise RuntimeError(f"backup copy failed quick_check: {result}")
+    finally:
+        target.close()
+        source.close()
+
+    try:
+        with open(out_path + '.partial', 'wb') as raw:
+            writer = HashingWriter(raw)
+            with open(copy_path, 'rb') as src, gzip.GzipFile(fileobj=writer, mode='wb', mtime=0) as gz:
+                shutil.copyfileobj(src, gz, CHUNK_SIZE)
+        os.replace(out_path + '.partial', out_path)
+    finally:
+        os.remove(copy_path)
+    return writer.sha256.hexdigest()
+
+
+def restore_sqlite(path, db_path):
+    """Load a snapshot into db_path through the backup API.
+
+    The running app's connections stay valid; writers wait for the few
+    moments the final copy holds the lock.
+    """
+    fd, copy_path = tempfile.mkstemp(suffix='.db', dir=os.path.dirname(os.path.abspath(db_path)))
+    os.close(fd)
+    try:
+        with gzip.open(path, 'rb') as src, open(copy_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        source = sqlite3.connect(copy_path)
+        target = sqlite3.connect(db_path, timeout=30)
+        try:
+            result = source.execute('PRAGMA quick_check').fetchone()[0]
+            if result != 'ok':
+                raise RuntimeError(f"snapshot failed quick_check: {result}")
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+    finally:
+        os.remove(copy_path)
+
+
+# ------------------
+# PostgreSQL
+# ------------------
+def copy_header(table):
+    preparer = db.engine.dialect.identifier_preparer
+    columns = ', '.join(preparer.quote(c.name) for c in table.columns)
+    return preparer.quote(table.name), columns
+
+
+def backup_postgres(out_path):
+    """Stream every table through COPY into a gzip file; returns (sha256, row counts)."""
+    rows = {}
+    raw = db.engine.raw_connection()
+    try:
+        conn = raw.driver_connection
+        with open(out_path + '.partial', 'wb') as f:
+            writer = HashingWriter(f)
+            with gzip.GzipFile(fileobj=writer, mode='wb', mtime=0) as gz, conn.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                gz.write(f"-- khata snapshot {datetime.utcnow():%Y-%m-%dT%H:%M:%SZ}\n".encode('utf-8'))
+                for table in db.metadata.sorted_tables:
+                    name, columns = copy_header(table)
+                    gz.write(f"COPY {name} ({columns}) FROM stdin;\n".encode('utf-8'))
+                    count = 0
+                    # COPY (SELECT ...) also works on partitioned tables
+                    with cursor.copy(f"COPY (SELECT {columns} FROM {name}) TO STDOUT") as copy:
+                        for data in copy:
+                            gz.write(data)
+                            count += bytes(data).count(b'\n')
+                    gz.write(b"\\.\n\n")
+                    rows[table.name] = count
+        conn.rollback()
+        os.replace(out_path + '.partial', out_path)
+    finally:
+        raw.close()
+    return writer.sha256.hexdigest(), rows
+
+
+def restore_postgres(path):
+    """Replace the contents of every table in the snapshot, in one transaction."""
+    with gzip.open(path, 'rb') as f:
+        tables = [line.decode('utf-8').split()[1] for line in f if line.startswith(b'COPY ')]
+    raw = db.engine.raw_connection()
+    try:
+        conn = raw.driver_connection
+        with conn.cursor() as cursor, gzip.open(path, 'rb') as f:
+            cursor.execute(f"TRUNCATE {', '.join(tables)} CASCADE")
+            for line in f:
+                if not line.startswith(b'COPY '):
+                    continue
+                statement = line.decode('utf-8').rstrip().rstrip(';')
+                with cursor.copy(statement[:-len('stdin')] + 'STDIN') as copy:
+                    # The same file iterator, so the outer loop resumes after the block
+                    for data in f:
+                        if data == b"\\.\n":
+                            break
+                        copy.write(data)
+            # Ids continue after the restored rows
+            for table in db.metadata.sorted_tables:
+                name, _ = copy_header(table)
+                if name not in tables or 'id' not in table.columns:
+                    continue
+                sequence = cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table.name,)).fetchone()[0]
+                if sequence:
+                    cursor.execute(f"SELECT setval(%s, coalesce(max(id), 0) + 1, false) FROM {name}", (sequence,))
+        conn.commit()
+    except Exception:
+        raw.driver_connection.rollback()
+        raise
+    finally:
+        raw.close()
+    return tables
+
+
+# ------------------
+# Commands
+# ------------------
+def backup(directory, keep=None):
+    """Write one snapshot into directory; returns its path."""
+    os.makedirs(directory, exist_ok=True)
+    dialect = db.engine.dialect.name
+    path = snapshot_path(directory, dialect)
+    started = time.perf_counter()
+    if dialect == 'sqlite':
+        digest = backup_sqlite(db.engine.url.database, path)
+        detail = ''
+    else:
+        digest, rows = backup_postgres(path)
+        detail = f", {sum(rows.values())} rows"
+    write_checksum(path, digest)
+    elapsed = time.perf_counter() - started
+    logger.info(f"✓ Backup written to {path} ({os.path.getsize(path)} bytes{detail}) in {elapsed:.1f}s")
+    if keep:
+        prune(directory, keep)
+    return path
+
+
+def prune(directory, keep):
+    """Keep the newest `keep` snapshots in directory."""
+    snapshots = sorted(glob.glob(os.path.join(directory, 'khata-*.gz')))
+    for old in snapshots[:-keep]:
+        os.remove(old)
+        if os.path.exists(old + '.sha256'):
+            os.remove(old + '.sha256')
+        logger.info(f"✓ Removed old backup {old}")
+
+
+def restore(path):
+    if not verify(path):
+        raise SystemExit(f"Refusing to restore {path}: it failed verification")
+    started = time.perf_counter()
+    if db.engine.dialect.name == 'sqlite':
+        if not path.endswith('.sqlite.gz'):
+            raise SystemExit("This is a PostgreSQL snapshot; the app is using SQLite")
+        restore_sqlite(path, db.engine.url.database)
+    else:
+        if not path.endswith('.pgcopy.gz'):
+            raise SystemExit("This is a SQLite snapshot; the app is using PostgreSQL")
+        restore_postgres(path)
+    logger.info(f"✓ Restored {path} in {time.perf_counter() - started:.1f}s")
+    # The item/customer catalog is shared on this host; a restart alone wouldn't rebuild it
+    shared_catalog.invalidate()
+    print("Restart the app so every worker drops its cached dashboard and search data.")
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def timed_sales(opener, base_url, item_id, customer_id, count):
+    """Record `count` credit sales; returns (latencies, sale ids)."""
+    body = urllib.parse.urlencode({
+        'sale_type': 'credit', 'item_id': item_id, 'customer_id': customer_id,
+        'quantity': 1, 'unit_price': 1, 'paid_amount': 0,
+    }).encode('ascii')
+    latencies, sale_ids = [], []
+    for _ in range(count):
+        started = time.perf_counter()
+        try:
+            opener.open(f"{base_url}/add-sale", data=body, timeout=30).read()
+            location = ''
+        except urllib.error.HTTPError as e:
+            location = e.headers.get('Location', '')
+        latencies.append(time.perf_counter() - started)
+        if '/invoice/' not in location:
+            raise SystemExit(f"Sale was not recorded (redirected to {location or 'nowhere'}); check item stock")
+        sale_ids.append(int(location.rstrip('/').rsplit('/', 1)[1]))
+    return latencies, sale_ids
+
+
+def latency_summary(phase, latencies):
+    latencies = sorted(latencies)
+    return {
+        'phase': phase,
+        'sales': len(latencies),
+        'p50_ms': round(statistics.median(latencies) * 1000, 1),
+        'p95_ms': round(latencies[max(0, int(len(latencies) * 0.95) - 1)] * 1000, 1),
+        'max_ms': round(latencies[-1] * 1000, 1),
+    }
+
+
+def benchmark(base_url, item_id, customer_id, count, budget_ms):
+    opener = urllib.request.build_opener(_NoRedirect)
+    recorded = []
+    try:
+        idle, ids = timed_sales(opener, base_url, item_id, customer_id, count)
+        recorded += ids
+
+        done = threading.Event()
+        backups = []
+
+        def keep_backing_up():
+            with app.app_context(), tempfile.TemporaryDirectory() as directory:
+                while not done.is_set():
+                    started = time.perf_counter()
+                    path = backup(directory)
+                    backups.append(time.perf_counter() - started)
+                    os.remove(path)
+                    os.remove(path + '.sha256')
+
+        worker = threading.Thread(target=keep_backing_up)
+        worker.start()
+        try:
+            busy, ids = timed_sales(opener, base_url, item_id, customer_id, count)
+            recorded += ids
+        finally:
+            done.set()
+            worker.join()
+    finally:
+        for sale_id in recorded:
+            try:
+                opener.open(f"{base_url}/delete-sale/{sale_id}", timeout=30).read()
+            except urllib.error.HTTPError:
+                pass
+
+    print(json.dumps(latency_summary('idle', idle)))
+    result = latency_summary('during_backup', busy)
+    result['backups'] = len(backups)
+    result['backup_s_avg'] = round(sum(backups) / len(backups), 2) if backups else None
+    print(json.dumps(result))
+    if result['p95_ms'] > budget_ms:
+        raise SystemExit(f"p95 add_sale latency during backup {result['p95_ms']} ms is over the {budget_ms} ms budget")
+    print(f"Within budget: p95 {result['p95_ms']} ms <= {budget_ms} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    backup_parser = commands.add_parser('backup', help='Write a snapshot')
+    backup_parser.add_argument('--dir', default=os.environ.get('BACKUP_DIR', 'backups'))
+    backup_parser.add_argument('--keep', type=int, help='Delete all but the newest N snapshots')
+
+    verify_parser = commands.add_parser('verify', help='Check a snapshot against its checksum')
+    verify_parser.add_argument('path')
+
+    restore_parser = commands.add_parser('restore', help='Replace the database with a snapshot')
+    restore_parser.add_argument('path')
+    restore_parser.add_argument('--yes', action='store_true', help='Skip the confirmation prompt')
+
+    bench_parser = commands.add_parser('benchmark', help='add_sale latency with and without a backup running')
+    bench_parser.add_argument('url', help='Base URL of a running server using the same database')
+    bench_parser.add_argument('--item-id', type=int, required=True)
+    bench_parser.add_argument('--customer-id', type=int, required=True)
+    bench_parser.add_argument('--sales', type=int, default=200)
+    bench_parser.add_argument('--budget-ms', type=float, default=100)
+
+    args = parser.parse_args()
+    with app.app_context():
+        if args.command == 'backup':
+            print(backup(args.dir, args.keep))
+        elif args.command == 'verify':
+            if not verify(args.path):
+                raise SystemExit(1)
+            print(f"{args.path}: OK")
+        elif args.command == 'restore':
+            if not args.yes and input(f"Replace all data with {args.path}? [y/N] ").strip().lower() != 'y':
+                raise SystemExit("Cancelled")
+            restore(args.path)
+        else:
+            benchmark(args.url.rstrip('/'), args.item_id, args.customer_id, args.sales, args.budget_ms)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+API Fields Benchmark
+Measures CPU time per request and payload size for /api/items on a generated
+catalog, comparing the old ORM handler (full Item objects turned into dicts)
+with the Core projection, with all fields and with ?fields=id,name.
+
+Runs in-process against a throwaway SQLite database, so the numbers are the
+app's own work (query, row handling, JSON) without network or server noise.
+
+Examples:
+    python benchmark_api_fields.py
+    python benchmark_api_fields.py --items 50000 --repeat 20
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+
+def orm_items(Item, jsonify):
+    """/api/items as it was before sparse fieldsets."""
+    items = Item.query.all()
+    return jsonify([{
+        'id': i.id,
+        'name': i.name,
+        'category': i.category,
+        'unit': i.unit,
+        'purchase_price': i.purchase_price,
+        'sale_price': i.sale_price,
+        'stock_quantity': i.stock_quantity,
+        'sku': i.sku,
+        'barcode': i.barcode
+    } for i in items])
+
+
+def measure(app, db, label, path, handler, repeat):
+    cpu = []
+    for _ in range(repeat):
+        with app.test_request_context(path):
+            started = time.process_time()
+            response = handler()
+            body = response.get_data()
+            cpu.append(time.process_time() - started)
+            db.session.remove()
+    cpu.sort()
+    return {
+        'variant': label,
+        'cpu_ms_median': round(cpu[len(cpu) // 2] * 1000, 1),
+        'cpu_ms_min': round(cpu[0] * 1000, 1),
+        'payload_bytes': len(body),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=10000, help='Catalog size (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='khata-bench-')
+    # Must be set before the app is imported; the real database is never touched
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    from flask import jsonify
+    from app import app, db, Item, api_items
+
+    with app.app_context():
+        db.session.execute(db.insert(Item), [{
+            'name': f"Item {n:05d}", 'category': ('Grocery', 'Dairy', 'Household')[n % 3], 'unit': 'pc',
+            'purchase_price': 10 + n % 90, 'sale_price': 12 + n % 90, 'stock_quantity': n % 50,
+            'sku': f"SKU{n:05d}", 'barcode': f"89{n:011d}",
+        } for n in range(args.items)])
+        db.session.commit()
+
+        results = [
+            measure(app, db, 'ORM objects (before)', '/api/items', lambda: orm_items(Item, jsonify), args.repeat),
+            measure(app, db, 'Core, all fields', '/api/items', api_items, args.repeat),
+            measure(app, db, 'Core, fields=id,name', '/api/items?fields=id,name', api_items, args.repeat),
+        ]
+        db.engine.dispose()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = results[0]
+    for result in results:
+        result['cpu_vs_before'] = f"{result['cpu_ms_median'] / baseline['cpu_ms_median']:.0%}"
+        result['payload_vs_before'] = f"{result['payload_bytes'] / baseline['payload_bytes']:.0%}"
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
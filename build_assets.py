@@ -0,0 +1,277 @@
+"""
+Static Asset Build
+Bundles and minifies the app's JavaScript and CSS into content-hashed files
+under static/dist/, with .gz and .br variants next to each one. It also
+writes static/dist/manifest.json, which the app uses to resolve
+url_for('static', ...), and a copy of the service worker whose cache name and
+precache list come from that manifest.
+
+Run it before starting the server (the Procfile does):
+    python build_assets.py
+
+Without a build the app serves the source files exactly as before.
+Brotli output needs the optional `Brotli` package; without it only .gz is written.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+
+# Bundle name -> source files (relative to static/), in load order
+ASSET_BUNDLES = {
+    'app.js': ['app.js', 'js/offline_contact_browser.js', 'js/contact_picker.js'],
+    'app.css': ['css/theme.css'],
+}
+# Files templates include on their own, minified and hashed too; form pages
+# still include contact_picker.js directly ahead of their inline scripts
+ASSET_FILES = ['js/invoice_share.js', 'js/contact_picker.js']
+
+# Third-party files the service worker precaches along with our own
+CDN_ASSETS = [
+    'https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css',
+    'https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/js/bootstrap.bundle.min.js',
+]
+
+JS_REGEX_PREFIX = set('(,=:[!&|?{};+-*%<>~^')
+JS_REGEX_KEYWORDS = {'return', 'typeof', 'case', 'in', 'of', 'void', 'delete', 'new', 'throw', 'else', 'do'}
+
+
+def minify_js(source):
+    """Drop comments and indentation, keeping strings, regexes and newlines.
+
+    Line breaks are kept so automatic semicolon insertion behaves exactly as
+    in the source; the savings come from comments and whitespace.
+    """
+    out = []
+    i, n = 0, len(source)
+    # Stack of open template literals: brace depth at which each ${ began
+    template_depths = []
+    brace_depth = 0
+    last = ''        # last significant character emitted
+    last_word = ''   # last identifier emitted, for regex detection
+
+    def emit_space(ws):
+        if out and out[-1] in (' ', '\n'):
+            if '\n' in ws and out[-1] == ' ':
+                out[-1] = '\n'
+            return
+        out.append('\n' if '\n' in ws else ' ')
+
+    while i < n:
+        ch = source[i]
+        nxt = source[i + 1] if i + 1 < n else ''
+
+        if ch in ' \t\r\n':
+            j = i
+            while j < n and source[j] in ' \t\r\n':
+                j += 1
+            emit_space(source[i:j])
+            i = j
+        elif ch == '/' and nxt == '/':
+            while i < n and source[i] != '\n':
+                i += 1
+        elif ch == '/' and nxt == '*':
+            end = source.find('*/', i + 2)
+            end = n if end == -1 else end + 2
+            emit_space('\n' if '\n' in source[i:end] else ' ')
+            i = end
+        elif ch in ('"', "'"):
+            j = i + 1
+            while j < n and source[j] != ch:
+                j += 2 if source[j] == '\\' else 1
+            out.append(source[i:j + 1])
+            last, last_word = ch, ''
+            i = j + 1
+        elif ch == '`' or (ch == '}' and template_depths and template_depths[-1] == brace_depth):
+            # Start of a template literal, or resuming one after ${ ... }
+            if ch == '}':
+                template_depths.pop()
+            j = i + 1
+            while j < n:
+                if source[j] == '\\':
+                    j += 2
+                elif source[j] == '`':
+                    j += 1
+                    break
+                elif source[j] == '$' and j + 1 < n and source[j + 1] == '{':
+                    j += 2
+                    template_depths.append(brace_depth)
+                    break
+                else:
+                    j += 1
+            # Newlines inside the literal are content, hide them from the line cleanup
+            out.append(source[i:j].replace('\n', '\0'))
+            last, last_word = '`', ''
+            i = j
+        elif ch == '/' and (last in JS_REGEX_PREFIX or last == '' or last_word in JS_REGEX_KEYWORDS):
+            j, in_class = i + 1, False
+            while j < n and source[j] != '\n':
+                if source[j] == '\\':
+                    j += 2
+                    continue
+                if source[j] == '[':
+                    in_class = True
+                elif source[j] == ']':
+                    in_class = False
+                elif source[j] == '/' and not in_class:
+                    break
+                j += 1
+            j += 1
+            while j < n and (source[j].isalnum()):
+                j += 1
+            out.append(source[i:j])
+            last, last_word = '/', ''
+            i = j
+        elif ch.isalnum() or ch in '_$':
+            j = i
+            while j < n and (source[j].isalnum() or source[j] in '_$'):
+                j += 1
+            last_word = source[i:j]
+            out.append(last_word)
+            last = last_word[-1]
+            i = j
+        else:
+            if ch == '{':
+                brace_depth += 1
+            elif ch == '}':
+                brace_depth -= 1
+            out.append(ch)
+            last, last_word = ch, ''
+            i += 1
+
+    lines = (line.strip() for line in ''.join(out).split('\n'))
+    return '\n'.join(line for line in lines if line).replace('\0', '\n') + '\n'
+
+
+def minify_css(source):
+    """Drop comments and collapse whitespace; strings are left alone."""
+    segments = []
+    code = []
+    i, n = 0, len(source)
+    while i < n:
+        ch = source[i]
+        if ch == '/' and source.startswith('/*', i):
+            end = source.find('*/', i + 2)
+            i = n if end == -1 else end + 2
+            code.append(' ')
+        elif ch in ('"', "'"):
+            j = i + 1
+            while j < n and source[j] != ch:
+                j += 2 if source[j] == '\\' else 1
+            segments.append(_tighten_css(''.join(code)))
+            segments.append(source[i:j + 1])
+            code = []
+            i = j + 1
+        else:
+            code.append(ch)
+            i += 1
+    segments.append(_tighten_css(''.join(code)))
+    return ''.join(segments).strip() + '\n'
+
+
+def _tighten_css(code):
+    code = re.sub(r'\s+', ' ', code)
+    # Spaces before ':' can be significant in selectors (a :hover), so only
+    # punctuation that never needs surrounding space is tightened
+    code = re.sub(r'\s*([{};,>])\s*', r'\1', code)
+    code = re.sub(r':\s+', ':', code)
+    return code.replace(';}', '}')
+
+
+def read_sources(paths):
+    parts = []
+    for path in paths:
+        with open(os.path.join(STATIC_DIR, path), encoding='utf-8') as f:
+            parts.append(f.read())
+    return parts
+
+
+def minify(name, parts):
+    if name.endswith('.js'):
+        # Each file ends its last statement so concatenation can't merge them
+        return ''.join(minify_js(part).rstrip('\n') + ';\n' for part in parts)
+    return ''.join(minify_css(part) for part in parts)
+
+
+def write_asset(name, content):
+    """Write content under a hashed name plus .gz/.br; returns the static/ path."""
+    data = content.encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    stem, ext = os.path.splitext(os.path.basename(name))
+    filename = f"{stem}.{digest}{ext}"
+    path = os.path.join(DIST_DIR, filename)
+    with open(path, 'wb') as f:
+        f.write(data)
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+    return f"dist/{filename}", len(data)
+
+
+def write_service_worker(manifest):
+    """Copy service-worker.js with its cache name and precache list filled in."""
+    with open(os.path.join(STATIC_DIR, 'service-worker.js'), encoding='utf-8') as f:
+        source = f.read()
+    precache = (
+        [f"/static/{path}" for path in manifest['bundles'].values()]
+        + [f"/static/{path}" for path in manifest['files'].values()]
+        + ['/static/manifest.json']
+        + CDN_ASSETS
+    )
+    source, cache_count = re.subn(
+        r"const CACHE_NAME = '[^']*';",
+        f"const CACHE_NAME = 'store-billing-{manifest['version']}';",
+        source
+    )
+    source, list_count = re.subn(
+        r"const STATIC_ASSETS = \[.*?\];",
+        "const STATIC_ASSETS = " + json.dumps(precache, indent=2) + ";",
+        source,
+        flags=re.S
+    )
+    if cache_count != 1 or list_count != 1:
+        raise SystemExit("service-worker.js no longer has CACHE_NAME / STATIC_ASSETS to rewrite")
+    with open(os.path.join(DIST_DIR, 'service-worker.js'), 'w', encoding='utf-8') as f:
+        f.write(source)
+
+
+def build():
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    os.makedirs(DIST_DIR)
+
+    manifest = {'bundles': {}, 'files': {}}
+    for name, sources in ASSET_BUNDLES.items():
+        parts = read_sources(sources)
+        manifest['bundles'][name], size = write_asset(name, minify(name, parts))
+        print(f"{name}: {sum(len(p.encode('utf-8')) for p in parts)} -> {size} bytes ({len(sources)} files)")
+    for name in ASSET_FILES:
+        parts = read_sources([name])
+        manifest['files'][name], size = write_asset(name, minify(name, parts))
+        print(f"{name}: {len(parts[0].encode('utf-8'))} -> {size} bytes")
+
+    hashed = json.dumps(manifest, sort_keys=True).encode('utf-8')
+    manifest['version'] = hashlib.sha256(hashed).hexdigest()[:12]
+    with open(os.path.join(DIST_DIR, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    write_service_worker(manifest)
+
+    if brotli is None:
+        print("Brotli not installed: wrote .gz variants only")
+    print(f"Asset manifest version {manifest['version']} written to {DIST_DIR}")
+
+
+if __name__ == "__main__":
+    build()
@@ -2,6 +2,8 @@
 Database Fix Script
 This script will recreate the database with the updated schema.
 WARNING: This will delete all existing data!
+Take a snapshot first with `python backup_db.py backup`; it can be loaded
+back with `python backup_db.py restore <file>`.
 """
 
 from app import app, db
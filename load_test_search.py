@@ -0,0 +1,88 @@
+"""
+Search Load Test
+Fires concurrent /api/customers/search requests at one or more running
+servers and reports throughput and latency, to compare the sync Flask path
+with the async API.
+
+Example:
+    gunicorn app:app --workers 2 --bind :8000 &
+    uvicorn async_api:application --workers 2 --port 8001 &
+    python load_test_search.py http://localhost:8000 http://localhost:8001 --concurrency 50 --requests 2000
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def fetch(url):
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=30) as response:
+            response.read()
+            ok = response.status == 200
+    except Exception:
+        ok = False
+    return ok, time.perf_counter() - started
+
+
+def search_terms(base_url, limit=200):
+    """Short prefixes of real customer names, like autocomplete would send."""
+    with urllib.request.urlopen(f"{base_url}/api/customers", timeout=30) as response:
+        customers = json.loads(response.read())
+    terms = set()
+    for customer in customers[:limit]:
+        name = (customer.get('name') or '').strip().lower()
+        for length in (1, 2, 3):
+            if len(name) >= length:
+                terms.add(name[:length])
+    return sorted(terms) or ['a', 'al', 'ali']
+
+
+def run(base_url, terms, concurrency, total_requests):
+    urls = [
+        f"{base_url}/api/customers/search?q={urllib.parse.quote(random.choice(terms))}"
+        for _ in range(total_requests)
+    ]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(fetch, urls))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for ok, latency in results if ok)
+    failures = sum(1 for ok, _ in results if not ok)
+    if not latencies:
+        return {'url': base_url, 'failures': failures}
+    return {
+        'url': base_url,
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 1),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+        'max_ms': round(latencies[-1] * 1000, 1),
+        'failures': failures,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('urls', nargs='+', help='Base URLs of running servers to compare')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    terms = search_terms(args.urls[0])
+    for base_url in args.urls:
+        random.seed(args.seed)
+        # Warm up connections and caches before measuring
+        run(base_url, terms, min(args.concurrency, 10), 50)
+        print(json.dumps(run(base_url, terms, args.concurrency, args.requests)))
+
+
+if __name__ == "__main__":
+    main()
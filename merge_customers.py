@@ -0,0 +1,44 @@
+"""
+Duplicate Customer Merge
+Finds customers whose phone numbers are the same once normalized
+("0300-1234567", "+92 300 1234567" and "03001234567" are one number) and
+merges each group into its oldest customer: sales, archived sales and
+payments move to it, balances move with them in the ledger journal, and the
+duplicates are deleted. Everything happens in one transaction.
+
+Running web workers pick the change up when their caches expire (the offline
+snapshot after BOOTSTRAP_TTL_SECONDS, the dashboard after
+METRICS_RESEED_SECONDS).
+
+Examples:
+    python merge_customers.py --dry-run    # list what would be merged
+    python merge_customers.py
+"""
+
+import argparse
+
+from app import app, db, Customer, find_duplicate_customers, merge_duplicate_customers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help='Only list the duplicates')
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.dry_run:
+            groups = find_duplicate_customers()
+            db.session.rollback()
+            names = dict(db.session.execute(db.select(Customer.id, Customer.name)).all())
+            for phone_e164, survivor_id, duplicate_ids in groups:
+                merged = ', '.join(f"{names.get(i)} (#{i})" for i in duplicate_ids)
+                print(f"{phone_e164}: keep {names.get(survivor_id)} (#{survivor_id}), merge {merged}")
+            print(f"{len(groups)} phone numbers shared by {sum(len(g[2]) for g in groups)} duplicate customers")
+            return
+
+        groups, removed = merge_duplicate_customers()
+        print(f"Merged {removed} duplicate customers into {groups} surviving customers")
+
+
+if __name__ == "__main__":
+    main()
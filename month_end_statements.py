@@ -0,0 +1,410 @@
+"""
+Month-End Statements
+Builds every credit customer's statement for one month (opening balance,
+sales, payments, closing balance) as WhatsApp-ready text and a PDF, and
+writes a manifest.csv listing what to send to whom.
+
+The month's sales are read in one streaming query ordered by customer, so each
+customer's statement is complete as soon as the next customer's rows start.
+Finished statements are rendered by a process pool while the query keeps
+streaming.
+
+PDFs embed the TrueType fonts listed in STATEMENT_FONTS (os.pathsep separated;
+the first is the main font, the rest fill in scripts it lacks, e.g. Noto Naskh
+Arabic for Urdu names) using fpdf2. Without fpdf2 or any of those fonts the
+built-in Latin-1 writer is used, and statements that lost text are listed.
+
+Usage:
+    python month_end_statements.py                 # last month
+    python month_end_statements.py 2026-09 --out statements --workers 4
+"""
+
+import argparse
+import csv
+import os
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, date
+from itertools import groupby
+
+try:
+    from fpdf import FPDF
+except ImportError:
+    FPDF = None
+
+try:
+    import uharfbuzz
+except ImportError:
+    uharfbuzz = None
+
+STORE_NAME = 'Dr Zeeshan Awan Store'
+
+STATEMENT_FONTS = [
+    path for path in os.environ.get('STATEMENT_FONTS', os.pathsep.join([
+        '/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf',
+        '/usr/share/fonts/truetype/noto/NotoNaskhArabic-Regular.ttf',
+        '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    ])).split(os.pathsep)
+    if os.path.isfile(path)
+]
+
+
+# ------------------
+# Rendering (runs in the worker processes, no database access)
+# ------------------
+def statement_text(statement):
+    """Message in the same style as the invoice WhatsApp message."""
+    lines = [
+        f"🏪 *{STORE_NAME}*",
+        "",
+        f"📋 *Statement for {statement['month_label']}*",
+        f"👤 *Customer:* {statement['customer_name']}",
+        "",
+        f"Opening balance: Rs {statement['opening_balance']:.2f}",
+        "",
+    ]
+    if statement['sales']:
+        lines.append("📦 *Sales:*")
+        for sale in statement['sales']:
+            lines.append(
+                f"   {sale['date']}  {sale['item']} x {sale['quantity']:g} {sale['unit']}"
+                f" = Rs {sale['total']:.2f}"
+                + (f" (paid Rs {sale['paid']:.2f})" if sale['paid'] else "")
+            )
+        lines.append("")
+    if statement['payments']:
+        lines.append("💵 *Payments received:*")
+        for payment in statement['payments']:
+            lines.append(f"   {payment['date']}  Rs {payment['amount']:.2f}")
+        lines.append("")
+    lines += [
+        "💰 *Summary:*",
+        f"   Sales: Rs {statement['sales_total']:.2f}",
+        f"   Paid: Rs {statement['paid_total']:.2f}",
+        f"   Closing balance: Rs {statement['closing_balance']:.2f}",
+    ]
+    if statement['closing_balance'] > 0:
+        lines += ["", f"⚠️ *Please pay Rs {statement['closing_balance']:.2f}*"]
+    lines += ["", "Thank you for your business!"]
+    return "\n".join(lines)
+
+
+def _pdf_escape(value):
+    # The built-in PDF fonts only cover Latin-1; anything else prints as '?'
+    value = value.encode('latin-1', 'replace').decode('latin-1')
+    return value.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def statement_pdf_lines(statement):
+    lines = [
+        (16, STORE_NAME),
+        (12, f"Statement for {statement['month_label']}"),
+        (10, f"Customer: {statement['customer_name']}   Phone: {statement['phone'] or '-'}"),
+        (10, ""),
+        (10, f"Opening balance: Rs {statement['opening_balance']:.2f}"),
+        (10, ""),
+    ]
+    if statement['sales']:
+        lines.append((11, "Sales"))
+        for sale in statement['sales']:
+            lines.append((9, f"{sale['date']}  {sale['item'][:40]:<40} {sale['quantity']:>8g} {sale['unit'] or '':<6}"
+                             f" Rs {sale['total']:>10.2f}   paid Rs {sale['paid']:>10.2f}"))
+        lines.append((10, ""))
+    if statement['payments']:
+        lines.append((11, "Payments received"))
+        for payment in statement['payments']:
+            lines.append((9, f"{payment['date']}  Rs {payment['amount']:>10.2f}"))
+        lines.append((10, ""))
+    lines += [
+        (10, f"Sales: Rs {statement['sales_total']:.2f}"),
+        (10, f"Paid: Rs {statement['paid_total']:.2f}"),
+        (12, f"Closing balance: Rs {statement['closing_balance']:.2f}"),
+    ]
+    return lines
+
+
+def statement_pdf_unicode(statement):
+    """The same A4 text PDF through fpdf2, with the STATEMENT_FONTS embedded."""
+    pdf = FPDF(unit='pt', format='A4')
+    pdf.set_margins(50, 50)
+    pdf.set_auto_page_break(True, margin=50)
+    families = []
+    for number, path in enumerate(STATEMENT_FONTS):
+        families.append(f"F{number}")
+        pdf.add_font(families[-1], fname=path)
+    pdf.set_fallback_fonts(families[1:])
+    if uharfbuzz is not None:
+        # Joins Arabic-script letters and lays right-to-left runs out in order
+        pdf.set_text_shaping(True)
+    pdf.add_page()
+    pdf.set_font(families[0])
+    for size, line in statement_pdf_lines(statement):
+        if not line:
+            pdf.ln(size * 1.4)
+            continue
+        pdf.set_font_size(size)
+        pdf.cell(text=line, h=size * 1.4, new_x='LMARGIN', new_y='NEXT')
+    return bytes(pdf.output())
+
+
+def pdf_loses_text(statement):
+    """True when the built-in writer would print part of this statement as '?'."""
+    if FPDF is not None and STATEMENT_FONTS:
+        return False
+    try:
+        "".join(line for _, line in statement_pdf_lines(statement)).encode('latin-1')
+    except UnicodeEncodeError:
+        return True
+    return False
+
+
+def statement_pdf(statement):
+    """A plain A4 text PDF, built directly when fpdf2 or a TTF font is missing."""
+    if FPDF is not None and STATEMENT_FONTS:
+        return statement_pdf_unicode(statement)
+    page_height, margin = 842, 50
+    pages, stream, y = [], [], page_height - margin
+    for size, line in statement_pdf_lines(statement):
+        if y - size * 1.4 < margin:
+            pages.append(stream)
+            stream, y = [], page_height - margin
+        y -= size * 1.4
+        font = '/F2' if size >= 11 else '/F1'
+        stream.append(f"BT {font} {size} Tf {margin} {y:.1f} Td ({_pdf_escape(line)}) Tj ET")
+    pages.append(stream)
+
+    # Objects: 1 catalog, 2 page tree, 3-4 fonts, then a page + content pair per page
+    page_ids = [5 + 2 * i for i in range(len(pages))]
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{' '.join(f'{pid} 0 R' for pid in page_ids)}] /Count {len(pages)} >>".encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>",
+    ]
+    for page_id, page_stream in zip(page_ids, pages):
+        content = "\n".join(page_stream).encode('latin-1')
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 {page_height}] "
+            f"/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents {page_id + 1} 0 R >>".encode()
+        )
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def render_statement(statement, out_dir):
+    """Write one customer's .txt and .pdf and return their manifest row."""
+    base = os.path.join(out_dir, f"customer_{statement['customer_id']}")
+    text = statement_text(statement)
+    with open(base + '.txt', 'w', encoding='utf-8') as f:
+        f.write(text)
+    with open(base + '.pdf', 'wb') as f:
+        f.write(statement_pdf(statement))
+
+    phone = ''.join(ch for ch in (statement['phone'] or '') if ch.isdigit())
+    return {
+        'customer_id': statement['customer_id'],
+        'customer_name': statement['customer_name'],
+        'phone': statement['phone'] or '',
+        'opening_balance': f"{statement['opening_balance']:.2f}",
+        'sales_total': f"{statement['sales_total']:.2f}",
+        'paid_total': f"{statement['paid_total']:.2f}",
+        'closing_balance': f"{statement['closing_balance']:.2f}",
+        'text_file': base + '.txt',
+        'pdf_file': base + '.pdf',
+        'whatsapp_url': f"https://wa.me/{phone}?text={urllib.parse.quote(text)}" if phone else '',
+        'pdf_lost_text': 'yes' if pdf_loses_text(statement) else '',
+    }
+
+
+# ------------------
+# Statement data (runs in the main process)
+# ------------------
+def month_bounds(month, today=None):
+    """First day of the month and of the next one; default is the month before today."""
+    start = datetime.strptime(month, '%Y-%m') if month else None
+    if start is None:
+        today = today or date.today()
+        start = datetime(today.year - 1, 12, 1) if today.month == 1 else datetime(today.year, today.month - 1, 1)
+    end = datetime(start.year + 1, 1, 1) if start.month == 12 else datetime(start.year, start.month + 1, 1)
+    return start, end
+
+
+def iter_statements(db, models, start, end, history):
+    """Yield one statement dict per customer with activity or a balance.
+
+    A sale adds what was left unpaid when it was recorded (paid_amount minus
+    later payment allocations); a payment subtracts its full amount, including
+    any advance. That matches the balance_delta the ledger journal records.
+    Opening balances come from Sale, whose archive summary rows carry the
+    same totals; the month's lines come from `history` (app.sale_history()),
+    so archived months still list every sale.
+
+    start and end are shop-local month bounds: sales are picked by their
+    business_date, payments by their UTC time converted from those bounds.
+    """
+    from app import shop_time, shop_to_utc
+
+    Customer, Sale, Item, Payment, PaymentAllocation = models
+    first_day, next_first_day = start.date(), end.date()
+    start_utc, end_utc = shop_to_utc(start), shop_to_utc(end)
+
+    allocated = (
+        db.select(PaymentAllocation.sale_id, db.func.sum(PaymentAllocation.amount).label('amount'))
+        .group_by(PaymentAllocation.sale_id)
+        .subquery()
+    )
+    unpaid_at_sale = Sale.total_price - Sale.paid_amount + db.func.coalesce(allocated.c.amount, 0)
+
+    opening = {}
+    for customer_id, amount in db.session.execute(
+        db.select(Sale.customer_id, db.func.sum(unpaid_at_sale))
+        .outerjoin(allocated, allocated.c.sale_id == Sale.id)
+        .where(Sale.customer_id.isnot(None), Sale.business_date < first_day)
+        .group_by(Sale.customer_id)
+    ):
+        opening[customer_id] = amount or 0.0
+    for customer_id, amount in db.session.execute(
+        db.select(Payment.customer_id, db.func.sum(Payment.amount))
+        .where(Payment.date < start_utc)
+        .group_by(Payment.customer_id)
+    ):
+        opening[customer_id] = opening.get(customer_id, 0.0) - (amount or 0.0)
+
+    payments = {}
+    for customer_id, rows in groupby(db.session.execute(
+        db.select(Payment.customer_id, Payment.date, Payment.amount)
+        .where(Payment.date >= start_utc, Payment.date < end_utc)
+        .order_by(Payment.customer_id, Payment.date, Payment.id)
+    ), key=lambda row: row.customer_id):
+        payments[customer_id] = [
+            {'date': shop_time(row.date).strftime('%Y-%m-%d'), 'amount': row.amount} for row in rows
+        ]
+
+    customers = {
+        row.id: row for row in db.session.execute(db.select(Customer.id, Customer.name, Customer.phone))
+    }
+
+    # The month's sales for every customer in one pass, partitioned by customer.
+    # Archived sales carry their own allocated_amount; their allocations now
+    # point at the summary row.
+    sales = db.session.execute(
+        db.select(
+            history.c.customer_id, history.c.business_date, history.c.quantity, history.c.total_price,
+            (history.c.paid_amount - db.func.coalesce(history.c.allocated_amount, allocated.c.amount, 0)).label('paid_at_sale'),
+            Item.name.label('item_name'), Item.unit
+        )
+        .join(Item, Item.id == history.c.item_id)
+        .outerjoin(allocated, allocated.c.sale_id == history.c.id)
+        .where(
+            history.c.customer_id.isnot(None),
+            history.c.business_date >= first_day, history.c.business_date < next_first_day
+        )
+        .order_by(history.c.customer_id, history.c.date, history.c.id)
+        .execution_options(yield_per=1000)
+    )
+    sales_by_customer = groupby(sales, key=lambda row: row.customer_id)
+
+    def build(customer_id, sale_rows):
+        customer = customers[customer_id]
+        sale_lines = [
+            {
+                'date': row.business_date.strftime('%Y-%m-%d'),
+                'item': row.item_name,
+                'quantity': row.quantity,
+                'unit': row.unit or '',
+                'total': row.total_price,
+                'paid': round(row.paid_at_sale or 0.0, 2),
+            }
+            for row in sale_rows
+        ]
+        payment_lines = payments.pop(customer_id, [])
+        opening_balance = round(opening.pop(customer_id, 0.0), 2)
+        sales_total = round(sum(s['total'] for s in sale_lines), 2)
+        paid_total = round(sum(s['paid'] for s in sale_lines) + sum(p['amount'] for p in payment_lines), 2)
+        return {
+            'customer_id': customer_id,
+            'customer_name': customer.name,
+            'phone': customer.phone,
+            'month_label': start.strftime('%B %Y'),
+            'opening_balance': opening_balance,
+            'sales': sale_lines,
+            'payments': payment_lines,
+            'sales_total': sales_total,
+            'paid_total': paid_total,
+            'closing_balance': round(opening_balance + sales_total - paid_total, 2),
+        }
+
+    for customer_id, sale_rows in sales_by_customer:
+        if customer_id in customers:
+            yield build(customer_id, sale_rows)
+    sales.close()
+
+    # Customers with no sales this month still get a statement if they paid
+    # something or still owe from earlier months
+    for customer_id in sorted(set(payments) | set(opening)):
+        if customer_id not in customers:
+            continue
+        if customer_id not in payments and abs(opening[customer_id]) < 0.005:
+            continue
+        yield build(customer_id, [])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('month', nargs='?', help='Month as YYYY-MM (default: last month)')
+    parser.add_argument('--out', default='statements', help='Output directory (a YYYY-MM folder is created inside)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    args = parser.parse_args()
+
+    # Imported here so pool workers started with "spawn" don't initialise the app
+    from app import app, db, Customer, Sale, Item, Payment, PaymentAllocation, sale_history, shop_today
+
+    start, end = month_bounds(args.month, shop_today())
+    out_dir = os.path.join(args.out, start.strftime('%Y-%m'))
+    os.makedirs(out_dir, exist_ok=True)
+
+    started = datetime.now()
+    rows = []
+    with app.app_context(), ProcessPoolExecutor(max_workers=args.workers) as pool:
+        pending = set()
+        for statement in iter_statements(db, (Customer, Sale, Item, Payment, PaymentAllocation), start, end, sale_history()):
+            pending.add(pool.submit(render_statement, statement, out_dir))
+            # Keep the pool busy without holding every statement in memory
+            if len(pending) >= args.workers * 8:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                rows.extend(future.result() for future in done)
+        rows.extend(future.result() for future in pending)
+
+    rows.sort(key=lambda row: row['customer_id'])
+    manifest = os.path.join(out_dir, 'manifest.csv')
+    with open(manifest, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=[
+            'customer_id', 'customer_name', 'phone', 'opening_balance', 'sales_total',
+            'paid_total', 'closing_balance', 'text_file', 'pdf_file', 'whatsapp_url', 'pdf_lost_text'
+        ])
+        writer.writeheader()
+        writer.writerows(rows)
+
+    elapsed = (datetime.now() - started).total_seconds()
+    print(f"Wrote {len(rows)} statements for {start.strftime('%B %Y')} to {out_dir} in {elapsed:.1f}s")
+    print(f"Manifest: {manifest}")
+    lost = [row for row in rows if row['pdf_lost_text']]
+    if lost:
+        print(f"⚠️ {len(lost)} PDFs print some text as '?' (install fpdf2 and a Unicode font, see STATEMENT_FONTS):")
+        for row in lost:
+            print(f"   customer {row['customer_id']}: {row['customer_name']} -> {row['pdf_file']}")
+
+
+if __name__ == "__main__":
+    main()
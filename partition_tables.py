@@ -0,0 +1,113 @@
+"""
+Monthly Partitioning (PostgreSQL)
+Converts the sale and wholesaler_transaction tables into tables partitioned
+by month on their date column. Each month gets its own partition and its own
+small indexes, and queries with a date range only read the months they need.
+Once converted the app creates upcoming months on its own
+(PARTITION_MONTHS_AHEAD, default 3); rows dated outside every partition go
+to a <table>_default partition.
+
+Run it once, during a quiet moment; each table is converted in one
+transaction that holds an exclusive lock while the rows are copied:
+    python partition_tables.py
+    python partition_tables.py --dry-run
+
+PostgreSQL requires the partition key in the primary key, so the key becomes
+(id, date); ids still come from the same sequence and stay unique. Foreign
+keys that point at these tables (payment_allocation.sale_id,
+cost_layer_consumption.sale_id, cost_layer.wholesaler_transaction_id) can't
+reference a partitioned table's id alone and are dropped; the app already
+keeps those links consistent itself.
+"""
+
+import argparse
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex
+
+from app import (
+    app, db, logger, PARTITIONED_TABLES, PARTITION_MONTHS_AHEAD,
+    add_months, partitioned_tables, create_month_partitions
+)
+
+
+def convert(conn, table):
+    """Swap table for a partitioned copy holding the same rows."""
+    preparer = conn.dialect.identifier_preparer
+    name = preparer.quote(table.name)
+    old_name = f"{table.name}_unpartitioned"
+
+    conn.execute(text(f"LOCK TABLE {name} IN ACCESS EXCLUSIVE MODE"))
+    for referencing, constraint in conn.execute(text(
+        "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+        "WHERE contype = 'f' AND confrelid = CAST(:table AS regclass)"
+    ), {'table': table.name}).all():
+        conn.execute(text(f"ALTER TABLE {referencing} DROP CONSTRAINT {preparer.quote(constraint)}"))
+        logger.info(f"✓ Dropped foreign key {constraint} on {referencing}")
+
+    # The partition key must be NOT NULL; undated rows get the conversion time
+    conn.execute(text(f"UPDATE {name} SET date = now() WHERE date IS NULL"))
+    first, last = conn.execute(text(f"SELECT min(date), max(date) FROM {name}")).one()
+    sequence = conn.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {'table': table.name}).scalar()
+
+    conn.execute(text(f"ALTER TABLE {name} RENAME TO {preparer.quote(old_name)}"))
+    conn.execute(text(
+        f"CREATE TABLE {name} (LIKE {preparer.quote(old_name)} INCLUDING DEFAULTS) PARTITION BY RANGE (date)"
+    ))
+    conn.execute(text(f"ALTER TABLE {name} ALTER COLUMN date SET NOT NULL"))
+
+    this_month = add_months(datetime.utcnow())
+    create_month_partitions(
+        conn, table.name,
+        min(first or this_month, this_month),
+        add_months(max(last or this_month, this_month), PARTITION_MONTHS_AHEAD)
+    )
+    conn.execute(text(f"CREATE TABLE {preparer.quote(table.name + '_default')} PARTITION OF {name} DEFAULT"))
+
+    copied = conn.execute(text(f"INSERT INTO {name} SELECT * FROM {preparer.quote(old_name)}")).rowcount
+    # The id sequence belongs to the old table's column and would be dropped with it
+    if sequence:
+        conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {name}.id"))
+    conn.execute(text(f"DROP TABLE {preparer.quote(old_name)}"))
+
+    conn.execute(text(f"ALTER TABLE {name} ADD CONSTRAINT {preparer.quote(table.name + '_pkey')} PRIMARY KEY (id, date)"))
+    for fk in table.foreign_key_constraints:
+        columns = ', '.join(preparer.quote(c.name) for c in fk.columns)
+        targets = ', '.join(preparer.quote(e.column.name) for e in fk.elements)
+        conn.execute(text(
+            f"ALTER TABLE {name} ADD FOREIGN KEY ({columns}) "
+            f"REFERENCES {preparer.quote(fk.referred_table.name)} ({targets})"
+        ))
+    # Created on the parent, so every partition (present and future) gets its own copy
+    for index in table.indexes:
+        conn.execute(CreateIndex(index))
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help='Only report which tables would be converted')
+    args = parser.parse_args()
+
+    with app.app_context():
+        if db.engine.dialect.name != 'postgresql':
+            raise SystemExit("Partitioning needs PostgreSQL; on SQLite use archive_sales.py")
+        with db.engine.connect() as conn:
+            done = set(partitioned_tables(conn))
+        for table_name in PARTITIONED_TABLES:
+            if table_name in done:
+                print(f"{table_name}: already partitioned")
+                continue
+            if args.dry_run:
+                print(f"{table_name}: would be partitioned by month")
+                continue
+            started = datetime.now()
+            with db.engine.begin() as conn:
+                copied = convert(conn, db.metadata.tables[table_name])
+            elapsed = (datetime.now() - started).total_seconds()
+            print(f"{table_name}: partitioned by month, {copied} rows copied in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
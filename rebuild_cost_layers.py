@@ -0,0 +1,57 @@
+"""
+Cost Layer Rebuild Script
+Rebuilds FIFO cost layers, weighted-average costs and the cost stored on every
+sale by replaying existing purchases and sales in date order.
+Run this once after upgrading; from then on the layers are kept up to date as
+purchases and sales are recorded.
+"""
+
+from collections import defaultdict
+from datetime import datetime
+
+from app import (
+    app, db, Item, Sale, WholesalerTransaction, CostLayer, CostLayerConsumption,
+    add_cost_layer, consume_cost_layers
+)
+
+with app.app_context():
+    CostLayerConsumption.query.delete()
+    CostLayer.query.delete()
+    items = Item.query.all()
+    for item in items:
+        item.avg_cost = None
+    db.session.flush()
+
+    # (date, order, kind, record) - purchases sort before sales on the same instant
+    events = []
+    purchased = defaultdict(float)
+    for transaction in WholesalerTransaction.query.order_by(WholesalerTransaction.date, WholesalerTransaction.id):
+        item = transaction.item
+        if item is None:
+            continue
+        purchased[item.id] += transaction.quantity
+        events.append((transaction.date, 1, 'purchase', (item, transaction)))
+
+    # Stock entered on the Items page that no purchase explains becomes opening stock
+    for item in items:
+        opening = (item.stock_quantity or 0) - purchased[item.id]
+        if opening > 0:
+            events.append((datetime.min, 0, 'opening', (item, opening)))
+
+    for sale in Sale.query.order_by(Sale.date, Sale.id):
+        events.append((sale.date, 2, 'sale', sale))
+
+    events.sort(key=lambda e: (e[0], e[1]))
+
+    for when, _, kind, record in events:
+        if kind == 'opening':
+            item, quantity = record
+            add_cost_layer(item, quantity, item.purchase_price or 0, when=when)
+        elif kind == 'purchase':
+            item, transaction = record
+            add_cost_layer(item, transaction.quantity, transaction.price_per_unit, transaction, transaction.date)
+        else:
+            consume_cost_layers(record, record.item)
+
+    db.session.commit()
+    print(f"Rebuilt cost layers for {len(items)} items from {len(events)} events.")
@@ -0,0 +1,173 @@
+"""
+Stock Reconciliation
+Recomputes every item's purchased and sold totals from the records and
+compares them with the running figures the app keeps: Item.stock_quantity
+(opening stock plus everything bought) and the sold quantity in the reorder
+state. Those are adjusted by deltas as purchases are added, edited and
+deleted, and drift when a deletion is clamped at zero or a purchase is moved
+to a renamed item.
+
+Items are split into id ranges, and each range is checked by a worker process
+with streaming grouped queries, so memory stays flat and the work spreads over
+the CPUs even with millions of purchases and sales. Only discrepancies come
+back; with --repair they are corrected in one transaction at the end.
+
+Opening stock is the cost layers marked 'opening' (entered on the Items page
+or by rebuild_cost_layers.py) plus 'retained' ones, bought stock that stayed
+when its wholesaler was deleted. Layers of deleted purchases keep their
+quantity for the sales that used them but no longer count. Archived sales
+count through their summary rows, as they do everywhere else.
+
+Examples:
+    python reconcile_stock.py                       # report only
+    python reconcile_stock.py --repair
+    python reconcile_stock.py --workers 8 --chunk-size 20000
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+TOLERANCE = 0.0001
+
+
+def _grouped(db, conn, column, quantity, lo, hi, *conditions):
+    """(item_id, total) for ids in [lo, hi), streamed in item_id order."""
+    return conn.execute(
+        db.select(column, db.func.sum(quantity))
+        .where(column >= lo, column < hi, *conditions)
+        .group_by(column).order_by(column)
+        .execution_options(yield_per=5000)
+    )
+
+
+def _merged(rows, item_id):
+    """Advance a sorted (item_id, total) stream to item_id; its total or 0."""
+    head = rows['head']
+    while head is not None and head[0] < item_id:
+        head = rows['head'] = next(rows['rows'], None)
+    if head is not None and head[0] == item_id:
+        return head[1] or 0.0
+    return 0.0
+
+
+def check_range(bounds):
+    """Discrepancies for items with ids in [lo, hi). Runs in a worker process."""
+    lo, hi = bounds
+    from app import app, db, Item, Sale, WholesalerTransaction, CostLayer, ItemReorderState
+
+    with app.app_context(), db.engine.connect() as conn:
+        streams = {
+            'purchased': _grouped(db, conn, WholesalerTransaction.item_id, WholesalerTransaction.quantity, lo, hi),
+            'opening': _grouped(db, conn, CostLayer.item_id, CostLayer.quantity, lo, hi,
+                                CostLayer.source.in_(('opening', 'retained'))),
+            'sold': _grouped(db, conn, Sale.item_id, Sale.quantity, lo, hi),
+        }
+        streams = {name: {'rows': iter(rows), 'head': None} for name, rows in streams.items()}
+        for stream in streams.values():
+            stream['head'] = next(stream['rows'], None)
+
+        items = conn.execute(
+            db.select(Item.id, Item.name, Item.stock_quantity, ItemReorderState.sold_quantity)
+            .outerjoin(ItemReorderState, ItemReorderState.item_id == Item.id)
+            .where(Item.id >= lo, Item.id < hi)
+            .order_by(Item.id)
+            .execution_options(yield_per=5000)
+        )
+        checked, discrepancies = 0, []
+        for item_id, name, stock_quantity, recorded_sold in items:
+            checked += 1
+            purchased = _merged(streams['opening'], item_id) + _merged(streams['purchased'], item_id)
+            sold = _merged(streams['sold'], item_id)
+            # Items without a reorder state get one seeded from their sales at startup
+            if (abs((stock_quantity or 0) - purchased) > TOLERANCE
+                    or recorded_sold is not None and abs(recorded_sold - sold) > TOLERANCE):
+                discrepancies.append({
+                    'item_id': item_id, 'name': name,
+                    'stock_quantity': stock_quantity or 0, 'purchased': purchased,
+                    'recorded_sold': recorded_sold, 'sold': sold,
+                })
+    return checked, discrepancies
+
+
+def _worker_init():
+    from app import db
+    # Forked workers must not reuse the parent's pooled connections
+    db.engine.dispose(close=False)
+
+
+def id_ranges(db, Item, chunk_size):
+    low, high = db.session.execute(db.select(db.func.min(Item.id), db.func.max(Item.id))).one()
+    if low is None:
+        return []
+    return [(lo, min(lo + chunk_size, high + 1)) for lo in range(low, high + 1, chunk_size)]
+
+
+def repair(db, discrepancies):
+    """Set the running figures to the recomputed totals; reorder advice follows."""
+    from app import Item, ItemReorderState, refresh_reorder_states
+
+    conn = db.session.connection()
+    stock = [d for d in discrepancies if abs(d['stock_quantity'] - d['purchased']) > TOLERANCE]
+    if stock:
+        conn.execute(
+            db.update(Item).where(Item.id == db.bindparam('item_id')).values(stock_quantity=db.bindparam('purchased')),
+            [{'item_id': d['item_id'], 'purchased': d['purchased']} for d in stock]
+        )
+    state = ItemReorderState.__table__
+    sold = [d for d in discrepancies if d['recorded_sold'] is not None and abs(d['recorded_sold'] - d['sold']) > TOLERANCE]
+    if sold:
+        conn.execute(
+            db.update(state).where(state.c.item_id == db.bindparam('state_item_id')).values(sold_quantity=db.bindparam('sold')),
+            [{'state_item_id': d['item_id'], 'sold': d['sold']} for d in sold]
+        )
+    refresh_reorder_states(conn, [d['item_id'] for d in discrepancies])
+    db.session.info['catalog_stale'] = True
+    db.session.info['bootstrap_stale'] = True
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repair', action='store_true', help='Correct the discrepancies found')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--chunk-size', type=int, default=50000, help='Item ids per worker task (default: %(default)s)')
+    args = parser.parse_args()
+    if args.chunk_size < 1:
+        parser.error('--chunk-size must be at least 1')
+
+    from app import app, db, Item, WholesalerTransaction
+
+    started = datetime.now()
+    with app.app_context():
+        ranges = id_ranges(db, Item, args.chunk_size)
+        unlinked = db.session.execute(
+            db.select(db.func.count(WholesalerTransaction.id)).where(WholesalerTransaction.item_id.is_(None))
+        ).scalar()
+        db.session.rollback()
+
+        checked, discrepancies = 0, []
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_worker_init) as pool:
+            for range_checked, found in pool.map(check_range, ranges):
+                checked += range_checked
+                discrepancies.extend(found)
+
+        for d in discrepancies:
+            recorded_sold = '-' if d['recorded_sold'] is None else f"{d['recorded_sold']:g}"
+            print(
+                f"#{d['item_id']} {d['name']}: stock {d['stock_quantity']:g} -> {d['purchased']:g}, "
+                f"sold {recorded_sold} -> {d['sold']:g}"
+            )
+        print(f"Checked {checked} items in {len(ranges)} ranges: {len(discrepancies)} discrepancies "
+              f"({(datetime.now() - started).total_seconds():.1f}s)")
+        if unlinked:
+            print(f"{unlinked} purchases are not linked to any item and were not counted")
+
+        if args.repair and discrepancies:
+            repair(db, discrepancies)
+            print(f"Repaired {len(discrepancies)} items")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,8 @@
 // ============================================
 
 const DB_NAME = 'StoreBillingDB';
-const DB_VERSION = 1;
+const DB_VERSION = 2;
+const BOOTSTRAP_VERSION_KEY = 'bootstrapVersion';
 let db = null;
 
 // Initialize IndexedDB
@@ -41,6 +42,17 @@ function initDB() {
         itemStore.createIndex('name', 'name', { unique: false });
       }
 
+      // Wholesalers store
+      if (!db.objectStoreNames.contains('wholesalers')) {
+        const wholesalerStore = db.createObjectStore('wholesalers', { keyPath: 'id' });
+        wholesalerStore.createIndex('name', 'name', { unique: false });
+      }
+
+      // Customer balances store (outstanding credit per customer)
+      if (!db.objectStoreNames.contains('balances')) {
+        db.createObjectStore('balances', { keyPath: 'customer_id' });
+      }
+
       // Sales store (for offline sales)
       if (!db.objectStoreNames.contains('sales')) {
         const saleStore = db.createObjectStore('sales', { keyPath: 'id', autoIncrement: true });
@@ -161,7 +173,8 @@ async function saveOfflineSale(saleData) {
       ...saleData,
       synced: false,
       date: new Date().toISOString(),
-      temp_id: 'temp_' + Date.now()
+      // Also the server's key for this sale, so a retried sync can't record it twice
+      temp_id: 'temp_' + (window.crypto && crypto.randomUUID ? crypto.randomUUID() : Date.now() + '_' + Math.random().toString(36).slice(2))
     };
     
     const request = store.add(sale);
@@ -197,6 +210,43 @@ async function addToSyncQueue(type, data) {
   });
 }
 
+// Replace all reference data with a bootstrap snapshot in one transaction
+function saveBootstrapToDB(snapshot) {
+  const stores = ['customers', 'items', 'wholesalers', 'balances'];
+  return new Promise((resolve, reject) => {
+    const tx = db.transaction(stores, 'readwrite');
+    stores.forEach((name) => {
+      const store = tx.objectStore(name);
+      store.clear();
+      (snapshot[name] || []).forEach((record) => store.put(record));
+    });
+    tx.oncomplete = () => resolve();
+    tx.onerror = () => reject(tx.error);
+    tx.onabort = () => reject(tx.error);
+  });
+}
+
+// Load customers, items, wholesalers and balances with a single request.
+// The server answers 304 when our stored version is still current.
+async function loadBootstrap() {
+  if (!db) await initDB();
+  const storedVersion = localStorage.getItem(BOOTSTRAP_VERSION_KEY);
+  const headers = storedVersion ? { 'If-None-Match': `"${storedVersion}"` } : {};
+
+  const response = await fetch('/api/bootstrap', { headers });
+  if (response.status === 304) {
+    return false;
+  }
+  if (!response.ok) {
+    throw new Error('Failed to load bootstrap data');
+  }
+
+  const snapshot = await response.json();
+  await saveBootstrapToDB(snapshot);
+  localStorage.setItem(BOOTSTRAP_VERSION_KEY, snapshot.version);
+  return true;
+}
+
 // ============================================
 // Network Status & Sync
 // ============================================
@@ -217,17 +267,26 @@ async function syncOfflineData() {
     
     request.onsuccess = async () => {
       const pendingItems = request.result;
+      let syncedCount = 0;
       
       for (const item of pendingItems) {
+        // Refused sales stay in the queue for reference but aren't sent again
+        if (item.refused) continue;
         try {
           if (item.type === 'sale') {
-            await syncSale(item.data);
+            const refusal = await syncSale(item.data);
+            if (refusal) {
+              item.refused = refusal;
+              showNotification(`Offline sale not recorded: ${refusal}`, 'error');
+            } else {
+              syncedCount++;
+            }
           }
           
-          // Mark as synced
+          // Mark as synced, or as refused
           const updateTx = db.transaction('syncQueue', 'readwrite');
           const updateStore = updateTx.objectStore('syncQueue');
-          item.synced = true;
+          item.synced = !item.refused;
           await updateStore.put(item);
         } catch (error) {
           console.error('Error syncing item:', error);
@@ -235,8 +294,8 @@ async function syncOfflineData() {
       }
       
       // Show notification
-      if (pendingItems.length > 0) {
-        showNotification(`${pendingItems.length} offline sales synced successfully!`);
+      if (syncedCount > 0) {
+        showNotification(`${syncedCount} offline sales synced successfully!`);
       }
     };
   } catch (error) {
@@ -244,29 +303,34 @@ async function syncOfflineData() {
   }
 }
 
-// Sync a single sale
+// Sync a single sale. Resolves to the server's reason if it refused the
+// sale for good; throws if it should be tried again later.
 async function syncSale(saleData) {
-  const formData = new FormData();
-  formData.append('sale_type', saleData.sale_type || 'credit');
-  formData.append('item_id', saleData.item_id);
-  formData.append('quantity', saleData.quantity);
-  formData.append('unit_price', saleData.unit_price);
-  formData.append('paid_amount', saleData.paid_amount || 0);
-  
-  if (saleData.customer_id) {
-    formData.append('customer_id', saleData.customer_id);
-  }
-  
-  const response = await fetch('/add-sale', {
+  const response = await fetch('/api/offline-sales', {
     method: 'POST',
-    body: formData
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({
+      client_id: saleData.temp_id,
+      sale_type: saleData.sale_type || 'credit',
+      item_id: saleData.item_id,
+      quantity: saleData.quantity,
+      unit_price: saleData.unit_price,
+      paid_amount: saleData.paid_amount || 0,
+      customer_id: saleData.customer_id || null,
+      // When the sale was queued; the server holds over-limit ones for review
+      queued_at: saleData.date
+    })
   });
   
+  if (response.status >= 400 && response.status < 500 && response.status !== 429) {
+    const body = await response.json().catch(() => ({}));
+    return body.error || `refused by the server (${response.status})`;
+  }
   if (!response.ok) {
     throw new Error('Failed to sync sale');
   }
   
-  return response;
+  return null;
 }
 
 // ============================================
@@ -278,8 +342,12 @@ function initCustomerAutocomplete(inputElement, hiddenInputElement, onSelectCall
   let currentFocus = -1;
   let customers = [];
   
-  // Load customers (from API or IndexedDB)
+  // Load customers (from IndexedDB, filled by the bootstrap; API only if empty)
   async function loadCustomers() {
+    customers = await getCustomersFromDB();
+    if (customers.length > 0) {
+      return;
+    }
     if (isOnline()) {
       try {
         const response = await fetch('/api/customers');
@@ -459,22 +527,10 @@ document.addEventListener('DOMContentLoaded', async () => {
   // Initialize IndexedDB
   await initDB();
   
-  // Load initial data
+  // Load initial data (customers, items, wholesalers, balances) in one request
   if (isOnline()) {
     try {
-      // Load customers
-      const customersRes = await fetch('/api/customers');
-      if (customersRes.ok) {
-        const customers = await customersRes.json();
-        await saveCustomersToDB(customers);
-      }
-      
-      // Load items
-      const itemsRes = await fetch('/api/items');
-      if (itemsRes.ok) {
-        const items = await itemsRes.json();
-        await saveItemsToDB(items);
-      }
+      await loadBootstrap();
     } catch (error) {
       console.error('Error loading initial data:', error);
     }
@@ -506,6 +562,7 @@ window.StoreApp = {
   showNotification,
   getCustomersFromDB,
   getItemsFromDB,
+  loadBootstrap,
   getCustomersFromDB: getCustomersFromDB  // Make sure it's exported
 };
 
@@ -90,8 +90,9 @@ async function getCustomersFromIndexedDB() {
             }
             
             // Last resort: try to open IndexedDB directly
+            // No version: open whatever version app.js has upgraded it to
             const DB_NAME = 'StoreBillingDB';
-            const request = indexedDB.open(DB_NAME, 1);
+            const request = indexedDB.open(DB_NAME);
             
             request.onsuccess = (event) => {
                 const db = event.target.result;
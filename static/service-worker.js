@@ -1,6 +1,8 @@
 // Service Worker for Offline-First PWA
 // Version: 1.0.0
 
+// CACHE_NAME and STATIC_ASSETS are rewritten from the asset manifest by
+// build_assets.py (static/dist/service-worker.js); no need to bump by hand
 const CACHE_NAME = 'store-billing-v1';
 const RUNTIME_CACHE = 'store-runtime-v1';
 
@@ -101,6 +103,14 @@ self.addEventListener('fetch', (event) => {
     return;
   }
 
+  // Hashed build output never changes: Cache First
+  if (url.pathname.startsWith('/static/dist/')) {
+    event.respondWith(
+      caches.match(request).then((cachedResponse) => cachedResponse || fetch(request))
+    );
+    return;
+  }
+
   // Strategy: Network First, fallback to Cache
   event.respondWith(
     fetch(request).then((response) => {